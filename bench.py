@@ -0,0 +1,1903 @@
+# -*- coding: utf-8 -*-
+# 打卡机器人：离线基准测试（不连 Telegram）
+#
+# 用法：
+#   python3 bench.py persistence --users 20000 --dirty 50
+#   python3 bench.py timers --sessions 10000
+#   python3 bench.py webhook --mode webhook --count 2000 [--updates recorded.jsonl]
+#   python3 bench.py webhook --mode polling --count 2000 --api-latency 0.05
+#   python3 bench.py filters --count 200000
+#   python3 bench.py load --groups 50 --users 40 --cycles 3 --api-latency 0.03 --rate-429 0.01
+#   python3 bench.py stress --concurrency 256 --groups 20 --users 50 --cycles 5
+#   python3 bench.py events --months 6 --groups 10 --users 50 --sessions 8
+#   python3 bench.py summary --users 100000 --chats 50
+#   python3 bench.py shards --workers 1,2,4 --groups 40 --users 50 --cycles 3
+#   python3 bench.py metrics --groups 20 --users 30 --api-latency 0.03 --rate-429 0.02
+#   python3 bench.py help --groups 20 --users 30 --interval 2 --duration 30
+#   python3 bench.py schema --users 20000 --chats 2
+#   python3 bench.py backup --users 20000 --days 7 --dirty 200 --restarts-per-day 24
+#   python3 bench.py export --users 300 --days 30
+#   python3 bench.py reshard --users 20000
+#   python3 bench.py startup --users 100000 --api-latency 0.05 --target-ms 500
+#   python3 bench.py trace --groups 20 --users 20 --cycles 5 --slow-ms 20
+#   python3 bench.py fanout --groups 100 --big-groups 5 --api-latency 0.25
+#   python3 bench.py replay --hours 24 --groups 1 --users 80 [--log recorded.jsonl.gz]
+#   python3 bench.py outage --groups 10 --users 10 --ended 0.25 --outage 3
+
+import os
+import gc
+import sys
+import re
+import copy
+import json
+import pickle
+import functools
+import random
+import asyncio
+import itertools
+import multiprocessing
+import argparse
+import tempfile
+import shutil
+import heapq
+import glob
+import io
+import contextlib
+import tracemalloc
+from types import SimpleNamespace
+from time import perf_counter, process_time, time
+from collections import Counter
+from html.parser import HTMLParser
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+from telegram import Update
+from telegram.request import BaseRequest
+from telegram.ext import (
+    ApplicationBuilder, BasePersistence, PersistenceInput, PicklePersistence, TypeHandler, MessageHandler,
+    filters as F,
+)
+
+import checkin_bot as bot
+
+# ========= 小工具 =========
+def legacy_user_data(uid: int, chats: int = 2) -> dict:
+    """构造一份改造前（schema 1）的 dict 版 user_data"""
+    now = datetime.now(timezone.utc)
+    ud = {
+        "last_chat_id": -1000 - uid % chats,
+        "_last_seen": now.timestamp(),
+        "user_username": f"user{uid}",
+        "user_link": f'<a href="tg://user?id={uid}">user {uid}</a>',
+        "last_end_smoke": now.timestamp() - 600,
+        "stats_epoch": bot.shift_epoch(),
+        "stats_by_chat": {
+            str(-1000 - c): {
+                "smoke":  {"count": uid % 5, "dur": uid % 3000},
+                "toilet": {"count": uid % 4, "dur": uid % 2000},
+                "meal":   {"count": uid % 2, "dur": uid % 4000},
+            }
+            for c in range(chats)
+        },
+    }
+    if uid % 10 == 0:
+        ud["active"] = {"type": "smoke", "title": "抽烟", "start": now - timedelta(minutes=3), "limit": 10}
+    return ud
+
+def fake_user_data(uid: int, chats: int = 2) -> "bot.UserState":
+    """构造一份和线上结构一致的 user_data"""
+    return bot.UserState.from_record(legacy_user_data(uid, chats))
+
+class LoopLag:
+    """记录事件循环最大卡顿（心跳间隔 - 期望间隔）"""
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _beat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            self.max_lag = max(self.max_lag, loop.time() - t0 - self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.ensure_future(self._beat())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def file_size(path: str) -> int:
+    total = 0
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            total += os.path.getsize(path + suffix)
+    return total
+
+class _TagChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack: List[str] = []
+        self.ok = True
+
+    def handle_starttag(self, tag, attrs):
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if self.stack and self.stack[-1] == tag:
+            self.stack.pop()
+        else:
+            self.ok = False
+
+def html_ok(text: str) -> bool:
+    """粗略模拟 Telegram 的 HTML 解析：长度不超过 4096、标签成对且正确嵌套"""
+    if len(text) > 4096:
+        return False
+    checker = _TagChecker()
+    checker.feed(text)
+    checker.close()
+    return checker.ok and not checker.stack and checker.rawdata == ""
+
+# ========= 假 Bot API：进程内替代 api.telegram.org =========
+class FakeBotAPI(BaseRequest):
+    """
+    作为 Application 的 request 使用：按方法名返回看起来合理的结果，记录每次调用，
+    可注入固定延迟和随机 429；getUpdates 支持长轮询（push_update 推进来的更新会立即返回）。
+    check_html=True 时像真接口一样拒绝超长（>4096）或 HTML 标签不配对的 sendMessage（400）。
+    """
+
+    def __init__(self, latency: float = 0.0, admins=(1,), rate_429: float = 0.0,
+                 retry_after: int = 1, seed: int = 1, check_html: bool = False):
+        self.latency = latency
+        self.check_html = check_html
+        self.inflight = 0
+        self.max_inflight = 0
+        self.admins = set(admins)
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self._rnd = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._mid = itertools.count(1_000_000)
+        self._updates: List[dict] = []
+        self._new_updates: Optional[asyncio.Event] = None
+
+    @property
+    def read_timeout(self) -> float:
+        return 10.0
+
+    async def initialize(self):
+        self._new_updates = asyncio.Event()
+
+    async def shutdown(self):
+        return None
+
+    def push_update(self, data: dict):
+        self._updates.append(data)
+        self._new_updates.set()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] += 1
+        if name == "getUpdates":
+            result = await self._get_updates(params)
+        else:
+            sending = name == "sendMessage"
+            self.inflight += sending
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            try:
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+            finally:
+                self.inflight -= sending
+            if name == "sendMessage" and self.check_html and not html_ok(params.get("text", "")):
+                self.errors["bad_html"] += 1
+                return 400, json.dumps({"ok": False, "error_code": 400,
+                                        "description": "Bad Request: can't parse entities"}).encode()
+            if name == "sendMessage" and self.rate_429 and self._rnd.random() < self.rate_429:
+                self.errors[name] += 1
+                return 429, json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }).encode()
+            result = self._result(name, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    async def _get_updates(self, params: dict) -> List[dict]:
+        offset = int(params.get("offset") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return list(self._updates)
+
+    def _result(self, name: str, params: dict):
+        if name == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if name == "sendMessage":
+            return {
+                "message_id": next(self._mid), "date": int(datetime.now().timestamp()),
+                "chat": {"id": int(params["chat_id"]), "type": "supergroup", "title": "bench"},
+                "text": params.get("text", ""),
+            }
+        if name == "sendDocument":
+            return {
+                "message_id": next(self._mid), "date": int(datetime.now().timestamp()),
+                "chat": {"id": int(params["chat_id"]), "type": "supergroup", "title": "bench"},
+                "document": {"file_id": "bench", "file_unique_id": "bench"},
+            }
+        if name == "getChatAdministrators":
+            return [{"status": "administrator", "user": {"id": uid, "is_bot": False, "first_name": "admin"},
+                     "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                     "can_delete_messages": True, "can_manage_video_chats": True,
+                     "can_restrict_members": True, "can_promote_members": False, "can_change_info": True,
+                     "can_invite_users": True, "can_post_stories": False, "can_edit_stories": False,
+                     "can_delete_stories": False}
+                    for uid in self.admins]
+        if name == "getChatMember":
+            uid = int(params["user_id"])
+            return {"status": "member", "user": {"id": uid, "is_bot": False, "first_name": f"u{uid}"}}
+        return True
+
+class MemoryPersistence(BasePersistence):
+    """只在内存里的持久化：用来把预先构造好的 user_data 交给 Application（模拟重启加载）"""
+
+    def __init__(self, user_data: Optional[dict] = None, chat_data: Optional[dict] = None):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=3600)
+        self.user_data = user_data or {}
+        self.chat_data = chat_data or {}
+        self.bot_data: dict = {}
+
+    async def get_user_data(self):
+        return self.user_data
+
+    async def get_chat_data(self):
+        return self.chat_data
+
+    async def get_bot_data(self):
+        return self.bot_data
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        self.user_data[user_id] = data
+
+    async def update_chat_data(self, chat_id, data):
+        self.chat_data[chat_id] = data
+
+    async def update_bot_data(self, data):
+        self.bot_data = data
+
+    async def update_callback_data(self, data):
+        return None
+
+    async def drop_user_data(self, user_id):
+        self.user_data.pop(user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self.chat_data.pop(chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        return None
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        return None
+
+    async def refresh_bot_data(self, bot_data):
+        return None
+
+    async def flush(self):
+        return None
+
+def make_message(update_id: int, chat_id: int, uid: int, text: str) -> dict:
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(datetime.now().timestamp()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"group {chat_id}"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"user{uid}"},
+            "text": text,
+        },
+    }
+    if text.startswith("/"):
+        data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return data
+
+def synth_updates(count: int, groups: int, users: int, seed: int = 1) -> List[dict]:
+    """N 个群 × M 个人随机打卡/回来/乱输"""
+    rnd = random.Random(seed)
+    texts = ["wc", "抽烟", "吃饭", "回来", "1", "你好", "ok"]
+    out = []
+    for i in range(1, count + 1):
+        chat_id = -1000 - rnd.randrange(groups)
+        uid = 10 + rnd.randrange(users)
+        out.append(make_message(i, chat_id, uid, rnd.choice(texts)))
+    return out
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class LatencyProbe:
+    """最后一个 handler 组里记录：从“送达”到所有 handler 处理完的耗时"""
+
+    def __init__(self):
+        self.sent: Dict[int, float] = {}
+        self.latency: List[float] = []
+        self._done = asyncio.Event()
+        self.expected = 0
+
+    def mark_sent(self, update_id: int):
+        self.sent[update_id] = perf_counter()
+
+    async def done(self, update: Update, _ctx):
+        t0 = self.sent.pop(update.update_id, None)
+        if t0 is not None:
+            self.latency.append(perf_counter() - t0)
+        if len(self.latency) >= self.expected:
+            self._done.set()
+
+    async def wait(self, expected: int, timeout: float = 60):
+        self.expected = expected
+        if len(self.latency) < expected:
+            await asyncio.wait_for(self._done.wait(), timeout)
+
+def deep_sizeof(obj, seen=None) -> int:
+    """递归估算对象占用（dict/list/tuple/set + 自定义对象的 __dict__/__slots__）"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += deep_sizeof(vars(obj), seen)
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+def drop_startup_reset(app):
+    """压测跑得比 5 秒长时，reset-on-start 会把统计清零，这里去掉"""
+    for job in app.job_queue.get_jobs_by_name("reset-on-start"):
+        job.schedule_removal()
+
+def relax_rules():
+    """压测时去掉最小时长/冷却/次数上限，让每个 开始→回来 都计入统计"""
+    for table in (bot.MIN_SECONDS, bot.COOLDOWN_MIN, bot.LIMITS_COUNT):
+        for key in table:
+            table[key] = 0
+    bot.POLICIES.clear()
+
+async def drain_outbox(timeout: float = 120):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while bot.OUTBOX.depth and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+# ========= persistence：PicklePersistence vs SQLitePersistence =========
+async def _flush_once(persistence, users: dict, dirty: list) -> tuple:
+    for uid in dirty:
+        users[uid].last_seen += 1
+    await asyncio.sleep(0)
+    # Application 也是先 deepcopy 再交给持久化
+    with LoopLag() as lag:
+        t0 = perf_counter()
+        await asyncio.gather(*(persistence.update_user_data(uid, copy.deepcopy(users[uid])) for uid in dirty))
+        wall = perf_counter() - t0
+        await asyncio.sleep(0.002)
+    return wall * 1000, lag.max_lag * 1000
+
+async def bench_persistence(args):
+    users = {uid: fake_user_data(uid) for uid in range(1, args.users + 1)}
+    dirty = list(range(1, args.dirty + 1))
+    with tempfile.TemporaryDirectory() as tmp:
+        pkl_path = os.path.join(tmp, "botdata.pkl")
+        db_path = os.path.join(tmp, "botdata.db")
+
+        # 和线上原配置一致：on_flush=False，每个脏用户都会整文件重写一次
+        pkl = PicklePersistence(filepath=pkl_path)
+        await pkl.get_user_data()
+        pkl.user_data = copy.deepcopy(users)
+        pkl._dump_singlefile()
+
+        sql = bot.SQLitePersistence(filepath=db_path)
+        await sql.get_user_data()
+        t0 = perf_counter()
+        await asyncio.gather(*(sql.update_user_data(uid, ud) for uid, ud in users.items()))
+        initial = (perf_counter() - t0) * 1000
+
+        results = {"pickle": [], "sqlite": []}
+        for _ in range(args.rounds):
+            results["pickle"].append(await _flush_once(pkl, users, dirty))
+            results["sqlite"].append(await _flush_once(sql, users, dirty))
+        await sql.flush()
+
+        print(f"users={args.users} dirty/flush={args.dirty} rounds={args.rounds}")
+        print(f"sqlite 首次全量写入: {initial:.1f} ms")
+        for name, rows in results.items():
+            walls = sorted(r[0] for r in rows)
+            lags = sorted(r[1] for r in rows)
+            print(f"{name:7s} flush 中位 {walls[len(walls) // 2]:8.1f} ms | 最大 {walls[-1]:8.1f} ms"
+                  f" | 事件循环最大卡顿 {lags[-1]:8.1f} ms")
+        print(f"pickle  文件大小 {file_size(pkl_path) / 1024:.0f} KiB")
+        print(f"sqlite  文件大小 {file_size(db_path) / 1024:.0f} KiB（含 WAL）")
+
+# ========= timers：N 个进行中的打卡，JobQueue vs DeadlineHeap =========
+async def _noop(*_args):
+    return None
+
+def _measure(fn) -> tuple:
+    """返回 (CPU 秒, 新增内存字节)"""
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = process_time()
+    keep = fn()
+    cpu = process_time() - t0
+    mem = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return cpu, mem, keep
+
+async def bench_timers(args):
+    n = args.sessions
+    now = datetime.now(timezone.utc)
+    starts = [now - timedelta(seconds=i % 600) for i in range(n)]
+
+    # 旧做法：每个打卡两个 APScheduler job
+    app = ApplicationBuilder().token("1:bench").build()
+    await app.job_queue.start()
+
+    def schedule_jobs():
+        jobs = []
+        for uid, start in enumerate(starts):
+            run_at = start + timedelta(minutes=10)
+            jobs.append(app.job_queue.run_once(_noop, when=run_at, data={"uid": uid, "chat_id": -1}))
+            jobs.append(app.job_queue.run_once(_noop, when=run_at + timedelta(minutes=3),
+                                               data={"uid": uid, "chat_id": -1}))
+        return jobs
+
+    jq_cpu, jq_mem, jobs = _measure(schedule_jobs)
+    t0 = process_time()
+    for job in jobs:
+        job.schedule_removal()
+    jq_cancel = process_time() - t0
+    await app.job_queue.stop()
+
+    # 新做法：一个堆，结束时不用删除
+    heap = bot.DeadlineHeap(_noop)
+
+    def schedule_heap():
+        for uid, start in enumerate(starts):
+            token = start.timestamp()
+            heap.push(token + 600, "timeout", uid, -1, token)
+            heap.push(token + 780, "grace", uid, -1, token)
+        return heap
+
+    hp_cpu, hp_mem, _ = _measure(schedule_heap)
+    t0 = process_time()
+    fired = heap.pop_due(now.timestamp() + 3600)
+    hp_pop = process_time() - t0
+
+    print(f"sessions={n}（每个 2 条提醒）")
+    print(f"JobQueue      安排 {jq_cpu * 1000:8.1f} ms CPU | 内存 {jq_mem / 1024 / 1024:7.2f} MiB"
+          f" | 取消 {jq_cancel * 1000:8.1f} ms CPU")
+    print(f"DeadlineHeap  安排 {hp_cpu * 1000:8.1f} ms CPU | 内存 {hp_mem / 1024 / 1024:7.2f} MiB"
+          f" | 取消 0（懒删除）| 弹出全部 {len(fired)} 条 {hp_pop * 1000:.1f} ms CPU")
+
+# ========= webhook：webhook vs polling 端到端处理延迟 =========
+async def bench_webhook(args):
+    updates = load_updates(args.updates) if args.updates else synth_updates(args.count, args.groups, args.users)
+    api = FakeBotAPI(latency=args.api_latency)
+    app = bot.build_app(token="1:bench", request=api)
+    probe = LatencyProbe()
+    app.add_handler(TypeHandler(Update, probe.done), group=1000)
+
+    t0 = perf_counter()
+    if args.mode == "webhook":
+        stop = asyncio.Event()
+        runner = asyncio.ensure_future(bot.run_webhook(app, "http://127.0.0.1", args.port, stop))
+        while not app.running:
+            await asyncio.sleep(0.01)
+        base = f"http://127.0.0.1:{args.port}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET}
+        async with httpx.AsyncClient() as client:
+            t0 = perf_counter()
+            for data in updates:
+                probe.mark_sent(data["update_id"])
+                r = await client.post(base + bot.WEBHOOK_PATH, json=data, headers=headers)
+                r.raise_for_status()
+                if args.interval:
+                    await asyncio.sleep(args.interval)
+            await probe.wait(len(updates))
+            elapsed = perf_counter() - t0
+            health = (await client.get(base + "/healthz")).json()
+        stop.set()
+        await runner
+        print("healthz:", health)
+    else:
+        await app.initialize()
+        await app.post_init(app)
+        await app.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=bot.ALLOWED_UPDATES)
+        await app.start()
+        t0 = perf_counter()
+        for data in updates:
+            probe.mark_sent(data["update_id"])
+            api.push_update(data)
+            await asyncio.sleep(args.interval)
+        await probe.wait(len(updates))
+        elapsed = perf_counter() - t0
+        await app.updater.stop()
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+
+    lat = [x * 1000 for x in probe.latency]
+    print(f"mode={args.mode} updates={len(updates)} api_latency={args.api_latency * 1000:.0f}ms")
+    print(f"端到端处理延迟 p50 {percentile(lat, 0.5):.2f} ms | p99 {percentile(lat, 0.99):.2f} ms"
+          f" | 最大 {max(lat):.2f} ms | 吞吐 {len(updates) / elapsed:.0f} updates/s")
+    print("Bot API 调用：", dict(api.calls))
+
+# ========= filters：旧的三个正则 MessageHandler vs 单次查表 =========
+def legacy_text_handlers():
+    """还原改造前 main() 里的三个 handler 及 text_start 里的集合重建"""
+    words = set()
+    for ws in bot.TRIGGERS.values():
+        words |= {w.lower() for w in ws}
+    start_re = re.compile(r"^(" + "|".join(map(re.escape, sorted(words))) + r")$", re.IGNORECASE)
+    back_re = re.compile(r"^(回来|回|back|1)$", re.IGNORECASE)
+    base = F.TEXT & F.ChatType.GROUPS & (~F.COMMAND)
+    handlers = [
+        MessageHandler(base & F.Regex(start_re), _noop),
+        MessageHandler(base & F.Regex(back_re), _noop),
+        MessageHandler(base & (~F.Regex(start_re)) & (~F.Regex(back_re)), _noop),
+    ]
+
+    def route(update: Update) -> Optional[str]:
+        action = None
+        for i, handler in enumerate(handlers):   # 每个 group 都要检查一遍
+            if not handler.check_update(update):
+                continue
+            txt = bot.normalize_txt(update.effective_message.text)
+            if i == 0:
+                for kind, ws in bot.TRIGGERS.items():
+                    if txt in {w.lower() for w in ws}:
+                        action = kind
+                        break
+            elif i == 1 and back_re.match(txt):
+                action = bot.ACTION_BACK
+        return action
+
+    return route
+
+def new_text_handler():
+    handler = MessageHandler(bot.GROUP_TEXT, _noop)
+
+    def route(update: Update) -> Optional[str]:
+        if handler.check_update(update):
+            return bot.TEXT_ACTIONS.get(bot.normalize_txt(update.effective_message.text))
+        return None
+
+    return route
+
+async def bench_filters(args):
+    app = ApplicationBuilder().token("1:bench").build()
+    updates = [Update.de_json(data, app.bot) for data in synth_updates(args.count, 20, 500)]
+    for name, route in (("旧：3 个正则 handler", legacy_text_handlers()), ("新：单 handler 查表", new_text_handler())):
+        t0 = perf_counter()
+        hits = Counter(route(u) for u in updates)
+        dt = perf_counter() - t0
+        print(f"{name:18s} {len(updates) / dt:10.0f} msg/s | 分发 {dict(hits)}")
+
+# ========= load：N 个群 × M 个人的 开始/回来 压测 + 换班耗时 =========
+async def bench_reset(sizes: List[int], active: int = 100) -> List[tuple]:
+    """换班只碰进行中的人：进行中人数固定，总用户数从小到大"""
+    out = []
+    for n in sizes:
+        users = {uid: fake_user_data(uid, chats=20) for uid in range(1, n + 1)}
+        for uid in range(active * 10 + 1, n + 1):
+            users[uid].active = None
+        app = ApplicationBuilder().token("1:bench").request(FakeBotAPI()).persistence(MemoryPersistence(users)).build()
+        await app.initialize()
+        await bot.post_init(app)
+        active = sum(map(len, bot.ACTIVE_BY_CHAT.values()))
+        context = SimpleNamespace(application=app, bot=app.bot)
+        t0 = perf_counter()
+        await bot.reset_shift(context)
+        reset_ms = (perf_counter() - t0) * 1000
+        t0 = perf_counter()
+        await bot.prune_idle_users(context)
+        out.append((n, active, reset_ms, (perf_counter() - t0) * 1000))
+        await bot.post_stop(app)
+        await app.shutdown()
+    return out
+
+async def bench_load(args):
+    relax_rules()
+    bot.SEND_RATE_GLOBAL = args.send_rate
+    bot.SEND_PER_CHAT_MIN = args.send_rate * 60
+    api = FakeBotAPI(latency=args.api_latency, rate_429=args.rate_429)
+    app = bot.build_app(token="1:bench", request=api)
+    drop_startup_reset(app)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    startup_calls = sum(api.calls.values())
+
+    chats = [-1000 - g for g in range(args.groups)]
+    users = {chat: [10 + g * args.users + u for u in range(args.users)] for g, chat in enumerate(chats)}
+    ids = itertools.count(1)
+    latencies: List[float] = []
+
+    async def feed(text: str):
+        for chat in chats:
+            for uid in users[chat]:
+                update = Update.de_json(make_message(next(ids), chat, uid, text), app.bot)
+                t0 = perf_counter()
+                await app.process_update(update)
+                latencies.append(perf_counter() - t0)
+
+    t0 = perf_counter()
+    for cycle in range(args.cycles):
+        await feed(("wc", "抽烟", "吃饭")[cycle % 3])
+        await feed("回来")
+    handled = perf_counter() - t0
+    await drain_outbox()
+    await asyncio.sleep(0.1)   # 后台删除任务
+    total = perf_counter() - t0
+
+    checkins = sum(sum(c.count) for ud in app.user_data.values() for c in ud.stats.values())
+    api_calls = sum(api.calls.values()) - startup_calls
+    per_user = deep_sizeof(dict(app.user_data)) / max(1, len(app.user_data))
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+
+    lat = [x * 1000 for x in latencies]
+    print(f"groups={args.groups} users/group={args.users} cycles={args.cycles} "
+          f"api_latency={args.api_latency * 1000:.0f}ms 429率={args.rate_429:.1%}")
+    print(f"updates {len(lat)}，处理 {handled:.2f}s（{len(lat) / handled:.0f} updates/s），含发送完毕 {total:.2f}s")
+    print(f"handler 延迟 p50 {percentile(lat, 0.5):.3f} ms | p99 {percentile(lat, 0.99):.3f} ms | 最大 {max(lat):.1f} ms")
+    print(f"计入统计 {checkins} 次 | Bot API 调用 {api_calls} 次 = {api_calls / max(1, checkins):.2f} 次/打卡 "
+          f"| 429 {sum(api.errors.values())} 次 | 明细 {dict(api.calls)}")
+    print(f"user_data 每人约 {per_user:.0f} 字节")
+    for n, active, ms, prune_ms in await bench_reset(args.reset_sizes, args.reset_active):
+        print(f"reset_shift：{n:>7} 用户（进行中 {active}）耗时 {ms:8.2f} ms | 每日清理闲置用户 {prune_ms:8.1f} ms")
+
+# ========= stress：并发处理下不能重复计数 =========
+async def bench_stress(args):
+    """
+    每人每轮同时发 “wc / 回来 / 回来”（再夹一条乱输触发管理员查询），全部一次性塞进 update_queue，
+    由 concurrent_updates 并发处理。检查：
+    - 没有人的次数超过轮数（双击“回来”不会重复计数）
+    - UserState.stats 的总次数 == 机器人发出的“本次结束”条数
+    """
+    relax_rules()
+    bot.SEND_RATE_GLOBAL = 100000
+    bot.SEND_PER_CHAT_MIN = 100000 * 60
+    api = FakeBotAPI(latency=args.api_latency)
+    app = bot.build_app(token="1:bench", request=api, concurrent_updates=args.concurrency)
+    drop_startup_reset(app)
+    probe = LatencyProbe()
+    app.add_handler(TypeHandler(Update, probe.done), group=1000)
+
+    ended = Counter()
+    original_submit = bot.Outbox.submit
+
+    def counting_submit(self, chat_id, text, *a, **kw):
+        if "本次结束" in text:
+            ended[chat_id] += 1
+        return original_submit(self, chat_id, text, *a, **kw)
+
+    bot.Outbox.submit = counting_submit
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    ids = itertools.count(1)
+    rnd = random.Random(7)
+    batch = []
+    for cycle in range(args.cycles):
+        for g in range(args.groups):
+            chat = -1000 - g
+            for u in range(args.users):
+                uid = 10 + g * args.users + u
+                burst = ["wc", "回来", "回来", "随便说点什么"]
+                if rnd.random() < 0.3:
+                    burst[1], burst[2] = "wc", "回来"   # 开始和回来几乎同时到
+                batch.extend(make_message(next(ids), chat, uid, text) for text in burst)
+
+    t0 = perf_counter()
+    for data in batch:
+        probe.mark_sent(data["update_id"])
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    await probe.wait(len(batch), timeout=300)
+    elapsed = perf_counter() - t0
+    await drain_outbox()
+
+    counts = Counter()
+    over = 0
+    for uid, ud in app.user_data.items():
+        for chat_id, c in ud.stats.items():
+            n = sum(c.count)
+            counts[chat_id] += n
+            over += n > args.cycles
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    bot.Outbox.submit = original_submit
+
+    lat = [x * 1000 for x in probe.latency]
+    print(f"concurrency={args.concurrency} updates={len(batch)} 用时 {elapsed:.2f}s"
+          f"（{len(batch) / elapsed:.0f} updates/s）p50 {percentile(lat, 0.5):.1f} ms p99 {percentile(lat, 0.99):.1f} ms")
+    print(f"统计次数 {sum(counts.values())} | “本次结束”消息 {sum(ended.values())} | 超过轮数的用户 {over}")
+    ok = counts == ended and over == 0
+    print("OK：没有重复计数" if ok else "FAIL：统计与结束消息不一致")
+    return 0 if ok else 1
+
+# ========= events：历史记录写入 / 重建 / 区间汇总 =========
+def _timed(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = perf_counter()
+        fn()
+        best = min(best, perf_counter() - t0)
+    return best * 1000
+
+async def bench_events(args):
+    rnd = random.Random(11)
+    kinds = bot.EVENT_KINDS
+    end = datetime.now(bot.LOCAL_TZ).replace(hour=6, minute=0, second=0, microsecond=0)
+    days = args.months * 30
+    with tempfile.TemporaryDirectory() as tmp:
+        log = bot.EventLog(tmp)
+        n = 0
+        t0 = perf_counter()
+        for day in range(days, 0, -1):
+            base = (end - timedelta(days=day)).timestamp()
+            for g in range(args.groups):
+                for u in range(args.users):
+                    uid = 10 + g * args.users + u
+                    for _ in range(args.sessions):
+                        start = base + rnd.random() * 86400
+                        dur = rnd.randint(60, 900)
+                        log.append(uid, -1000 - g, rnd.choice(kinds), start, dur,
+                                   bot.EV_OVERTIME if dur > 600 else 0)
+                        n += 1
+        log.close()
+        append = perf_counter() - t0
+        seg_bytes = sum(file_size(os.path.join(tmp, f)) for f in os.listdir(tmp) if f.endswith(".seg"))
+        months = sorted(f[:7] for f in os.listdir(tmp) if f.endswith(".seg"))
+
+        def cold():
+            for f in os.listdir(tmp):
+                if f.endswith(".roll.json"):
+                    os.remove(os.path.join(tmp, f))
+            fresh = bot.EventLog(tmp)
+            for m in months:
+                fresh.rollup(m)
+
+        def warm():
+            fresh = bot.EventLog(tmp)
+            for m in months:
+                fresh.rollup(m)
+
+        cold_ms = _timed(cold, 1)
+        warm_ms = _timed(warm, 3)   # 旧月份读 .roll.json，当月仍然 mmap 扫描
+
+        log = bot.EventLog(tmp)
+        for m in months:
+            log.rollup(m)
+        chat = -1000
+        last = (end - timedelta(days=1)).date()
+        ranges = {
+            "1 天": (last, last),
+            "7 天": (last - timedelta(days=6), last),
+            "90 天": (last - timedelta(days=89), last),
+        }
+
+        def naive(lo: str, hi: str):
+            out: Dict[int, int] = Counter()
+            for m in months:
+                for uid, chat_id, kind, start, dur, flags in log.scan(m):
+                    if chat_id == chat and lo <= bot.shift_of(start)[0] <= hi:
+                        out[uid] += 1
+            return out
+
+        print(f"months={args.months} groups={args.groups} users/群={args.users} sessions/人/天={args.sessions}")
+        print(f"写入 {n} 条：{append * 1e6 / n:.2f} µs/条，分段 {len(months)} 个共 {seg_bytes / 2**20:.1f} MiB")
+        print(f"冷启动重建全部汇总（mmap 扫描）{cold_ms:.0f} ms | 有旧月汇总文件时 {warm_ms:.0f} ms")
+        for name, (lo, hi) in ranges.items():
+            lo, hi = lo.isoformat(), hi.isoformat()
+            fast = _timed(lambda: log.summarize(chat, "day", lo, hi))
+            slow = _timed(lambda: naive(lo, hi), 1)
+            assert sum(c[0] for kinds_ in log.summarize(chat, "day", lo, hi).values() for c in kinds_.values()) \
+                == sum(naive(lo, hi).values())
+            print(f"/summary {name:5s} 汇总 {fast:8.2f} ms | 扫原始记录 {slow:8.0f} ms")
+        shift = bot.parse_summary_range([last.isoformat(), "夜班"])
+        print(f"/summary 单班 {_timed(lambda: log.summarize(chat, *shift)):.2f} ms")
+        log.close()
+
+# ========= summary：全量扫描 vs 按群增量汇总 + 文本缓存 =========
+def legacy_summary(user_data: dict, chat_id: int) -> str:
+    """改造前的 /summary：每次扫全部用户再拼文本"""
+    lines = [f"📊 本{bot.current_shift_label()}汇总（按用户）："]
+    for uid, ud in list(user_data.items()):
+        stats = (ud.get("stats_by_chat") or {}).get(str(chat_id)) or {}
+        per = []
+        for k in ("smoke", "toilet", "meal"):
+            c = stats.get(k, {}).get("count", 0)
+            d = stats.get(k, {}).get("dur", 0)
+            if c or d:
+                per.append(f"{bot.TITLES[k]} <b>{c}</b> 次 / {bot.fmt_dur_mmss(d)}")
+        if per:
+            lines.append(f"• {bot.mention_id_html(uid, '这位同事')} — " + "；".join(per))
+    return "\n".join(lines)
+
+async def bench_summary(args):
+    legacy_users = {}
+    for uid in range(1, args.users + 1):
+        ud = legacy_users[uid] = legacy_user_data(uid, chats=1)
+        ud["stats_by_chat"] = {str(-1000 - uid % args.chats): ud["stats_by_chat"]["-1000"]}   # 每人只在一个群
+    users = {uid: bot.UserState.from_record(ud) for uid, ud in legacy_users.items()}
+    app = SimpleNamespace(user_data=users)
+    chat_id = -1000
+    chat_data: dict = {}
+    bot.live_summary_pages(app, chat_data, chat_id)   # 第一次从 user_data 补建
+    members = len(chat_data["shift_agg"]["users"])
+
+    def uncached():
+        bot.add_to_chat_agg(chat_data["shift_agg"], 1, "smoke", 60)   # 有人刚结束，缓存失效
+        return bot.live_summary_pages(app, chat_data, chat_id)
+
+    legacy = _timed(lambda: legacy_summary(legacy_users, chat_id), 3)
+    fresh = _timed(uncached)
+    cached = _timed(lambda: bot.live_summary_pages(app, chat_data, chat_id), 50)
+    pages = bot.live_summary_pages(app, chat_data, chat_id)
+    text = legacy_summary(legacy_users, chat_id)
+    print(f"users={args.users} chats={args.chats}（本群 {members} 人）")
+    print(f"旧 /summary 全量扫描 {legacy:8.2f} ms，单条 {len(text)} 字符（超过 4096 会发送失败）")
+    print(f"新 /summary 统计变化后重排 {fresh:8.2f} ms | 未变化直接用缓存 {cached * 1000:8.1f} µs")
+    print(f"分 {len(pages)} 页，最长 {max(map(len, pages))} 字符")
+
+# ========= shards：1 / 2 / 4 个 worker 进程的吞吐 =========
+def _shard_worker(shard: int, shards: int, conn, results, workdir: str, api_latency: float):
+    """worker 进程：真实的 build_app + 假 Bot API + 本片的 SQLite，处理完把计数和 CPU 时间报回去"""
+    os.chdir(workdir)
+    bot.SHARD_ID, bot.SHARDS = shard, shards
+    relax_rules()
+    bot.SEND_RATE_GLOBAL = 10 ** 6
+    bot.SEND_PER_CHAT_MIN = 10 ** 8
+    app = bot.build_app(token="1:bench", request=FakeBotAPI(latency=api_latency),
+                        persistence=bot.SQLitePersistence(bot.shard_path(bot.DB_FILE)))
+    drop_startup_reset(app)
+    seen = {"count": 0, "last": 0.0, "cpu0": 0.0}
+
+    async def done(_update, _ctx):
+        seen["count"] += 1
+        seen["last"] = time()
+
+    app.add_handler(TypeHandler(Update, done), group=1000)
+    post_init = app.post_init
+
+    async def ready(a):
+        await post_init(a)
+        seen["cpu0"] = process_time()
+        results.put(("ready", shard))
+
+    app.post_init = ready
+    asyncio.run(bot.serve_worker(app, conn))
+    checkins = sum(sum(c.count) for ud in app.user_data.values() for c in ud.stats.values())
+    results.put(("done", shard, seen["count"], seen["last"], checkins, process_time() - seen["cpu0"]))
+
+async def bench_shards(args):
+    ids = itertools.count(1)
+    updates = []
+    for cycle in range(args.cycles):
+        for g in range(args.groups):
+            for u in range(args.users):
+                uid = 10 + g * args.users + u
+                updates.append(make_message(next(ids), -1000 - g, uid, ("wc", "抽烟", "吃饭")[cycle % 3]))
+        for g in range(args.groups):
+            for u in range(args.users):
+                updates.append(make_message(next(ids), -1000 - g, 10 + g * args.users + u, "回来"))
+
+    print(f"updates={len(updates)}（{args.groups} 群 × {args.users} 人 × {args.cycles} 轮），CPU 核数 {os.cpu_count()}")
+    base = None
+    for n in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = multiprocessing.get_context("spawn").Queue()
+            conns, procs = bot.spawn_workers(n, _shard_worker, results, tmp, args.api_latency)
+            for _ in range(n):
+                await asyncio.to_thread(results.get)          # 等 worker 启动完（不计入吞吐）
+            router = bot.ShardRouter(conns, procs)
+            router.start()
+            t0, cpu0 = time(), process_time()
+            for i, data in enumerate(updates):
+                router.route(data)
+                if i % 500 == 0:
+                    await asyncio.sleep(0)
+            await router.stop(timeout=600)
+            ingress_cpu = process_time() - cpu0
+            done = [await asyncio.to_thread(results.get) for _ in range(n)]
+            for proc in procs:
+                await asyncio.to_thread(proc.join)
+        handled = sum(d[2] for d in done)
+        elapsed = max(d[3] for d in done) - t0
+        rate = handled / elapsed
+        # 核数不够时墙钟时间看不出扩展性：按最忙的进程（入口或某个 worker）的 CPU 时间推算每核一个进程时的上限
+        busiest = max(ingress_cpu, max(d[5] for d in done))
+        projected = handled / busiest
+        base = base or projected
+        print(f"workers={n}: 实测 {rate:6.0f} updates/s（{elapsed:.2f}s）| 计入统计 {sum(d[4] for d in done)}"
+              f" | 入口 CPU {ingress_cpu * 1e6 / len(updates):.1f} µs/条 | 最忙 worker CPU {max(d[5] for d in done):.2f}s"
+              f" | 按 CPU 推算 {projected:6.0f} updates/s（×{projected / base:.2f}）| 按片 {[d[2] for d in sorted(done)]}")
+
+# ========= metrics：跑一轮负载后抓 /metrics，看时间花在哪 =========
+def parse_histograms(text: str) -> Dict[Tuple[str, str], List[float]]:
+    """只取 _sum / _count：{(指标, 标签值): [sum, count]}"""
+    out: Dict[Tuple[str, str], List[float]] = {}
+    for line in text.splitlines():
+        m = re.match(r'(\w+)_(sum|count)\{\w+="([^"]*)"\} (\S+)', line)
+        if m:
+            out.setdefault((m.group(1), m.group(3)), [0.0, 0.0])[m.group(2) == "count"] = float(m.group(4))
+    return out
+
+async def bench_metrics(args):
+    relax_rules()
+    bot.SEND_RATE_GLOBAL = 10 ** 6
+    bot.SEND_PER_CHAT_MIN = 10 ** 8
+    bot.METRICS_PORT = args.port
+    api = FakeBotAPI(latency=args.api_latency, rate_429=args.rate_429)
+    app = bot.build_app(token="1:bench", request=api)
+    drop_startup_reset(app)
+    probe = LatencyProbe()
+    app.add_handler(TypeHandler(Update, probe.done), group=1000)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    ids = itertools.count(1)
+    batch = []
+    for g in range(args.groups):
+        for u in range(args.users):
+            uid = 10 + g * args.users + u
+            for text in ("wc", "回来", "随便说点什么"):
+                batch.append(make_message(next(ids), -1000 - g, uid, text))
+    batch.append(make_message(next(ids), -1000, 10, "/summary"))
+    for data in batch:
+        probe.mark_sent(data["update_id"])
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    await probe.wait(len(batch), timeout=300)
+    await drain_outbox()
+
+    async with httpx.AsyncClient() as client:
+        t0 = perf_counter()
+        resp = await client.get(f"http://127.0.0.1:{args.port}/metrics")
+        scrape = (perf_counter() - t0) * 1000
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+
+    # timed() 本身的开销：包一个空协程
+    async def noop():
+        return None
+    wrapped = bot.timed(noop)
+    t0 = perf_counter()
+    for _ in range(100000):
+        await wrapped()
+    overhead = (perf_counter() - t0) / 100000
+    t0 = perf_counter()
+    for _ in range(100000):
+        await noop()
+    overhead -= (perf_counter() - t0) / 100000
+
+    hist = parse_histograms(resp.text)
+    print(f"updates={len(batch)} api_latency={args.api_latency * 1000:.0f}ms 429率={args.rate_429:.1%}"
+          f" | /metrics {len(resp.text) / 1024:.0f} KiB，抓取 {scrape:.1f} ms | timed() 开销 {overhead * 1e6:.2f} µs/次")
+    for metric in ("bot_handler_seconds", "bot_api_seconds"):
+        rows = sorted(((k[1], s, c) for k, (s, c) in hist.items() if k[0] == metric and c), key=lambda r: -r[1])
+        print(f"{metric}（按总耗时排序）：")
+        for name, total, count in rows:
+            print(f"  {name:20s} {int(count):6d} 次  平均 {total / count * 1000:8.3f} ms  合计 {total * 1000:9.1f} ms")
+    errors = [line for line in resp.text.splitlines() if line.startswith(("bot_api_errors_total{", "bot_outbox_total{"))]
+    print("\n".join(errors))
+
+# ========= help：乱输提示的群 / 个人防抖 =========
+async def _help_run(args, chat_window: float, user_window: float) -> Tuple[int, int, Counter]:
+    """模拟时钟跑 duration 分钟：每个群每 interval 秒一条乱输；返回 (sendMessage 次数, 待删条数, 结果计数)"""
+    bot.HELP_BY_CHAT = bot.Debounce(chat_window)
+    bot.HELP_BY_USER = bot.Debounce(user_window)
+    bot.HELP_REPLIES.values.clear()
+    bot.SEND_RATE_GLOBAL = 10 ** 6
+    bot.SEND_PER_CHAT_MIN = 10 ** 8
+    start = bot.CLOCK.time()
+    clock = bot.CLOCK = SimClock(start)                      # 防抖窗口按模拟时间走；BOOT 计时仍用真的 monotonic
+    api = FakeBotAPI()
+    app = bot.build_app(token="1:bench", request=api)
+    drop_startup_reset(app)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    before = api.calls["sendMessage"]
+    rnd = random.Random(5)
+    ids = itertools.count(1)
+    steps = int(args.duration * 60 / args.interval)
+    try:
+        for step in range(steps):
+            clock.t = start + step * args.interval
+            for g in range(args.groups):
+                uid = 10 + g * args.users + rnd.randrange(args.users)
+                data = make_message(next(ids), -1000 - g, uid, rnd.choice(("好的", "收到", "哈哈", "ok", "？")))
+                await app.process_update(Update.de_json(data, app.bot))
+        await drain_outbox()
+    finally:
+        bot.CLOCK = bot.Clock()
+    sent = api.calls["sendMessage"] - before
+    queued = len(bot.pending_deletes(app))
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    return sent, queued, Counter({k[0]: v for k, v in bot.HELP_REPLIES.values.items()})
+
+async def bench_help(args):
+    strays = args.groups * int(args.duration * 60 / args.interval)
+    print(f"{args.groups} 个群 × {args.users} 人，每群每 {args.interval:g}s 一条乱输，模拟 {args.duration:g} 分钟 = {strays} 条")
+    base = None
+    for name, cw, uw in (("不防抖（改造前）", 0, 0), (f"群 {args.chat_window:g}s / 人 {args.user_window:g}s",
+                                                 args.chat_window, args.user_window)):
+        sent, queued, results = await _help_run(args, cw, uw)
+        base = base or sent
+        per_min = sent / args.groups / args.duration
+        print(f"{name:18s} sendMessage {sent:6d} 次（每群 {per_min:5.1f} 条/分钟，×{sent / base:.3f}）"
+              f"| 待删 {queued:6d} 条 | {dict(results)}")
+
+# ========= schema：旧 dict 布局 vs __slots__ 记录 =========
+async def bench_schema(args):
+    n = args.users
+    legacy = {uid: legacy_user_data(uid, args.chats) for uid in range(1, n + 1)}
+    dump = functools.partial(pickle.dumps, protocol=pickle.HIGHEST_PROTOCOL)
+
+    t0 = perf_counter()
+    users = {uid: bot.UserState.from_record(ud) for uid, ud in legacy.items()}
+    migrate = perf_counter() - t0
+    assert all(bot.UserState.from_record(ud.to_record()).to_record() == ud.to_record() for ud in users.values())
+
+    old_rows = {uid: dump(ud) for uid, ud in legacy.items()}
+    new_rows = {uid: dump(ud.to_record()) for uid, ud in users.items()}
+    # 重启时从库里读回来实际占多少内存
+    old_load = lambda: {uid: pickle.loads(b) for uid, b in old_rows.items()}
+    new_load = lambda: {uid: bot.UserState.from_record(pickle.loads(b)) for uid, b in new_rows.items()}
+    old_mem, new_mem = _measure(old_load)[1], _measure(new_load)[1]
+    old_cpu, new_cpu = _timed(old_load, 3), _timed(new_load, 3)
+    old_enc = _timed(lambda: [dump(ud) for ud in legacy.values()], 3)
+    new_enc = _timed(lambda: [dump(ud.to_record()) for ud in users.values()], 3)
+    old_copy = _timed(lambda: copy.deepcopy(legacy), 3)
+    new_copy = _timed(lambda: copy.deepcopy(users), 3)
+
+    print(f"users={n} chats/用户={args.chats}（每 10 人有 1 个进行中）")
+    print(f"{'':14s}{'每人内存':>10s}{'每行快照':>10s}{'全量快照':>12s}{'序列化':>10s}{'读回':>10s}{'deepcopy':>10s}")
+    for name, mem, rows, enc, cpu, cp in (("旧 dict", old_mem, old_rows, old_enc, old_cpu, old_copy),
+                                          ("UserState", new_mem, new_rows, new_enc, new_cpu, new_copy)):
+        size = sum(map(len, rows.values()))
+        print(f"{name:14s}{mem / n:9.0f}B{size / n:9.0f}B{size / 1024:10.0f}KiB"
+              f"{enc:8.1f}ms{cpu:8.1f}ms{cp:8.1f}ms")
+    print(f"旧 dict → UserState 迁移 {n / migrate:.0f} 用户/s")
+
+# ========= backup：每次启动整库拷贝 vs 快照 + 增量 + 保留策略 =========
+async def bench_backup(args):
+    rnd = random.Random(3)
+    users = {uid: fake_user_data(uid) for uid in range(1, args.users + 1)}
+    step = bot.BACKUP_DELTA_MINUTES * 60
+    steps = int(args.days * 86400 // step)
+    restart_every = max(1, int(86400 / max(args.restarts_per_day, 1e-9) // step))
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "botdata.db")
+        sql = bot.SQLitePersistence(filepath=db_path)
+        await sql.get_user_data()
+        await asyncio.gather(*(sql.update_user_data(uid, ud) for uid, ud in users.items()))
+        old_dir = os.path.join(tmp, "old")
+        os.makedirs(old_dir)
+        store = bot.BackupStore(db_path, os.path.join(tmp, "backup"), source=sql)
+        now = datetime(2026, 10, 1, tzinfo=bot.LOCAL_TZ).timestamp()
+        copies, ticks, lags = [], {"snap": [], "delta": [], "": []}, []
+        for i in range(steps):
+            dirty = rnd.sample(range(1, args.users + 1), args.dirty)
+            for uid in dirty:
+                users[uid].last_seen += 1
+            await asyncio.gather(*(sql.update_user_data(uid, users[uid]) for uid in dirty))
+            if i % restart_every == 0:
+                # 旧做法：每次启动 shutil.copy2 整个库，永不清理
+                t0 = perf_counter()
+                await sql.flush()
+                shutil.copy2(db_path, os.path.join(old_dir, f"botdata-{i}.db"))
+                copies.append(perf_counter() - t0)
+                store = bot.BackupStore(db_path, store.dir, source=sql)   # 新做法重启后接着原来的链
+            with LoopLag() as lag:
+                t0 = perf_counter()
+                kind = await asyncio.to_thread(store.tick, now)
+                ticks[kind].append(perf_counter() - t0)
+            lags.append(lag.max_lag)
+            now += step
+        await sql.flush()
+
+        old_size = sum(os.path.getsize(os.path.join(old_dir, f)) for f in os.listdir(old_dir))
+        new_files = os.listdir(store.dir)
+        new_size = sum(os.path.getsize(os.path.join(store.dir, f)) for f in new_files)
+        restored = os.path.join(tmp, "restored.db")
+        t0 = perf_counter()
+        desc = store.restore(db_path=restored)
+        restore_ms = (perf_counter() - t0) * 1000
+        live, back = bot.open_db(db_path), bot.open_db(restored)
+        live.isolation_level = back.isolation_level = None
+        same = bot._read_rows(live) == bot._read_rows(back)
+        live.close()
+        back.close()
+
+    print(f"users={args.users} 每 {bot.BACKUP_DELTA_MINUTES} 分钟变 {args.dirty} 人，"
+          f"模拟 {args.days:g} 天，每天重启 {args.restarts_per_day:g} 次")
+    print(f"旧：每次启动 copy2 {len(copies)} 份，共 {old_size / 1024 / 1024:8.1f} MiB（不清理），"
+          f"每份 {percentile([c * 1000 for c in copies], 0.5):.1f} ms")
+    print(f"新：保留 {len(new_files)} 个文件，共 {new_size / 1024 / 1024:8.1f} MiB")
+    for kind, name in (("snap", "整库快照"), ("delta", "增量"), ("", "无变化")):
+        if ticks[kind]:
+            ms = [t * 1000 for t in ticks[kind]]
+            print(f"  {name:6s} {len(ms):5d} 次 | p50 {percentile(ms, 0.5):7.1f} ms | 最大 {max(ms):7.1f} ms")
+    print(f"备份期间事件循环最大卡顿 {max(lags) * 1000:.1f} ms")
+    print(f"恢复 {restore_ms:.0f} ms：{desc} | 与线上库逐行一致：{same}")
+
+# ========= export：/export 后台写 CSV / XLSX vs 在事件循环里拼 /summary =========
+async def bench_export(args):
+    rnd = random.Random(5)
+    chat = -1000
+    first = datetime(2026, 9, 1, 8, 0, tzinfo=bot.LOCAL_TZ).timestamp()
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.EVENTS = bot.EventLog(os.path.join(tmp, "events"))
+        for day in range(args.days):
+            for half in (0, 12 * 3600):                      # 白班 / 夜班
+                for u in range(args.users):
+                    for kind in bot.KINDS:
+                        start = first + day * 86400 + half + rnd.random() * 11 * 3600
+                        bot.EVENTS.append(10 + u, chat, kind, start, rnd.randint(60, 900))
+        bot.EVENTS.flush()
+        live_log = bot.EVENTS
+        lo = bot.shift_epoch(first)
+        hi = bot.shift_epoch(first + (args.days - 1) * 86400 + 12 * 3600)
+        users = SimpleNamespace(user_data={10 + u: fake_user_data(10 + u) for u in range(args.users)})
+
+        print(f"users={args.users} days={args.days} 范围 {bot.label_range('shift', lo, hi)}")
+        # 已封存：重启后的进程没在写这个月，导出线程直接读汇总；还在写：同一进程刚写过，要在事件循环上分块拷
+        for mode, log in (("已封存", bot.EventLog(os.path.join(tmp, "events"))), ("还在写", live_log)):
+            bot.EVENTS = log
+            await asyncio.to_thread(log.preload, lo[:7], hi[:7])   # 汇总是常驻缓存，不算进导出
+            for days in (max(1, args.days // 10), args.days):
+                hi_part = bot.shift_epoch(first + (days - 1) * 86400 + 12 * 3600)
+                for fmt in ("csv", "xlsx"):
+                    tracemalloc.start()
+                    with LoopLag() as lag:
+                        t0 = perf_counter()
+                        path, rows = await bot.build_export(users, chat, lo, hi_part, fmt)
+                        dt = perf_counter() - t0
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    print(f"{mode} {fmt:4s} {rows:7d} 行 {dt * 1000:8.0f} ms | 文件 {size / 1024:7.0f} KiB"
+                          f" | 峰值内存 {peak / 1024:6.0f} KiB | 循环卡顿 {lag.max_lag * 1000:5.1f} ms")
+        bot.EVENTS = live_log
+
+        # 事件循环：旧做法在 handler 里直接拼整段汇总；新做法 /export 交给线程，循环只发一条消息
+        with LoopLag() as lag:
+            await asyncio.sleep(0.01)
+            t0 = perf_counter()
+            bot.history_summary(chat, [lo[:10], hi[:10]])
+            inline = perf_counter() - t0
+            await asyncio.sleep(0.01)
+        print(f"/summary 整段在事件循环里拼：{inline * 1000:.0f} ms，循环卡顿 {lag.max_lag * 1000:.0f} ms")
+
+        api = FakeBotAPI()
+        app = bot.build_app(token="1:bench", request=api)
+        await app.initialize()
+        bot.OUTBOX = bot.Outbox(app.bot)                     # 文件也走发送队列
+        bot.OUTBOX.start()
+        bot.EVENTS._rollups.clear()                          # 冷启动：线程里还要扫原始记录重建汇总
+        with LoopLag() as lag:
+            t0 = perf_counter()
+            await bot.export_and_send(app, chat, lo, hi, "xlsx")
+            total = perf_counter() - t0
+        print(f"/export xlsx 后台生成并上传（含冷月份重建）：{total * 1000:.0f} ms，循环最大卡顿 {lag.max_lag * 1000:.1f} ms"
+              f" | {dict(api.calls)}")
+        await bot.OUTBOX.stop()
+        await app.shutdown()
+        bot.EVENTS.close()
+
+# ========= reshard：分片数变了之后，同一个人在各群的本班统计都还在 =========
+def _shard_copy(uid: int, chat_id: int, shard: int, epoch: str, now: float) -> "bot.UserState":
+    ud = bot.UserState()
+    ud.epoch, ud.last_chat_id, ud.last_seen = epoch, chat_id, now - 60 + shard   # 1 号片那份更近
+    c = ud.counters(chat_id)
+    c.add("smoke", 60 * (uid % 7 + 1), uid % 5 + 1 + shard)
+    ud.last_end[shard] = now - 100 * (shard + 1)
+    if shard == 0 and uid % 3 == 0:
+        ud.active = bot.ActiveSession("toilet", now - 30, 15)                       # 较旧的那份里有进行中的
+    return ud
+
+def _read_users(path: str) -> Dict[int, "bot.UserState"]:
+    conn = bot.open_db(path)
+    out = {uid: bot.UserState.from_record(pickle.loads(blob)) for uid, blob in conn.execute("SELECT id, data FROM user_data")}
+    conn.close()
+    return out
+
+async def bench_reshard(args):
+    """2 片 → 1 片 → 2 片：每个人在两片的群里都打过卡，逐人核对合并 / 拆开后两个群的次数、冷却、进行中"""
+    chats = (-1000, -1001)                                   # 2 片时分别归 0 / 1 号片
+    assert [bot.chat_shard(c, 2) for c in chats] == [0, 1]
+    now, epoch = bot.CLOCK.time(), bot.shift_epoch()
+    uids = range(1, args.users + 1)
+    expect = {uid: [_shard_copy(uid, chats[i], i, epoch, now) for i in (0, 1)] for uid in uids}
+    bad: Counter = Counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "botdata.db")
+        for i in (0, 1):
+            seed = bot.SQLitePersistence(filepath=bot.shard_path(db, i, 2))
+            seed._write_batch({("user_data", uid): copies[i] for uid, copies in expect.items()})
+            await seed.flush()
+        t0 = perf_counter()
+        bot.reshard_db(1, db)
+        merge_ms = (perf_counter() - t0) * 1000
+        merged = _read_users(db)
+        for uid, copies in expect.items():
+            ud = merged.get(uid)
+            if ud is None:
+                bad["2→1 丢了人"] += 1
+                continue
+            for i in (0, 1):
+                got = ud.stats.get(chats[i])
+                if got is None or got.to_record() != copies[i].stats[chats[i]].to_record():
+                    bad[f"2→1 群 {chats[i]} 统计不对"] += 1
+            if list(ud.last_end) != [max(a, b) for a, b in zip(copies[0].last_end, copies[1].last_end)]:
+                bad["2→1 冷却不对"] += 1
+            if (ud.active is not None, ud.last_chat_id) != ((True, chats[0]) if copies[0].active else (False, chats[1])):
+                bad["2→1 进行中不对"] += 1
+
+        t0 = perf_counter()
+        bot.reshard_db(2, db)
+        split_ms = (perf_counter() - t0) * 1000
+        parts = [_read_users(bot.shard_path(db, i, 2)) for i in (0, 1)]
+        for uid, copies in expect.items():
+            for i in (0, 1):
+                ud = parts[i].get(uid)
+                got = ud and ud.stats.get(chats[i])
+                if got is None or got.to_record() != copies[i].stats[chats[i]].to_record():
+                    bad[f"1→2 {i} 号片群 {chats[i]} 统计不对"] += 1
+            owner = 0 if copies[0].active else 1
+            if [bool(parts[i].get(uid) and parts[i][uid].active) for i in (0, 1)] != [bool(copies[0].active) and i == owner for i in (0, 1)]:
+                bad["1→2 进行中不只在所在群那一片"] += 1
+
+    print(f"users={args.users}，每人在 2 片的群里各有本班统计，{sum(1 for c in expect.values() if c[0].active)} 人有进行中")
+    print(f"2 → 1 合并 {merge_ms:.0f} ms | 1 → 2 拆开 {split_ms:.0f} ms")
+    if bad:
+        print("不一致：" + "；".join(f"{k} {n} 人" for k, n in bad.items()))
+        return 1
+    print("逐人核对：两个群的次数 / 秒数、冷却、进行中都对")
+    return 0
+
+# ========= startup：冷启动到处理第一条更新 =========
+async def _boot(db: str, latency: float, chat: int, uid: int) -> dict:
+    """按 main() 的顺序启动一次，往队列里放一条打卡，量到它被处理完"""
+    api = FakeBotAPI(latency=latency)
+    app = bot.build_app(token="1:bench", request=api, persistence=bot.SQLitePersistence(filepath=db))
+    drop_startup_reset(app)
+    first = asyncio.Event()
+
+    async def seen(_update, _ctx):
+        first.set()
+
+    app.add_handler(TypeHandler(Update, seen), group=1000)
+    bot.BOOT.update(started=bot.monotonic(), ready=0.0, first_update=0.0)
+    t0 = perf_counter()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    ready = perf_counter() - t0
+    calls = sum(api.calls.values())
+    with LoopLag() as lag:                                   # 后台解码期间事件循环的卡顿
+        await app.update_queue.put(Update.de_json(make_message(1, chat, uid, "wc"), app.bot))
+        await first.wait()
+        ttfu = perf_counter() - t0
+        if bot.HYDRATION is not None:
+            await bot.HYDRATION
+        await bot.events_ready()
+        hydrated = perf_counter() - t0
+    await asyncio.sleep(0.2)                                 # 后台同步菜单的请求也算进来
+    out = {"ready": ready, "ttfu": ttfu, "hydrated": hydrated, "calls": calls, "lag": lag.max_lag,
+           "menu": sum(api.calls[m] for m in ("setMyCommands", "deleteMyCommands")),
+           "active": sum(map(len, bot.ACTIVE_BY_CHAT.values())), "timers": len(bot.TIMERS)}
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    return out
+
+async def bench_startup(args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)                                        # events/ backup/ 都建在临时目录里
+        try:
+            db = os.path.join(tmp, "botdata.db")
+            seed = bot.SQLitePersistence(filepath=db)
+            seed._write_batch({("user_data", uid): fake_user_data(uid) for uid in range(1, args.users + 1)})
+            await seed.flush()
+            # 当月已有的打卡记录：启动后要扫一遍建当月汇总
+            now = bot.CLOCK.time()
+            os.makedirs(bot.EVENT_DIR, exist_ok=True)
+            with open(os.path.join(bot.EVENT_DIR, bot.shift_of(now)[0][:7] + ".seg"), "wb") as f:
+                f.write(b"".join(bot.EVENT_REC.pack(1 + i % args.users, -1000 - i % 50, now - 60 - i % 3600, 120, i % 3, 0)
+                                 for i in range(args.events)))
+            print(f"users={args.users}（每 10 人有 1 个进行中）Bot API 延迟 {args.api_latency * 1000:.0f} ms"
+                  f" | 库 {file_size(db) / 1024:.0f} KiB | 当月记录 {args.events} 条")
+            print(f"{'':10s}{'可服务':>10s}{'首条更新':>10s}{'后台加载':>10s}{'循环卡顿':>10s}"
+                  f"{'启动API':>9s}{'菜单':>6s}{'进行中':>8s}{'提醒':>8s}")
+            for name in ("首次启动", "再次启动"):
+                gc.collect()                                 # 真重启是新进程：上一轮的 app 先回收掉，不算进这一轮
+                r = await _boot(db, args.api_latency, -1000, 11)
+                verdict = "OK" if r["ttfu"] * 1000 <= args.target_ms else "超标"
+                print(f"{name:10s}{r['ready'] * 1000:8.0f}ms{r['ttfu'] * 1000:8.0f}ms{r['hydrated'] * 1000:8.0f}ms"
+                      f"{r['lag'] * 1000:8.1f}ms{r['calls']:9d}{r['menu']:6d}{r['active']:8d}{r['timers']:8d}  {verdict}（目标 {args.target_ms:g} ms）")
+        finally:
+            os.chdir(cwd)
+
+# ========= trace：追踪开 / 关的开销，以及一条慢更新长什么样 =========
+async def _trace_run(args, slow_ms: float, profile_rate: float, latency: float = 0.0,
+                     texts=("wc", "回来")) -> Tuple[float, List[float], Counter]:
+    bot.TRACE_SLOW_MS, bot.TRACE_PROFILE_RATE = slow_ms, profile_rate
+    bot.SLOW_TRACES.values.clear()
+    api = FakeBotAPI(latency=latency)
+    app = bot.build_app(token="1:bench", request=api)
+    drop_startup_reset(app)
+    bot.BOOT["started"] = bot.monotonic()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    ids = itertools.count(1)
+    latencies: List[float] = []
+    t0 = perf_counter()
+    for _ in range(args.cycles):
+        for text in texts:
+            for g in range(args.groups):
+                for u in range(args.users):
+                    update = Update.de_json(make_message(next(ids), -1000 - g, 10 + g * args.users + u, text), app.bot)
+                    t1 = perf_counter()
+                    await app.process_update(update)
+                    latencies.append((perf_counter() - t1) * 1000)
+    wall = perf_counter() - t0
+    await drain_outbox()
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    bot.TRACE_SLOW_MS = bot.TRACE_PROFILE_RATE = 0
+    return len(latencies) / wall, latencies, Counter(bot.SLOW_TRACES.values)
+
+async def bench_trace(args):
+    relax_rules()
+    bot.SEND_RATE_GLOBAL = 10 ** 6
+    bot.SEND_PER_CHAT_MIN = 10 ** 8
+    n = args.groups * args.users * args.cycles * 2
+    print(f"{args.groups} 个群 × {args.users} 人 × {args.cycles} 轮 开始/回来 = {n} 条更新")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            base = None
+            for name, slow, rate in (("关闭", 0, 0), ("开启（阈值很高，只建树）", 10 ** 9, 0),
+                                     (f"开启 + 抽样 profile {args.profile_rate:.0%}", 10 ** 9, args.profile_rate)):
+                best = None
+                for _ in range(3):
+                    tput, lat, _slow = await _trace_run(args, slow, rate)
+                    if best is None or tput > best[0]:
+                        best = (tput, lat)
+                base = base or best[0]
+                print(f"{name:26s} {best[0]:7.0f} updates/s（×{best[0] / base:.3f}）| p50 {percentile(best[1], 0.5):.3f} ms"
+                      f" | p99 {percentile(best[1], 0.99):.3f} ms")
+
+            # 一条慢更新：管理员 /who 要现查管理员名单，Bot API 人为加延迟
+            buf = io.StringIO()
+            with contextlib.redirect_stdout(buf):
+                demo = SimpleNamespace(groups=1, users=1, cycles=1)
+                await _trace_run(demo, args.slow_ms, 1.0, latency=0.03, texts=("/who",))
+            print(f"\n阈值 {args.slow_ms:g} ms、Bot API 延迟 30 ms 时的 /who：")
+            print("\n".join(line for line in buf.getvalue().splitlines() if not line.startswith("启动完成")))
+            await asyncio.sleep(0.1)                         # profile 在线程里写
+            profiles = glob.glob(os.path.join(tmp, bot.TRACE_DIR, "*.prof"))
+            print(f"存下的 profile：{[os.path.basename(p) for p in profiles]}")
+        finally:
+            os.chdir(cwd)
+
+# ========= fanout：换班统计群发 =========
+def _seed_active(groups: int, big_groups: int, per_group: int, big: int, start: float):
+    bot.ACTIVE_BY_CHAT.clear()
+    users = {}
+    uid = itertools.count(10)
+    for g in range(groups):
+        for _ in range(big if g < big_groups else per_group):
+            u = next(uid)
+            ud = fake_user_data(u)
+            ud.active = bot.ActiveSession("smoke", start, 10)
+            ud.last_chat_id = -1000 - g
+            users[u] = ud
+            bot.index_active(ud.last_chat_id, u, ud.active)
+    return users
+
+async def bench_fanout(args):
+    bot.SEND_PER_CHAT_MIN = 10 ** 6                         # 这里只看全局限速
+    start = datetime.now(timezone.utc).timestamp() - 600
+    print(f"{args.groups} 个群（其中 {args.big_groups} 个群各 {args.big} 人未回来，其余各 {args.per_group} 人）"
+          f"| Bot API 延迟 {args.api_latency * 1000:.0f} ms | 全局限速 {bot.SEND_RATE_GLOBAL}/s")
+    for name in ("旧：逐群 await send_message，整段发", "旧：定长切 3500", "新：先渲染按行分页 + 发送队列群发"):
+        api = FakeBotAPI(latency=args.api_latency, check_html=True)
+        app = bot.build_app(token="1:bench", request=api, persistence=MemoryPersistence())
+        drop_startup_reset(app)
+        await app.initialize()
+        await app.post_init(app)
+        await app.start()
+        app.persistence.user_data.update(_seed_active(args.groups, args.big_groups, args.per_group, args.big, start))
+        before = api.calls["sendMessage"]
+        with LoopLag() as lag:
+            t0 = perf_counter()
+            messages = bot.end_sessions(app)
+            render = perf_counter() - t0
+            if name.startswith("新"):
+                sent, _ = await bot.fan_out("bench", messages, prio=bot.PRIO_REMIND)
+            else:
+                # 改造前：一个群一条（或 3500 字一段），一个一个 await
+                texts = {}
+                for chat_id, page in messages:
+                    texts.setdefault(chat_id, []).append(page.split("\n", 1)[1])
+                sent = 0
+                for chat_id, lines in texts.items():
+                    text = "🕖 换班统计：\n" + "\n".join(lines)
+                    chunks = [text] if "整段" in name else [text[i:i + 3500] for i in range(0, len(text), 3500)]
+                    for chunk in chunks:
+                        try:
+                            await app.bot.send_message(chat_id, chunk)
+                            sent += 1
+                        except Exception:
+                            pass
+            total = perf_counter() - t0
+        calls = api.calls["sendMessage"] - before
+        print(f"{name:28s} 渲染 {render * 1000:5.1f} ms | 发完 {total:6.2f}s | 成功 {sent:4d} / 请求 {calls:4d}"
+              f"（HTML/超长被拒 {api.errors['bad_html']}）| sendMessage 最多同时在途 {api.max_inflight} | 循环卡顿 {lag.max_lag * 1000:.1f} ms")
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+
+# ========= replay：录制的 Update 按模拟时钟回放 =========
+class SimClock(bot.Clock):
+    """回放用的时钟：只在驱动里往前拨"""
+
+    def __init__(self, t: float):
+        self.t = t
+
+    def time(self) -> float:
+        return self.t
+
+    def monotonic(self) -> float:
+        return self.t
+
+def synth_day(start: float, hours: float, groups: int, users: int, seed: int = 7) -> List[Tuple[float, dict]]:
+    """一个忙碌群的一天：每人隔一阵打一次卡，少数超时 / 太短，夹杂乱输和管理员查询"""
+    rnd = random.Random(seed)
+    end = start + hours * 3600
+    events: List[Tuple[float, int, int, str]] = []
+    for g in range(groups):
+        chat = -1000 - g
+        for u in range(users):
+            uid = 10 + g * users + u
+            t = start + rnd.random() * 1800
+            while t < end:
+                kind = rnd.choices(("wc", "抽烟", "吃饭"), (5, 4, 1))[0]
+                limit = 30 if kind == "吃饭" else 10
+                r = rnd.random()
+                dur = (rnd.uniform(5, 25) if r < 0.05                               # 太短
+                       else rnd.uniform(limit + 1, limit + 8) * 60 if r < 0.15       # 超时 / 过了宽限
+                       else rnd.uniform(0.3, 0.9) * limit * 60)
+                events.append((t, chat, uid, kind))
+                if rnd.random() < 0.03:
+                    events.append((t + rnd.uniform(1, 60), chat, uid, kind))         # 重复开始
+                events.append((t + dur, chat, uid, "回来"))
+                if rnd.random() < 0.05:
+                    events.append((t + dur + rnd.uniform(1, 60), chat, uid, rnd.choice(("好的", "收到", "ok"))))
+                t += dur + rnd.expovariate(1 / 3000)
+        for t in range(int(start) + 1800, int(end), 7200):
+            events.append((float(t), chat, 1, rnd.choice(("/who", "/summary"))))
+    events = sorted(e for e in events if e[0] < end)
+    out = []
+    for i, (t, chat, uid, text) in enumerate(events, 1):
+        data = make_message(i, chat, uid, text)
+        data["message"]["date"] = int(t)
+        out.append((round(t, 3), data))
+    return out
+
+def _shift_stats(app, start: float, end: float) -> dict:
+    """用来比对两次运行的结果：历史汇总（按班）+ 每个用户的完整状态"""
+    months = bot._months_between(bot.shift_of(start)[0][:7], bot.shift_of(end)[0][:7])
+    rollups = {m: bot.EVENTS.rollup(m)["shift"] for m in months}
+    users = {uid: ud.to_record() for uid, ud in app.user_data.items()}
+    return {"rollups": rollups, "users": users}
+
+async def _replay_run(records, start: float, end: float, workdir: str, record_to: Optional[str] = None) -> dict:
+    """
+    按模拟时钟把 records（(到达时间戳, Update dict)）喂给 handler：
+    两条更新之间先按时间顺序跑到期的提醒和定时任务（换班 / 删消息 / 刷历史），每步都等发送队列清空，结果可重复。
+    """
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    clock = bot.CLOCK = SimClock(start)
+    bot.SEND_RATE_GLOBAL = 10 ** 6
+    bot.SEND_PER_CHAT_MIN = 10 ** 8
+    bot.HELP_BY_CHAT = bot.Debounce(bot.HELP_CHAT_WINDOW)
+    bot.HELP_BY_USER = bot.Debounce(bot.HELP_USER_WINDOW)
+    bot.ADMIN_CACHE.clear()
+    bot.SUMMARY_CACHE.clear()
+    bot.RECORD_FILE, bot.RECORDER = record_to, None
+    api = FakeBotAPI()
+    app = bot.build_app(token="1:bench", request=api)
+    bot.RECORD_FILE = None
+    bot.BOOT["started"] = bot.monotonic()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    bot.TIMERS.stop()                                        # 提醒由下面的驱动按模拟时间发
+    for job in app.job_queue.jobs():                         # JobQueue 按真实时间跑，这里全部换成模拟的
+        job.schedule_removal()
+    ctx = SimpleNamespace(application=app, bot=app.bot)
+    jobs: List[Tuple[float, int, Callable, float]] = []
+    day0 = datetime.fromtimestamp(start, bot.LOCAL_TZ).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    for hour in (7, 19):                                      # 和 build_app 里的 run_daily 一致
+        due = day0 + hour * 3600
+        heapq.heappush(jobs, (due if due > start else due + 86400, hour, bot.reset_shift, 86400))
+    heapq.heappush(jobs, (start + bot.DELETE_SWEEP_SECONDS, 100, bot.sweep_deletes, bot.DELETE_SWEEP_SECONDS))
+    heapq.heappush(jobs, (start + bot.PERSIST_INTERVAL, 101, bot.flush_events, bot.PERSIST_INTERVAL))
+    fired = Counter()
+
+    async def settle():
+        while bot.OUTBOX.depth or len(asyncio.all_tasks()) > base_tasks:
+            await asyncio.sleep(0)
+
+    async def advance(until: float):
+        while True:
+            t_timer = bot.TIMERS.next_due()
+            t_timer = until + 1 if t_timer is None else t_timer
+            t = min(t_timer, jobs[0][0])
+            if t > until:
+                break
+            clock.t = t
+            if t_timer <= jobs[0][0]:
+                fired["reminders"] += await bot.TIMERS.fire_due(t)
+            else:
+                due, key, fn, interval = heapq.heappop(jobs)
+                await fn(ctx)
+                fired[fn.__name__] += 1
+                heapq.heappush(jobs, (due + interval, key, fn, interval))
+            await settle()
+        clock.t = until
+
+    await asyncio.sleep(0.01)
+    base_tasks = len(asyncio.all_tasks())
+    n = 0
+    t0 = perf_counter()
+    for ts, data in records:
+        await advance(ts)
+        await app.process_update(Update.de_json(data, app.bot))
+        await settle()
+        n += 1
+    await advance(end)
+    wall = perf_counter() - t0
+    stats = _shift_stats(app, start, end)
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    bot.CLOCK = bot.Clock()
+    return {"updates": n, "wall": wall, "stats": stats, "calls": Counter(api.calls), "fired": fired}
+
+async def bench_replay(args):
+    start = datetime(2026, 10, 16, 6, 0, tzinfo=bot.LOCAL_TZ).timestamp()
+    end = start + args.hours * 3600
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            log = args.log
+            if log is None:
+                # 先“线上”跑一遍合成的一天，同时开录制；再从录制文件回放一遍，结果应当一模一样
+                log = os.path.join(tmp, "recorded.jsonl.gz")
+                day = synth_day(start, args.hours, args.groups, args.users)
+                live = await _replay_run(day, start, end, os.path.join(tmp, "live"), record_to=log)
+                print(f"合成 {args.hours:g} 小时：{args.groups} 个群 × {args.users} 人，{live['updates']} 条更新"
+                      f" | 录制文件 {os.path.getsize(log) / 1024:.0f} KiB（{os.path.getsize(log) / live['updates']:.0f} B/条）")
+            else:
+                live = None
+                first = next(bot.read_recording(log))[0]
+                start, end = first, first + args.hours * 3600
+            records = [r for r in bot.read_recording(log) if r[0] <= end]
+            end = max(end, records[-1][0] if records else end)
+            rep = await _replay_run(records, start, end, os.path.join(tmp, "replay"))
+            virt = end - start
+            print(f"回放 {rep['updates']} 条更新，模拟 {virt / 3600:.1f} 小时用时 {rep['wall']:.2f}s"
+                  f"（{rep['updates'] / rep['wall']:.0f} updates/s，{virt / rep['wall']:.0f}× 实时）")
+            print(f"定时任务 / 提醒：{dict(rep['fired'])}")
+            print(f"Bot API：{dict(rep['calls'])}")
+            if live is not None:
+                same = live["stats"] == rep["stats"]
+                same_calls = live["calls"] == rep["calls"]
+                shifts = sum(len(v) for roll in rep["stats"]["rollups"].values() for v in roll.values())
+                print(f"和录制时的结果比对：按班汇总 {shifts} 个（群×班次）、{len(rep['stats']['users'])} 个用户的计数"
+                      f" {'一致' if same else '不一致'}；API 调用次数 {'一致' if same_calls else '不一致'}")
+        finally:
+            os.chdir(cwd)
+
+# ========= outage：Bot API 挂掉期间的提醒，重启后还能不能发出去 =========
+class OutageAPI(FakeBotAPI):
+    """down 时 sendMessage 一律 502（PTB 当成 NetworkError）；记下真正发出去的每条文本"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.down = False
+        self.texts: Counter = Counter()
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        if url.endswith("/sendMessage"):
+            if self.down:
+                self.errors["502"] += 1
+                return 502, json.dumps({"ok": False, "error_code": 502, "description": "Bad Gateway"}).encode()
+            self.texts[request_data.parameters.get("text", "")] += 1
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+async def _outage_run(args, journal: bool) -> dict:
+    bot.OUTBOX_FILE = "outbox.jsonl" if journal else None
+    start = datetime.now(timezone.utc).timestamp() - 15 * 60   # 都已经过了上限 + 宽限
+    users = _seed_active(args.groups, 0, args.users, 0, start)
+    persistence = MemoryPersistence(users)
+    api = OutageAPI()
+    api.down = True
+
+    async def boot():
+        app = bot.build_app(token="1:bench", request=api, persistence=persistence)
+        drop_startup_reset(app)
+        bot.BOOT["started"] = bot.monotonic()
+        await app.initialize()
+        await app.post_init(app)                             # 重建提醒：过期的马上发（到时 + @管理员）
+        await app.start()
+        return app
+
+    async def stop(app):
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+
+    # 接口挂着的时候提醒到点，然后进程重启（接口还没恢复）
+    app = await boot()
+    await asyncio.sleep(args.outage)
+    await stop(app)
+    attempts = api.errors["502"]
+
+    # 重启前后有人已经回来了：这些人的提醒不该再发
+    ended = set(list(users)[::max(1, round(1 / args.ended))] if args.ended else ())
+    for uid in ended:
+        bot.unindex_active(users[uid].last_chat_id, uid)
+        users[uid].active = None
+    api.down = False
+    app = await boot()
+    t0 = perf_counter()
+    await asyncio.sleep(1.2)                                 # replay-outbox 在启动 1 秒后跑
+    # 假装有几个提醒因为状态没来得及落盘又被重建的定时器发了一遍：靠 key 去重
+    again = [uid for uid in users if uid not in ended][:args.groups]
+    for uid in again:
+        await bot.remind_grace(app, uid, users[uid].last_chat_id)
+    await drain_outbox()
+    drain = perf_counter() - t0
+    stats = dict(bot.OUTBOX.journal.stats) if bot.OUTBOX.journal is not None else {}
+    await stop(app)
+    expected = 2 * (len(users) - len(ended))
+    delivered = sum(1 for text in api.texts if "提醒" in text or "已到上限" in text)
+    return {"attempts": attempts, "expected": expected, "delivered": delivered,
+            "dupes": sum(n - 1 for n in api.texts.values()), "drain": drain, "stats": stats,
+            "stale_expected": 2 * len(ended)}
+
+async def bench_outage(args):
+    print(f"{args.groups} 个群 × {args.users} 人同时超时，Bot API 挂 {args.outage:g}s 后进程重启，"
+          f"重启时 {args.ended:.0%} 的人已经回来 | 全局限速 {bot.SEND_RATE_GLOBAL}/s")
+    cwd = os.getcwd()
+    for name, journal in (("只在内存里重试", False), ("先写 outbox 日志", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                r = await _outage_run(args, journal)
+            finally:
+                os.chdir(cwd)
+        extra = ""
+        if journal:
+            st = r["stats"]
+            extra = (f" | 丢弃已结束的 {st['stale']}（应为 {r['stale_expected']}），去重 {st['deduped']}"
+                     f" | 恢复后 {r['drain']:.1f}s 发完（{st['sent'] / r['drain']:.0f} 条/s）")
+        print(f"{name:12s} 挂掉期间请求 {r['attempts']:4d} 次 | 应发提醒 {r['expected']}，实际发出 {r['delivered']}，"
+              f"重复 {r['dupes']}{extra}")
+    bot.OUTBOX_FILE = "outbox.jsonl"
+
+# ========= 入口 =========
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="打卡机器人离线基准测试")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("persistence", help="持久化落盘耗时与文件大小")
+    p.add_argument("--users", type=int, default=20000)
+    p.add_argument("--dirty", type=int, default=50)
+    p.add_argument("--rounds", type=int, default=5)
+    p.set_defaults(func=bench_persistence)
+
+    p = sub.add_parser("timers", help="提醒调度的内存与 CPU")
+    p.add_argument("--sessions", type=int, default=10000)
+    p.set_defaults(func=bench_timers)
+
+    p = sub.add_parser("webhook", help="webhook / polling 端到端延迟（可回放录制的 Update JSON）")
+    p.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    p.add_argument("--updates", help="每行一个 Update JSON 的文件；不给就随机生成")
+    p.add_argument("--count", type=int, default=2000)
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--interval", type=float, default=0.002, help="两条更新之间的间隔（秒）")
+    p.add_argument("--api-latency", type=float, default=0.0, help="每次 Bot API 调用注入的延迟（秒）")
+    p.add_argument("--port", type=int, default=18080)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser("filters", help="群消息过滤/分发阶段吞吐")
+    p.add_argument("--count", type=int, default=200000)
+    p.set_defaults(func=bench_filters)
+
+    p = sub.add_parser("load", help="离线压测：handler 延迟、每次打卡的 API 调用、内存、换班耗时")
+    p.add_argument("--groups", type=int, default=50)
+    p.add_argument("--users", type=int, default=40, help="每个群的人数")
+    p.add_argument("--cycles", type=int, default=3, help="每人 开始→回来 的轮数")
+    p.add_argument("--api-latency", type=float, default=0.0)
+    p.add_argument("--rate-429", type=float, default=0.0, help="sendMessage 随机返回 429 的比例")
+    p.add_argument("--send-rate", type=float, default=1000, help="压测时放开的发送速率（条/秒）")
+    p.add_argument("--reset-sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1000, 10000, 100000])
+    p.add_argument("--reset-active", type=int, default=100, help="换班时进行中的人数")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("stress", help="并发处理下的重复计数检查")
+    p.add_argument("--concurrency", type=int, default=256)
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--cycles", type=int, default=5)
+    p.add_argument("--api-latency", type=float, default=0.01)
+    p.set_defaults(func=bench_stress)
+
+    p = sub.add_parser("events", help="历史记录：写入、重建汇总、区间查询")
+    p.add_argument("--months", type=int, default=6)
+    p.add_argument("--groups", type=int, default=10)
+    p.add_argument("--users", type=int, default=50, help="每个群的人数")
+    p.add_argument("--sessions", type=int, default=8, help="每人每天的打卡次数")
+    p.set_defaults(func=bench_events)
+
+    p = sub.add_parser("summary", help="/summary：全量扫描 vs 增量汇总 + 缓存")
+    p.add_argument("--users", type=int, default=100000)
+    p.add_argument("--chats", type=int, default=50)
+    p.set_defaults(func=bench_summary)
+
+    p = sub.add_parser("shards", help="多进程分片：worker 数与吞吐")
+    p.add_argument("--workers", type=lambda v: [int(x) for x in v.split(",")], default=[1, 2, 4])
+    p.add_argument("--groups", type=int, default=40)
+    p.add_argument("--users", type=int, default=50, help="每个群的人数")
+    p.add_argument("--cycles", type=int, default=3)
+    p.add_argument("--api-latency", type=float, default=0.0)
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("metrics", help="跑一轮负载后抓 /metrics：各 handler / API 方法的耗时")
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--users", type=int, default=30)
+    p.add_argument("--api-latency", type=float, default=0.03)
+    p.add_argument("--rate-429", type=float, default=0.02)
+    p.add_argument("--port", type=int, default=19100)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("help", help="乱输提示防抖：发出去的消息数")
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--users", type=int, default=30, help="每个群的人数")
+    p.add_argument("--interval", type=float, default=2, help="每个群两条乱输之间的间隔（模拟秒）")
+    p.add_argument("--duration", type=float, default=30, help="模拟多少分钟")
+    p.add_argument("--chat-window", type=float, default=bot.HELP_CHAT_WINDOW)
+    p.add_argument("--user-window", type=float, default=bot.HELP_USER_WINDOW)
+    p.set_defaults(func=bench_help)
+
+    p = sub.add_parser("schema", help="user_data：旧 dict 布局 vs __slots__ 记录的内存与快照大小")
+    p.add_argument("--users", type=int, default=20000)
+    p.add_argument("--chats", type=int, default=2, help="每人有统计的群数")
+    p.set_defaults(func=bench_schema)
+
+    p = sub.add_parser("backup", help="备份：每次启动整库拷贝 vs 快照 + 增量 + 保留策略")
+    p.add_argument("--users", type=int, default=20000)
+    p.add_argument("--days", type=float, default=7)
+    p.add_argument("--dirty", type=int, default=200, help="每个备份间隔内有变化的用户数")
+    p.add_argument("--restarts-per-day", type=float, default=24)
+    p.set_defaults(func=bench_backup)
+
+    p = sub.add_parser("export", help="/export：后台写 CSV / XLSX 的耗时、内存与事件循环卡顿")
+    p.add_argument("--users", type=int, default=300)
+    p.add_argument("--days", type=int, default=30)
+    p.set_defaults(func=bench_export)
+
+    p = sub.add_parser("reshard", help="分片数变化：2 → 1 → 2 后逐人核对各群统计没丢（不一致时退出码 1）")
+    p.add_argument("--users", type=int, default=20000)
+    p.set_defaults(func=bench_reshard)
+
+    p = sub.add_parser("startup", help="冷启动：菜单同步的 API 调用、加载用户、到处理第一条更新的耗时")
+    p.add_argument("--users", type=int, default=100000)
+    p.add_argument("--events", type=int, default=300000, help="当月已有的打卡记录条数")
+    p.add_argument("--api-latency", type=float, default=0.05)
+    p.add_argument("--target-ms", type=float, default=500, help="首条更新的目标耗时（毫秒）")
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("trace", help="追踪：开 / 关 / 抽样 profile 的开销，打印一条慢更新的 span 树")
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--cycles", type=int, default=5)
+    p.add_argument("--slow-ms", type=float, default=20)
+    p.add_argument("--profile-rate", type=float, default=0.01)
+    p.set_defaults(func=bench_trace)
+
+    p = sub.add_parser("fanout", help="换班统计群发：逐群发送 vs 先渲染再经发送队列并发，含 HTML 切分校验")
+    p.add_argument("--groups", type=int, default=100)
+    p.add_argument("--big-groups", type=int, default=5, help="人很多、一条放不下的群")
+    p.add_argument("--per-group", type=int, default=5)
+    p.add_argument("--big", type=int, default=120)
+    p.add_argument("--api-latency", type=float, default=0.25)
+    p.set_defaults(func=bench_fanout)
+
+    p = sub.add_parser("replay", help="录制 / 回放：模拟时钟下跑一天的流量，比对结果和吞吐")
+    p.add_argument("--log", help="RECORD_UPDATES 录下的文件；不给就合成一天再录制")
+    p.add_argument("--hours", type=float, default=24)
+    p.add_argument("--groups", type=int, default=1)
+    p.add_argument("--users", type=int, default=80)
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser("outage", help="Bot API 挂掉 + 进程重启时提醒的补发、去重和排空速度")
+    p.add_argument("--groups", type=int, default=10)
+    p.add_argument("--users", type=int, default=10)
+    p.add_argument("--ended", type=float, default=0.25, help="重启时已经回来的人的比例")
+    p.add_argument("--outage", type=float, default=3, help="重启前接口挂了多少秒")
+    p.set_defaults(func=bench_outage)
+
+    args = parser.parse_args(argv)
+    return asyncio.run(args.func(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
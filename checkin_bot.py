@@ -2,39 +2,115 @@
 # 飞机打卡机器人（群用）
 
 import os
-import re
+import sys
+import hmac
+import json
+import signal
 import shutil
-from time import perf_counter
+import gzip
+import zlib
+import hashlib
+import functools
+import pickle
+import sqlite3
+import glob
+import bisect
+import heapq
+import mmap
+import struct
+import csv
+import re
+import zipfile
+import tempfile
+import asyncio
+import threading
+import multiprocessing
+import itertools
+import random
+import cProfile
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from http import HTTPStatus
+from time import perf_counter, monotonic
 from datetime import datetime, timezone, timedelta, time as dtime
-from typing import Optional, Any, Dict, Set, List
+from typing import Optional, Any, Dict, Set, List, Tuple, Callable, Awaitable, Sequence
 
 from telegram import (
-    Update, constants, BotCommand,
+    Bot, Update, Message, LinkPreviewOptions, constants, BotCommand,
     BotCommandScopeDefault, BotCommandScopeAllGroupChats, BotCommandScopeAllPrivateChats
 )
-from telegram.error import RetryAfter
+from telegram.error import RetryAfter, BadRequest, Forbidden
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
-    Application, ApplicationBuilder, CommandHandler, MessageHandler,
-    ContextTypes, Defaults, filters as F, PicklePersistence
+    Application, ApplicationBuilder, CommandHandler, MessageHandler, ChatMemberHandler,
+    ContextTypes, Defaults, filters as F, BasePersistence, PersistenceInput, TypeHandler
 )
 
 # ========= 基础配置 =========
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "8474574984:AAEQaBlw1MED0EPlx0sFD_gyFXJn7hh8rQw"
 LOCAL_TZ = timezone(timedelta(hours=7))   # 柬埔寨 UTC+7
 
+# 运行方式：设置 WEBHOOK_URL（如 https://xxx.herokuapp.com）就走 webhook，否则 long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = "/telegram"
+HTTP_MAX_BODY = 4 * 1024 * 1024   # 请求体上限（字节），超过直接 413，不读
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+PORT = int(os.getenv("PORT") or 8080)
+ALLOWED_UPDATES = ["message", "chat_member"]
+# 并发处理的更新数（0 = 按顺序逐条处理）；同一用户 / 同一群的关键状态仍然串行
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES") or 0)
+# 多进程：WORKERS > 1 时本进程只收更新，按 chat_id 分给 N 个 worker（各自的状态 / 定时器 / 数据库）
+WORKERS = int(os.getenv("WORKERS") or 0)
+SHARD_ID, SHARDS = 0, 1   # 当前进程负责的分片，worker 启动时改
+# 监控端口（0 = 不开）；只监听 127.0.0.1，多进程时 worker 用 METRICS_PORT + 分片号
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+# 追踪：一条更新 / 定时任务超过 TRACE_SLOW_MS 毫秒就打印它的 span 树（0 = 关闭，几乎零开销）
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS") or 0)
+TRACE_PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE") or 0)   # 按这个比例抽样 cProfile，慢的存到 TRACE_DIR
+TRACE_DIR = "traces"
+
 # 管理员（超时后会 @）
 MANAGER_ID = 7736035882
 MANAGER_NAME = "Kun"
 MANAGER_USERNAME = "Knor1130"   # Telegram 用户名，用于真正 @
 
-# ========= 业务参数 =========
+# ========= 业务参数（默认规则；各群可在 policies.json 或用 /setlimit /setcount 覆盖） =========
 LIMITS       = {"toilet": 10, "smoke": 10, "meal": 30}          # 每次最大时长（分钟）
 LIMITS_COUNT = {"toilet": 5,  "smoke": 5,  "meal": 3}           # 每类每班最多次数
 MIN_SECONDS  = {"toilet": 30, "smoke": 30, "meal": 60}          # 最小时长（秒）
 COOLDOWN_MIN = {"toilet": 5,  "smoke": 5,  "meal": 15}          # 冷却（分钟）
 GRACE_MINUTES = 3                                               # 超时后再等 X 分钟 @ 管理员
+POLICY_FILE = os.getenv("POLICY_FILE", "policies.json")         # 按群覆盖规则，改了自动生效
+POLICY_RELOAD_SECONDS = 10                                      # 多久检查一次 POLICY_FILE 有没有改
 
 HELP_DELETE_MINUTES = 1   # 提示类消息保留时间（分钟）
+HELP_CHAT_WINDOW = 60     # 同一个群多少秒内最多发一次打卡说明（0 = 不限）
+HELP_USER_WINDOW = 300    # 同一个人在同一个群多少秒内最多收到一次打卡说明
+DELETE_SWEEP_SECONDS = 5  # 待删除消息扫描间隔（秒）
+SEND_RATE_GLOBAL = 25       # 全局每秒最多发送条数（Telegram 约 30 条/秒）
+SEND_PER_CHAT_MIN = 20      # 每个群每分钟最多条数（Telegram 群约 20 条/分钟）
+SEND_MAX_INFLIGHT = 32      # 同时在途的 sendMessage 请求上限
+SEND_RETRY_MAX = 300        # 发送失败后隔 2、4、8… 秒重试，最长隔这么多秒
+FANOUT_WAIT_SECONDS = 120   # 记了发送日志的群发最多等这么久，没发完的留在日志里接着重试，定时任务先返回
+ADMIN_CACHE_TTL = 600     # 群管理员名单缓存时间（秒），chat_member 更新会即时修正
+
+DB_FILE = "botdata.db"          # SQLite 持久化文件
+LEGACY_PICKLE = "botdata.pkl"   # 旧版 PicklePersistence 文件（启动时一次性迁移）
+PERSIST_INTERVAL = 5            # 脏数据落盘间隔（秒）
+HYDRATE_CHUNK = 1000            # 启动后台找进行中打卡时每批解码多少人
+STARTUP_TARGET_MS = 500         # 启动到可以处理更新的目标耗时（毫秒），超了打印提醒
+IDLE_PRUNE_DAYS = 30            # 多少天没打卡的用户清掉
+EVENT_DIR = "events"            # 历史打卡记录（按月分段）
+RECORD_FILE = os.getenv("RECORD_UPDATES")   # 设置后把收到的 Update 录下来（gzip JSON 行），回放见 bench.py replay
+OUTBOX_FILE = "outbox.jsonl"    # 要紧的消息（提醒、结束结果、换班统计）先记到这里再发，重启后补发
+OUTBOX_MAX_AGE_HOURS = 6        # 要紧的消息最多补发多久（不超过半个班）；发过的 key 也记这么久用来去重
+BACKUP_DIR = "backup"           # 备份目录：整库快照 + 增量
+BACKUP_DELTA_MINUTES = 10       # 多久备份一次变化的行
+BACKUP_SNAPSHOT_HOURS = 24      # 多久做一次整库快照（开一条新链）
+BACKUP_KEEP = {"hourly": 24, "daily": 7, "weekly": 4}   # 每小时/每天/每周各保留最新的一个还原点
 
 TITLES = {"toilet": "厕所", "smoke": "抽烟", "meal": "吃饭"}
 
@@ -44,10 +120,38 @@ TRIGGERS: Dict[str, Set[str]] = {
     "meal":   {"吃", "吃饭", "吃飯", "用餐", "eat", "eating", "meal", "lunch", "dinner", "food"},
 }
 
+# ========= 时钟：业务里的“现在”都从这里取，回放（bench.py replay）时换成模拟时钟 =========
+class Clock:
+    def time(self) -> float:
+        """当前 UTC 时间戳"""
+        return datetime.now(timezone.utc).timestamp()
+
+    def monotonic(self) -> float:
+        """只用来算间隔（管理员缓存、防抖）"""
+        return monotonic()
+
+CLOCK = Clock()
+
 # ========= 小工具 =========
+SHIFT_NAMES = {"D": "白班", "N": "夜班"}
+_SHIFT_DAY_OFFSET = LOCAL_TZ.utcoffset(None).total_seconds() - 7 * 3600   # 一个班次日从本地 07:00 开始
+
+@functools.lru_cache(maxsize=4096)
+def _day_iso(day: int) -> str:
+    return (datetime(1970, 1, 1) + timedelta(days=day)).date().isoformat()
+
+def shift_of(ts: float) -> Tuple[str, str]:
+    """时间戳 → (班次日期, "D"/"N")；夜班 0~7 点算前一天的夜班（重建汇总时每条都要算，不走 datetime）"""
+    day, sec = divmod(ts + _SHIFT_DAY_OFFSET, 86400)
+    return _day_iso(int(day)), ("D" if sec < 12 * 3600 else "N")
+
+def shift_epoch(ts: Optional[float] = None) -> str:
+    """班次编号，如 2026-10-17D；换班就是编号变了"""
+    day, shift = shift_of(CLOCK.time() if ts is None else ts)
+    return day + shift
+
 def current_shift_label() -> str:
-    now_local = datetime.now(LOCAL_TZ).time()
-    return "白班" if dtime(7, 0) <= now_local < dtime(19, 0) else "夜班"
+    return SHIFT_NAMES[shift_epoch()[-1]]
 
 def mention_user_html(user) -> str:
     name = (getattr(user, "full_name", None) or getattr(user, "first_name", None) or "用户")
@@ -63,336 +167,1775 @@ def fmt_dur_mmss(seconds: int) -> str:
     m, s = divmod(seconds, 60)
     return f"{m}分{s:02d}秒"
 
-def ensure_stats_for_chat(ud: dict, chat_id: int) -> dict:
+# ========= 用户状态：带版本号的 __slots__ 记录 =========
+# context.user_data 就是 UserState（见 build_app 里的 ContextTypes）。
+# 落盘时转成只含内置类型的 record（开头是版本号），读回来时旧版 dict 一并升级；
+# 定时器、Job、HTML 片段之类不进持久化。
+SCHEMA_VERSION = 2      # 1 = 旧版 dict：stats_by_chat / last_end_xxx / user_link / reminder_job ...
+KINDS = ("toilet", "smoke", "meal")
+KIND_INDEX = {k: i for i, k in enumerate(KINDS)}
+
+class ActiveSession:
+    """进行中的一次打卡；start 是 UTC 时间戳，同时也是提醒的 token"""
+
+    __slots__ = ("kind", "start", "limit", "reminded", "graced", "user_msg_id", "bot_msg_id")
+
+    def __init__(self, kind: str, start: float, limit: int):
+        self.kind = kind
+        self.start = start
+        self.limit = limit
+        self.reminded = False
+        self.graced = False
+        self.user_msg_id: Optional[int] = None     # 你发的 wc/抽烟/吃饭
+        self.bot_msg_id: Optional[int] = None      # 机器人“开始计时”
+
+    @property
+    def title(self) -> str:
+        return TITLES.get(self.kind, "打卡")
+
+    def to_record(self) -> tuple:
+        return (self.kind, self.start, self.limit, self.reminded, self.graced, self.user_msg_id, self.bot_msg_id)
+
+    @classmethod
+    def from_record(cls, rec: tuple) -> "ActiveSession":
+        a = cls(rec[0], rec[1], rec[2])
+        a.reminded, a.graced, a.user_msg_id, a.bot_msg_id = rec[3:7]
+        return a
+
+class ChatCounters:
+    """一个群本班的次数 / 秒数，按 KINDS 的下标存"""
+
+    __slots__ = ("count", "dur")
+
+    def __init__(self):
+        self.count = array("I", [0] * len(KINDS))
+        self.dur = array("I", [0] * len(KINDS))
+
+    def add(self, kind: str, seconds: int, n: int = 1):
+        i = KIND_INDEX[kind]
+        self.count[i] += n
+        self.dur[i] += max(0, int(seconds))
+
+    def items(self):
+        """(类型, 次数, 秒数)，全 0 的跳过"""
+        for i, kind in enumerate(KINDS):
+            if self.count[i] or self.dur[i]:
+                yield kind, self.count[i], self.dur[i]
+
+    def to_record(self) -> bytes:
+        return self.count.tobytes() + self.dur.tobytes()
+
+    @classmethod
+    def from_record(cls, rec: bytes) -> "ChatCounters":
+        c = cls()
+        half = len(rec) // 2
+        c.count = array("I", rec[:half])
+        c.dur = array("I", rec[half:])
+        return c
+
+class UserState:
     """
-    每个用户按群单独统计：
-    ud["stats_by_chat"][chat_id]["smoke"|"toilet"|"meal"]["count"|"dur"]
+    一个用户的全部状态：
+    - stats：{chat_id: ChatCounters}，只属于 epoch 那一班；换班后视为 0，下次用到时清掉
+    - last_end：各类型上次结束的时间戳（冷却用），按 KINDS 下标
+    - active：进行中的打卡，没有就是 None
+    启动时从库里读出来的是“冷”对象：只带着原始行（_blob），第一次访问任何字段时才解码
     """
-    all_stats = ud.setdefault("stats_by_chat", {})
-    key = str(chat_id)
-    if key not in all_stats:
-        all_stats[key] = {
-            "smoke":  {"count": 0, "dur": 0},
-            "toilet": {"count": 0, "dur": 0},
-            "meal":   {"count": 0, "dur": 0},
-        }
-    return all_stats[key]
 
-async def is_admin(update: Update) -> bool:
-    try:
-        member = await update.effective_chat.get_member(update.effective_user.id)
-        return member.status in ("administrator", "creator")
-    except Exception:
-        return False
+    __slots__ = ("epoch", "stats", "last_end", "active", "last_chat_id", "last_seen", "username", "name", "_blob")
+    FIELDS = __slots__[:-1]
+
+    def __init__(self):
+        self._blob: Optional[bytes] = None
+        self.epoch = ""
+        self.stats: Dict[int, ChatCounters] = {}
+        self.last_end = array("d", [0.0] * len(KINDS))
+        self.active: Optional[ActiveSession] = None
+        self.last_chat_id: Optional[int] = None
+        self.last_seen = 0.0
+        self.username: Optional[str] = None
+        self.name: Optional[str] = None
+
+    @classmethod
+    def cold(cls, blob: bytes) -> "UserState":
+        ud = cls.__new__(cls)
+        ud._blob = blob
+        return ud
+
+    @property
+    def is_cold(self) -> bool:
+        return self._blob is not None
+
+    def hydrate(self, warm: Optional["UserState"] = None) -> bool:
+        """冷对象就地解码；warm 是线程里已经从同一行解好的对象。本来就是热的返回 False"""
+        blob = self._blob
+        if blob is None:
+            return False
+        src = warm if warm is not None else UserState.from_record(pickle.loads(blob))
+        for name in UserState.FIELDS:
+            setattr(self, name, getattr(src, name))
+        self._blob = None
+        return True
+
+    def __getattr__(self, name: str):
+        # 只有没赋值的 slot 才会走到这里：冷对象第一次被访问
+        if name == "_blob" or not self.hydrate():
+            raise AttributeError(name)
+        return getattr(self, name)
+
+    def counters(self, chat_id: int) -> ChatCounters:
+        """本班在这个群的计数；上一班留下的在这里顺手清掉"""
+        epoch = shift_epoch()
+        if self.epoch != epoch:
+            self.epoch = epoch
+            self.stats = {}
+        c = self.stats.get(chat_id)
+        if c is None:
+            c = self.stats[chat_id] = ChatCounters()
+        return c
+
+    def link(self, uid: int) -> str:
+        return mention_id_html(uid, self.name or "这位同事")
+
+    def __deepcopy__(self, memo) -> "UserState":
+        # Application 每次落盘前都会 deepcopy 脏用户；走 record 比逐个 slot 通用复制快得多
+        return UserState.from_record(self.to_record())
+
+    def __reduce__(self):
+        return UserState.from_record, (self.to_record(),)
+
+    def to_record(self) -> tuple:
+        """落盘格式：只有内置类型，第一个元素是版本号"""
+        return (
+            SCHEMA_VERSION, self.epoch,
+            {cid: c.to_record() for cid, c in self.stats.items()},
+            self.last_end.tobytes(),
+            self.active.to_record() if self.active else None,
+            self.last_chat_id, self.last_seen, self.username, self.name,
+        )
+
+    @classmethod
+    def from_record(cls, rec) -> "UserState":
+        """读回落盘数据；旧版 dict 布局在这里升级，以后加字段也按版本号补默认值"""
+        if isinstance(rec, cls):
+            return rec
+        if isinstance(rec, dict):
+            return cls._from_v1(rec)
+        ud = cls()
+        (_, ud.epoch, stats, last_end, active,
+         ud.last_chat_id, ud.last_seen, ud.username, ud.name) = rec
+        ud.stats = {cid: ChatCounters.from_record(c) for cid, c in stats.items()}
+        ud.last_end = array("d", last_end)
+        ud.active = ActiveSession.from_record(active) if active else None
+        return ud
+
+    @classmethod
+    def _from_v1(cls, d: dict) -> "UserState":
+        ud = cls()
+        ud.epoch = d.get("stats_epoch") or ""
+        for key, kinds in (d.get("stats_by_chat") or {}).items():
+            c = ChatCounters()
+            for kind, st in kinds.items():
+                if kind in KIND_INDEX and (st.get("count") or st.get("dur")):
+                    c.add(kind, st.get("dur", 0), st.get("count", 0))
+            if any(c.count) or any(c.dur):
+                ud.stats[int(key)] = c
+        for i, kind in enumerate(KINDS):
+            ud.last_end[i] = d.get(f"last_end_{kind}") or 0.0
+        active = d.get("active")
+        if active and active.get("type") in KIND_INDEX:
+            start = active.get("start")
+            start = start.timestamp() if isinstance(start, datetime) else float(start or 0)
+            a = ActiveSession(active["type"], start, int(active.get("limit") or LIMITS[active["type"]]))
+            a.reminded = bool(active.get("reminded"))
+            a.graced = bool(active.get("graced"))
+            a.user_msg_id = d.get("start_user_msg_id")
+            a.bot_msg_id = d.get("start_bot_msg_id")
+            ud.active = a
+        ud.last_chat_id = d.get("last_chat_id")
+        ud.last_seen = d.get("_last_seen") or 0.0
+        ud.username = d.get("user_username")
+        link = d.get("user_link")
+        if link and ">" in link:
+            # 旧版存的是拼好的 <a href=...>名字</a>，只留名字
+            ud.name = link.split(">", 1)[1].rsplit("</a>", 1)[0].replace("&lt;", "<").replace("&gt;", ">")
+        return ud
 
 def chat_is_muted(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
     return bool(ctx.application.chat_data.get(chat_id, {}).get("muted", False))
 
-async def safe_send(bot, chat_id: int, html_text: str, preview: bool = False):
-    MAX = 3500
-    for i in range(0, len(html_text), MAX):
-        chunk = html_text[i:i+MAX]
-        for attempt in range(2):
+BACK_WORDS = {"回来", "回", "back", "1"}
+ACTION_BACK = "back"
+
+def build_text_actions(triggers: Dict[str, Set[str]] = TRIGGERS) -> Dict[str, str]:
+    """归一化后的文本 → 动作（打卡类型 / back），群消息只查一次字典"""
+    actions = {w.lower(): kind for kind, words in triggers.items() for w in words}
+    actions.update({w.lower(): ACTION_BACK for w in BACK_WORDS})
+    return actions
+
+TEXT_ACTIONS = build_text_actions()
+
+# ========= 群规则：默认值 ← policies.json ← 群里 /setlimit /setcount =========
+# policies.json 示例（类型可写 toilet/smoke/meal 或 厕所/抽烟/吃饭）：
+#   {"default": {"grace": 3},
+#    "chats": {"-1001234567890": {"limits": {"抽烟": 12}, "counts": {"吃饭": 2}, "min_seconds": {"厕所": 20},
+#                                 "cooldown": {"抽烟": 10}, "grace": 5, "triggers": {"smoke": ["抽", "烟"]}}}}
+# 群里管理员改的写在 chat_data["policy"]，随持久化落盘，优先级最高。
+POLICY_TABLES = ("limits", "counts", "min_seconds", "cooldown")   # 按类型的整数表
+KIND_BY_NAME = {**{k: k for k in KINDS}, **{v: k for k, v in TITLES.items()}}
+
+class Policy:
+    """一个群生效的规则；内容相同的群共用同一个对象"""
+
+    __slots__ = ("limits", "counts", "min_seconds", "cooldown", "grace", "actions")
+
+    def __init__(self, layers: List[dict]):
+        self.limits, self.counts = dict(LIMITS), dict(LIMITS_COUNT)
+        self.min_seconds, self.cooldown = dict(MIN_SECONDS), dict(COOLDOWN_MIN)
+        self.grace = GRACE_MINUTES
+        triggers: Dict[str, Any] = {}
+        for layer in layers:
+            for table in POLICY_TABLES:
+                getattr(self, table).update(layer.get(table) or {})
+            self.grace = layer.get("grace", self.grace)
+            triggers.update(layer.get("triggers") or {})
+        self.actions = build_text_actions({**TRIGGERS, **triggers}) if triggers else TEXT_ACTIONS
+
+    def rules_text(self) -> str:
+        """打卡说明里和规则有关的几行"""
+        limits = "，".join(f"{TITLES[k]}{self.limits[k]}分" for k in KINDS)
+        mins = "、".join(f"{TITLES[k]}{self.min_seconds[k]}秒" for k in KINDS)
+        return (f"• 时长：{limits}；到时提醒；超时提示。\n"
+                f"• 最小时长：{mins}，未达不计且不冷却。\n"
+                f"• 超时：到时提醒本人，{self.grace} 分钟后仍未结束会@管理员。")
+
+def _checked(field: str, value, least: int) -> int:
+    value = int(value)
+    if value < least:
+        raise ValueError(f"{field} 不能小于 {least}：{value}")
+    return value
+
+def clean_rules(rules: dict) -> dict:
+    """
+    校验一层规则（配置文件里的一个群 / default）；类型名统一成 toilet/smoke/meal，不对就抛异常。
+    时长上限和 /setlimit 一样必须大于 0（0 分钟会一开始就提醒超时），其余不能为负
+    """
+    out: Dict[str, Any] = {}
+    for field, value in rules.items():
+        if field in POLICY_TABLES:
+            least = 1 if field == "limits" else 0
+            out[field] = {KIND_BY_NAME[k]: _checked(f"{field}.{k}", v, least) for k, v in value.items()}
+        elif field == "grace":
+            out[field] = _checked(field, value, 0)
+        elif field == "triggers":
+            out[field] = {KIND_BY_NAME[k]: {str(w).lower() for w in words} for k, words in value.items()}
+        else:
+            raise ValueError(f"未知字段 {field}")
+    return out
+
+class PolicyStore:
+    """
+    每个群的 Policy 缓存：第一次用到时把三层规则合并好，之后每个 update 只是一次字典查找。
+    配置文件改了 / 群里改了规则，清掉对应缓存即可。
+    """
+
+    def __init__(self, path: str = POLICY_FILE):
+        self.path = path
+        self.mtime: Optional[int] = None
+        self.default: dict = {}
+        self.chats: Dict[int, dict] = {}
+        self.reloads = 0
+        self._by_chat: Dict[int, Policy] = {}
+        self._shared: Dict[str, Policy] = {}
+
+    def read_if_changed(self) -> Optional[Tuple[dict, Dict[int, dict]]]:
+        """文件变了就读出来并校验（在线程里跑）；没变返回 None，读坏了打印错误、沿用旧规则"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        if mtime is None:
+            return {}, {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                raw = json.load(f)
+            return (clean_rules(raw.get("default") or {}),
+                    {int(cid): clean_rules(rules) for cid, rules in (raw.get("chats") or {}).items()})
+        except Exception as e:
+            print(f"{self.path} 有误，沿用旧规则：{e!r}")
+            return None
+
+    def apply(self, config: Tuple[dict, Dict[int, dict]]):
+        self.default, self.chats = config
+        self.reloads += 1
+        self.clear()
+
+    def clear(self):
+        self._by_chat.clear()
+        self._shared.clear()
+
+    def forget(self, chat_id: int):
+        self._by_chat.pop(chat_id, None)
+
+    def get(self, chat_id: int, chat_data: Optional[dict]) -> Policy:
+        policy = self._by_chat.get(chat_id)
+        if policy is None:
+            layers = [self.default, self.chats.get(chat_id) or {}, (chat_data or {}).get("policy") or {}]
+            key = repr(layers)
+            policy = self._shared.get(key)
+            if policy is None:
+                policy = self._shared[key] = Policy(layers)
+            self._by_chat[chat_id] = policy
+        return policy
+
+    def __len__(self) -> int:
+        return len(self._by_chat)
+
+POLICIES = PolicyStore()
+
+def chat_policy(app: Application, chat_id: int) -> Policy:
+    return POLICIES.get(chat_id, app.chat_data.get(chat_id))
+
+# ========= 监控：handler / Bot API 耗时直方图、计数器（Prometheus 文本格式） =========
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """按一个标签分组的直方图；各桶单独计数，输出时再累加成 le 桶"""
+
+    def __init__(self, name: str, doc: str, label: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.buckets = buckets
+        self.series: Dict[str, List[float]] = {}   # 标签值 -> [各桶..., +Inf, sum, count]
+
+    def observe(self, key: str, value: float):
+        s = self.series.get(key)
+        if s is None:
+            s = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-2] += value
+        s[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, s in self.series.items():
+            acc = 0
+            for le, n in zip(self.buckets + ("+Inf",), s):
+                acc += n
+                out.append(f'{self.name}_bucket{{{self.label}="{key}",le="{le}"}} {acc}')
+            out.append(f'{self.name}_sum{{{self.label}="{key}"}} {s[-2]:.6f}')
+            out.append(f'{self.name}_count{{{self.label}="{key}"}} {s[-1]}')
+        return out
+
+class CounterVec:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], int] = {}
+
+    def inc(self, *key: str, n: int = 1):
+        self.values[key] = self.values.get(key, 0) + n
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, v in self.values.items():
+            labels = ",".join(f'{k}="{val}"' for k, val in zip(self.labels, key))
+            out.append(f"{self.name}{{{labels}}} {v}")
+        return out
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "handler / 定时任务耗时（含等锁）", "handler")
+HANDLER_ERRORS = CounterVec("bot_handler_errors_total", "handler 抛出的异常", ("handler", "error"))
+API_SECONDS = Histogram("bot_api_seconds", "Bot API 请求耗时", "method")
+API_ERRORS = CounterVec("bot_api_errors_total", "Bot API 非 200 响应（429 等）和网络错误", ("method", "status"))
+FLUSH_SECONDS = Histogram("bot_persistence_flush_seconds", "一批脏行写入 SQLite 的耗时", "store")
+FANOUT_SECONDS = Histogram("bot_fanout_seconds", "多群群发（换班统计等）从交给发送队列到全部发出的耗时", "job",
+                           buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+SLOW_TRACES = CounterVec("bot_slow_traces_total", "超过 TRACE_SLOW_MS 的更新 / 任务（profiled = 存了 profile）",
+                         ("handler", "profiled"))
+# 进程启动 → post_init 完成（可以处理更新）→ 第一条更新处理完，单位秒
+BOOT = {"started": monotonic(), "ready": 0.0, "first_update": 0.0}
+
+# ========= 追踪：每条更新 / 定时任务一棵 span 树，慢的打印出来，抽样 cProfile =========
+class Span:
+    """
+    根 = 一次 handler / 定时任务 / 落盘；子节点 = 里面嵌套的 handler、Bot API 调用、等锁、进发送队列。
+    当前 span 放在 contextvar 里，跟着 asyncio 任务走；发送队列的 worker 任务不在树里（只记“进队”）
+    """
+
+    __slots__ = ("name", "start", "dur", "attrs", "children", "token", "profile")
+
+    def __init__(self, name: str, start: float, attrs: dict):
+        self.name = name
+        self.start = start
+        self.dur = 0.0
+        self.attrs = attrs
+        self.children: List["Span"] = []
+        self.token = None
+        self.profile: Optional[cProfile.Profile] = None
+
+    def render(self, origin: Optional[float] = None, depth: int = 0) -> List[str]:
+        origin = self.start if origin is None else origin
+        attrs = " ".join(f"{k}={v}" for k, v in self.attrs.items())
+        out = [f"{'  ' * depth}{self.name} +{(self.start - origin) * 1000:.1f} {self.dur * 1000:.1f} ms {attrs}".rstrip()]
+        for child in self.children:
+            out += child.render(origin, depth + 1)
+        return out
+
+CURRENT_SPAN: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_PROFILING = False   # cProfile 同一线程只能开一个
+
+def update_attrs(args: tuple) -> dict:
+    update = args[0] if args else None
+    if not isinstance(update, Update):
+        return {}
+    chat, user = update.effective_chat, update.effective_user
+    return {"update": update.update_id, "chat": chat.id if chat else None, "user": user.id if user else None}
+
+def span_open(name: str, attrs: Optional[dict] = None, root: bool = True) -> Optional[Span]:
+    """开一个 span 并设为当前；外面没有 span 时 root=True 才开成根（抽样 profile 也从这里开始）"""
+    global _PROFILING
+    parent = CURRENT_SPAN.get()
+    if parent is None and not root:
+        return None
+    s = Span(name, perf_counter(), attrs or {})
+    if parent is not None:
+        parent.children.append(s)
+    elif TRACE_PROFILE_RATE and not _PROFILING and random.random() < TRACE_PROFILE_RATE:
+        # 事件循环是单线程：这段时间里交错执行的其它任务也会算进来，看的时候注意
+        _PROFILING = True
+        s.profile = cProfile.Profile()
+        s.profile.enable()
+    s.token = CURRENT_SPAN.set(s)
+    return s
+
+def span_close(s: Span):
+    """结束 span；根超过 TRACE_SLOW_MS 就打印整棵树，抽样到的 profile 一并存盘"""
+    global _PROFILING
+    s.dur = perf_counter() - s.start
+    CURRENT_SPAN.reset(s.token)
+    if CURRENT_SPAN.get() is not None:
+        return
+    if s.profile is not None:
+        s.profile.disable()
+        _PROFILING = False
+    if s.dur * 1000 < TRACE_SLOW_MS:
+        return
+    path = ""
+    if s.profile is not None:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, f"{_stamp(datetime.now(timezone.utc).timestamp())}-{s.name}-{s.attrs.get('update', 0)}.prof")
+        asyncio.get_running_loop().run_in_executor(None, s.profile.dump_stats, path)
+    SLOW_TRACES.inc(s.name, "1" if path else "0")
+    print("慢 " + "\n".join(s.render()) + (f"\n  profile → {path}" if path else ""))
+
+def span_add(name: str, t0: float, **attrs):
+    """在当前 span 下记一个已经结束的子节点（Bot API 调用、等锁这类没有下一层的）"""
+    parent = CURRENT_SPAN.get()
+    if parent is not None:
+        s = Span(name, t0, attrs)
+        s.dur = perf_counter() - t0
+        parent.children.append(s)
+
+def timed(func):
+    """记录 handler 耗时到 bot_handler_seconds{handler=函数名}；异常计数后照常抛出；开了追踪时顺带开 span"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        t0 = perf_counter()
+        s = span_open(name, update_attrs(args)) if TRACE_SLOW_MS else None
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            if s is not None:
+                s.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            HANDLER_SECONDS.observe(name, perf_counter() - t0)
+            if s is not None:
+                span_close(s)
+            if not BOOT["first_update"] and args and isinstance(args[0], Update):
+                BOOT["first_update"] = monotonic() - BOOT["started"]
+    return wrapper
+
+class TimedRequest(BaseRequest):
+    """包住任意 BaseRequest（默认 HTTPXRequest，压测时是假 API），按 API 方法记录耗时和错误"""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        api = url.rsplit("/", 1)[-1]
+        t0 = perf_counter()
+        code = None
+        try:
+            code, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        except Exception as e:
+            API_ERRORS.inc(api, type(e).__name__)
+            code = type(e).__name__
+            raise
+        finally:
+            API_SECONDS.observe(api, perf_counter() - t0)
+            if TRACE_SLOW_MS:
+                span_add("api:" + api, t0, status=code)
+        if code != HTTPStatus.OK:
+            API_ERRORS.inc(api, str(code))
+        return code, payload
+
+# ========= 发送队列：全局 + 按群令牌桶，RetryAfter 不阻塞事件循环 =========
+PRIO_ALERT, PRIO_REMIND, PRIO_NORMAL, PRIO_HELP = 0, 1, 2, 3   # 数字越小越先发
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "ts", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.ts = now
+        self.blocked_until = 0.0
+
+    def take(self, now: float) -> float:
+        """有令牌就取走一个并返回 0；否则返回还要等多少秒"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+NO_PREVIEW = LinkPreviewOptions(is_disabled=True)
+
+class _Outgoing:
+    __slots__ = ("chat_id", "kwargs", "future", "on_sent", "enqueued", "attempts", "key", "guard", "method")
+
+    def __init__(self, chat_id: int, kwargs: dict, future: asyncio.Future,
+                 on_sent: Optional[Callable[[Message], Any]], enqueued: float,
+                 key: Optional[str] = None, guard: Optional[Sequence] = None, method: str = "send_message"):
+        self.method = method  # Bot 上的发送方法：send_message / send_document
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.on_sent = on_sent
+        self.enqueued = enqueued
+        self.attempts = 0
+        self.key = key        # 有 key 的记在 OutboxJournal 里，失败不丢、重启补发
+        self.guard = guard    # (uid, 打卡开始时间)：提醒类消息，那次打卡结束了就不用再发
+
+def _jline(rec: dict) -> str:
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+class OutboxJournal:
+    """
+    要紧消息的追加日志（OUTBOX_FILE，每行一个 JSON）：交给发送队列前写一条 add，发出 / 放弃后写一条 done。
+    - key 去重：同一个 key 还在等或 OUTBOX_MAX_AGE_HOURS 内发过的，不再发第二次
+    - 启动时读回，没有 done 的就是要补发的；读完压缩成只剩待发 + 近期 done（行数太多时运行中也压缩）
+    - 每行写完就 flush，进程崩了不丢；压缩时先写临时文件再替换
+    """
+
+    COMPACT_LINES = 20000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pending: Dict[str, dict] = {}   # key -> add 记录
+        self.done: Dict[str, float] = {}     # key -> 结束时间
+        self.lines = 0
+        self._compacted = 0   # 上次压缩后剩几行
+        self.stats = {"sent": 0, "failed": 0, "expired": 0, "stale": 0, "deduped": 0}
+        self._finished: deque = deque(maxlen=10000)   # 最近结束的时刻，算排空速度
+        self._load()
+        self.recovered = list(self.pending)   # 上次没发出去的，等 Outbox.replay() 重新排队
+        self._f = open(path, "a", encoding="utf-8")
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def _load(self):
+        try:
+            f = open(self.path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue   # 写到一半的尾巴
+                if rec["op"] == "add":
+                    if rec["key"] not in self.done:
+                        self.pending[rec["key"]] = rec
+                else:
+                    self.pending.pop(rec["key"], None)
+                    self.done[rec["key"]] = rec["ts"]
+        self._compact()
+
+    def _compact(self):
+        cutoff = CLOCK.time() - OUTBOX_MAX_AGE_HOURS * 3600
+        self.done = {key: ts for key, ts in self.done.items() if ts >= cutoff}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, ts in self.done.items():
+                f.write(_jline({"op": "done", "key": key, "ts": ts}))
+            for rec in self.pending.values():
+                f.write(_jline(rec))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.lines = self._compacted = len(self.done) + len(self.pending)
+
+    def _write(self, rec: dict):
+        self._f.write(_jline(rec))
+        self._f.flush()
+        self.lines += 1
+
+    def add(self, key: str, chat_id: int, text: str, prio: int, kwargs: dict, guard: Optional[Sequence]) -> bool:
+        """记一条待发；key 已经在等或近期发过时返回 False（调用方就不要再发了）"""
+        if key in self.pending or key in self.done:
+            self.stats["deduped"] += 1
+            return False
+        rec = {"op": "add", "key": key, "ts": round(CLOCK.time(), 3), "chat": chat_id, "text": text,
+               "prio": prio, "kw": kwargs, "guard": list(guard) if guard else None}
+        self.pending[key] = rec
+        self._write(rec)
+        return True
+
+    def finish(self, key: str, result: str):
+        """result：sent / failed（消息本身有问题）/ expired（太久没发出去）/ stale（打卡已结束）"""
+        if self.pending.pop(key, None) is None:
+            return
+        ts = round(CLOCK.time(), 3)
+        self.done[key] = ts
+        self._write({"op": "done", "key": key, "ts": ts, "result": result})
+        self.stats[result] += 1
+        self._finished.append(monotonic())
+
+    def expired(self, key: str) -> bool:
+        rec = self.pending.get(key)
+        return rec is not None and CLOCK.time() - rec["ts"] > OUTBOX_MAX_AGE_HOURS * 3600
+
+    def oldest_age(self) -> float:
+        return CLOCK.time() - min(rec["ts"] for rec in self.pending.values()) if self.pending else 0.0
+
+    def drain_rate(self, window: float = 60.0) -> float:
+        """最近 window 秒每秒结束（发出 / 放弃）多少条"""
+        since = monotonic() - window
+        return sum(1 for t in self._finished if t >= since) / window
+
+    def maintain(self):
+        """flush_events 顺带调用：上次压缩后又写了 COMPACT_LINES 行就再压缩一次"""
+        if self.lines - self._compacted > self.COMPACT_LINES:
+            self._f.close()
+            self._compact()
+            self._f = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        self._f.close()
+
+class Outbox:
+    """
+    所有 send_message 统一从这里走：
+    - 按优先级出队（管理员提醒 > 到时提醒 > 普通回复 > 乱输提示）
+    - 全局和每个群各一个令牌桶，群里的桶空了就把这条放到一边，不影响其它群
+    - RetryAfter 只让对应的群暂停 retry_after 秒，不 sleep 整个事件循环
+    - 网络错误 / 5xx 隔 2、4、8… 秒重试；普通消息试 MAX_ATTEMPTS 次，带 key 的（见 OutboxJournal）
+      一直重试到 OUTBOX_MAX_AGE_HOURS，重启后由 replay() 补发
+    submit() 返回 Future（结果为 Message，失败为 None），调用方一般不需要 await。
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, bot, rate: float = SEND_RATE_GLOBAL, per_chat_min: float = SEND_PER_CHAT_MIN,
+                 max_inflight: int = SEND_MAX_INFLIGHT):
+        self.bot = bot
+        self.rate = rate
+        self.per_chat_min = per_chat_min
+        self.max_inflight = max_inflight
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._queue: "asyncio.PriorityQueue[Tuple[int, int, _Outgoing]]" = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[int, TokenBucket] = {}
+        self._parked = 0
+        self._taking = 0   # 已出队、在等在途名额 / 全局令牌的那一条
+        self._inflight: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.waits: deque = deque(maxlen=1000)   # 最近的排队等待（秒）
+        self.stats = {"sent": 0, "failed": 0, "retry_after": 0, "retried": 0}
+        self.journal: Optional[OutboxJournal] = None
+        self.guard: Callable[[Sequence], bool] = lambda guard: True   # 提醒对应的打卡还在不在
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() + self._parked + self._taking + len(self._inflight)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._global = TokenBucket(self.rate, self.rate, loop.time())
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._task = loop.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        """先尽量发完，再停止"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.depth and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def submit(self, chat_id: int, text: str, prio: int = PRIO_NORMAL,
+               on_sent: Optional[Callable[[Message], Any]] = None, key: Optional[str] = None,
+               guard: Optional[Sequence] = None, **kwargs) -> asyncio.Future:
+        """key 不为空时先记日志（kwargs 要能转 JSON）；同一个 key 已经在等或发过，直接返回结果为 None 的 Future"""
+        if key is not None and self.journal is not None:
+            if not self.journal.add(key, chat_id, text, prio, kwargs, guard):
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(None)
+                return future
+        else:
+            key = None
+        return self._enqueue(chat_id, text, prio, on_sent, key, guard, kwargs)
+
+    def _enqueue(self, chat_id: int, text: str, prio: int, on_sent, key, guard, kwargs: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        kwargs = dict(kwargs, text=text)
+        kwargs.setdefault("parse_mode", constants.ParseMode.HTML)
+        kwargs.setdefault("link_preview_options", NO_PREVIEW)
+        return self._put(_Outgoing(chat_id, kwargs, loop.create_future(), on_sent, loop.time(), key, guard), prio)
+
+    def submit_document(self, chat_id: int, document: str, filename: str, prio: int = PRIO_NORMAL,
+                        **kwargs) -> asyncio.Future:
+        """发文件（/export）：和消息一起排队、限速、重试；document 给文件路径，Future 完成前别删"""
+        loop = asyncio.get_running_loop()
+        kwargs = dict(kwargs, document=document, filename=filename)
+        return self._put(_Outgoing(chat_id, kwargs, loop.create_future(), None, loop.time(),
+                                   method="send_document"), prio)
+
+    def _put(self, item: _Outgoing, prio: int) -> asyncio.Future:
+        self._queue.put_nowait((prio, next(self._seq), item))
+        if TRACE_SLOW_MS:
+            span_add("outbox", perf_counter(), prio=prio, depth=self.depth)
+        return item.future
+
+    def replay(self) -> Dict[str, int]:
+        """重启后把日志里还没发出的重新排队；太旧的、提醒对应的打卡已经结束的直接丢掉"""
+        counts = {"resent": 0, "expired": 0, "stale": 0}
+        recovered, self.journal.recovered = self.journal.recovered, []
+        for key in recovered:
+            rec = self.journal.pending.get(key)
+            if rec is None:
+                continue
+            if self.journal.expired(key):
+                result = "expired"
+            elif rec["guard"] and not self.guard(rec["guard"]):
+                result = "stale"
+            else:
+                self._enqueue(rec["chat"], rec["text"], rec["prio"], None, key, rec["guard"], rec["kw"])
+                counts["resent"] += 1
+                continue
+            self.journal.finish(key, result)
+            counts[result] += 1
+        return counts
+
+    def wait_stats(self) -> Dict[str, float]:
+        waits = sorted(self.waits)
+        if not waits:
+            return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+        return {
+            "p50": waits[len(waits) // 2],
+            "p99": waits[min(len(waits) - 1, int(len(waits) * 0.99))],
+            "max": waits[-1],
+        }
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_min / 60.0, self.per_chat_min, now)
+        return bucket
+
+    def _requeue(self, entry: tuple):
+        self._parked -= 1
+        self._queue.put_nowait(entry)
+
+    def _retry_later(self, entry: tuple, attempts: int):
+        self.stats["retried"] += 1
+        self._parked += 1
+        delay = min(SEND_RETRY_MAX, 2 ** attempts) * random.uniform(0.8, 1.2)
+        asyncio.get_running_loop().call_later(delay, self._requeue, entry)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            prio, seq, item = entry = await self._queue.get()
+            wait = self._bucket(item.chat_id, loop.time()).take(loop.time())
+            if wait > 0:
+                # 这个群暂时发不了：放到一边，到点再回队列（保持原优先级和顺序）
+                self._parked += 1
+                loop.call_later(wait, self._requeue, entry)
+                continue
+            self._taking = 1
+            await self._slots.acquire()   # 接口慢的时候不让在途请求无限堆积
+            while (wait := self._global.take(loop.time())) > 0:
+                await asyncio.sleep(wait)
+            self._taking = 0
+            task = loop.create_task(self._deliver(entry))
+            self._inflight.add(task)
+            task.add_done_callback(self._delivered)
+
+    def _delivered(self, task: asyncio.Task):
+        self._inflight.discard(task)
+        self._slots.release()
+
+    async def _deliver(self, entry: tuple):
+        loop = asyncio.get_running_loop()
+        prio, seq, item = entry
+        result = "sent"
+        try:
+            if item.attempts and item.key is not None:
+                # 重试了一阵才轮到：太久了或者打卡已经结束，就不发了
+                if self.journal.expired(item.key):
+                    raise _GiveUp("expired")
+                if item.guard and not self.guard(item.guard):
+                    raise _GiveUp("stale")
+            if item.method == "send_document":
+                with open(item.kwargs["document"], "rb") as f:   # 按文件流上传，重试时重新打开
+                    msg = await self.bot.send_document(chat_id=item.chat_id, **dict(item.kwargs, document=f))
+            else:
+                msg = await getattr(self.bot, item.method)(chat_id=item.chat_id, **item.kwargs)
+        except RetryAfter as e:
+            self.stats["retry_after"] += 1
+            # 429 不说是按群还是整个 bot 限的：两个一起停，别的群接着发只会再吃一串 429
+            until = loop.time() + float(getattr(e, "retry_after", 3))
+            for bucket in (self._bucket(item.chat_id, loop.time()), self._global):
+                bucket.blocked_until = max(bucket.blocked_until, until)
+            self._queue.put_nowait(entry)
+            return
+        except _GiveUp as e:
+            result, msg = e.args[0], None
+        except (BadRequest, Forbidden):
+            # 消息本身的问题（群没了、被踢、HTML 不对），重试也没用
+            self.stats["failed"] += 1
+            result, msg = "failed", None
+        except Exception:
+            item.attempts += 1
+            if item.key is not None or item.attempts < self.MAX_ATTEMPTS:
+                self._retry_later(entry, item.attempts)
+                return
+            self.stats["failed"] += 1
+            result, msg = "failed", None
+        else:
+            self.stats["sent"] += 1
+            self.waits.append(loop.time() - item.enqueued)
+        if item.key is not None:
+            self.journal.finish(item.key, result)
+        if not item.future.done():
+            item.future.set_result(msg)
+        if msg is not None and item.on_sent is not None:
             try:
-                await bot.send_message(
-                    chat_id=chat_id, text=chunk,
-                    parse_mode=constants.ParseMode.HTML,
-                    disable_web_page_preview=not preview
-                )
-                break
-            except RetryAfter as e:
-                from time import sleep
-                sleep(int(getattr(e, "retry_after", 3)))
+                item.on_sent(msg)
             except Exception:
-                if attempt == 1:
-                    pass
+                pass
 
-def all_trigger_words() -> Set[str]:
-    s: Set[str] = set()
-    for words in TRIGGERS.values():
-        s |= {w.lower() for w in words}
-    return s
+class _GiveUp(Exception):
+    pass
 
-START_RE = re.compile(r"^(" + "|".join(map(re.escape, sorted(all_trigger_words()))) + r")$", re.IGNORECASE)
-BACK_RE  = re.compile(r"^(回来|回|back|1)$", re.IGNORECASE)
+OUTBOX: Optional[Outbox] = None
 
-# ========= 删除提示类消息（打卡相关误操作 & 员工乱输提示） =========
-async def delete_help_messages(context: ContextTypes.DEFAULT_TYPE):
+def send(chat_id: int, text: str, prio: int = PRIO_NORMAL,
+         on_sent: Optional[Callable[[Message], Any]] = None, key: Optional[str] = None,
+         guard: Optional[Sequence] = None, **kwargs) -> asyncio.Future:
+    return OUTBOX.submit(chat_id, text, prio=prio, on_sent=on_sent, key=key, guard=guard, **kwargs)
+
+def reply(update: Update, text: str, prio: int = PRIO_NORMAL,
+          on_sent: Optional[Callable[[Message], Any]] = None) -> asyncio.Future:
+    """等同 message.reply_html，但经过发送队列"""
+    return send(
+        update.effective_chat.id, text, prio=prio, on_sent=on_sent,
+        reply_to_message_id=update.effective_message.id,
+        allow_sending_without_reply=True,
+    )
+
+async def fan_out(name: str, messages: List[Tuple[int, str]], prio: int = PRIO_NORMAL,
+                  key: Optional[str] = None) -> Tuple[int, float]:
+    """
+    多群群发：消息都先渲染好，一次全交给发送队列（并发和限速由 Outbox 管），等全部发完。
+    key 不为空时每条按 key:序号 记日志（发不出去会一直重试、重启补发），这时最多等 FANOUT_WAIT_SECONDS：
+    Bot API 挂着的时候不让换班任务一直挂着。
+    返回 (发出条数, 用时秒)，用时记到 bot_fanout_seconds{job=name}
     """
-    延迟删除类消息：
-    - user_msg_id：用户发的那条
-    - bot_msg_id：机器人回的那条
-    （这里不区分管理员，因为管理员不会走 text_help；走的是打卡相关误操作）
+    if not messages:
+        return 0, 0.0
+    t0 = perf_counter()
+    futures = [send(chat_id, text, prio=prio, key=key and f"{key}:{i}") for i, (chat_id, text) in enumerate(messages)]
+    done, pending = await asyncio.wait(futures, timeout=FANOUT_WAIT_SECONDS if key else None)
+    elapsed = perf_counter() - t0
+    FANOUT_SECONDS.observe(name, elapsed)
+    sent = sum(1 for f in done if f.result() is not None)
+    print(f"{name}：{len({chat_id for chat_id, _ in messages})} 个群 {len(messages)} 条，"
+          f"发出 {sent} 条，用时 {elapsed:.1f}s" + (f"，{len(pending)} 条还在发送日志里重试" if pending else ""))
+    return sent, elapsed
+
+# ========= 长消息切分：按行切，不切断 HTML 标签 / 实体 =========
+MESSAGE_CHARS = 3500   # 每段最多字符数（Telegram 单条 4096，留余量）
+_HTML_TOKEN = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>|&#?\w+;")
+
+def split_long_line(line: str, limit: int = MESSAGE_CHARS) -> List[str]:
     """
-    data = context.job.data or {}
-    chat_id = data.get("chat_id")
-    user_msg_id = data.get("user_msg_id")
-    bot_msg_id = data.get("bot_msg_id")
+    单行超长时才用：只在标签 / 实体之外切开，切点上还开着的标签在段尾补闭合、
+    下一段开头原样重新打开，保证每段都能单独按 HTML 解析
+    """
+    out: List[str] = []
+    stack: List[Tuple[str, str]] = []   # (标签名, 原始开标签)
+    cur = ""
+
+    def closing() -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+    def flush():
+        nonlocal cur
+        out.append(cur + closing())
+        cur = "".join(raw for _, raw in stack)
+
+    pos = 0
+    for m in itertools.chain(_HTML_TOKEN.finditer(line), (None,)):
+        text = line[pos:m.start() if m else len(line)]
+        while text:
+            room = limit - len(cur) - len(closing())
+            if room <= 0:
+                flush()
+                continue
+            cur, text = cur + text[:room], text[room:]
+            if text:
+                flush()
+        if m is None:
+            break
+        tok, name = m.group(0), (m.group(2) or "").lower()
+        extra = len(name) + 4 if name and not m.group(1) else 0   # 新开的标签留出闭合和至少一个字的位置
+        if len(cur) + len(tok) + len(closing()) + extra > limit:
+            flush()
+        cur += tok
+        if name and m.group(1):
+            if stack and stack[-1][0] == name:
+                stack.pop()
+        elif name:
+            stack.append((name, tok))
+        pos = m.end()
+    if cur:
+        out.append(cur + closing())
+    return out
+
+# ========= 管理员名单缓存（按群） =========
+ADMIN_CACHE: Dict[int, Tuple[float, Set[int]]] = {}
+ADMIN_CACHE_STATS = {"hit": 0, "miss": 0}
+_ADMIN_FETCHING: Dict[int, "asyncio.Task[Set[int]]"] = {}
+
+async def _fetch_admin_ids(chat) -> Set[int]:
+    admins = await chat.get_administrators()
+    ids = {m.user.id for m in admins}
+    ADMIN_CACHE[chat.id] = (CLOCK.monotonic(), ids)
+    return ids
+
+async def chat_admin_ids(chat) -> Set[int]:
+    """群管理员 ID 集合：缓存命中直接返回；过期/未命中时拉一次 get_chat_administrators"""
+    cached = ADMIN_CACHE.get(chat.id)
+    if cached and CLOCK.monotonic() - cached[0] < ADMIN_CACHE_TTL:
+        ADMIN_CACHE_STATS["hit"] += 1
+        return cached[1]
+    ADMIN_CACHE_STATS["miss"] += 1
+    # 同一个群同时多条消息未命中时只拉一次
+    task = _ADMIN_FETCHING.get(chat.id)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_admin_ids(chat))
+        _ADMIN_FETCHING[chat.id] = task
+        task.add_done_callback(lambda _t, cid=chat.id: _ADMIN_FETCHING.pop(cid, None))
+    return await asyncio.shield(task)
 
-    if not chat_id:
+async def is_admin(update: Update) -> bool:
+    chat = update.effective_chat
+    try:
+        if chat.type in (constants.ChatType.GROUP, constants.ChatType.SUPERGROUP):
+            return update.effective_user.id in await chat_admin_ids(chat)
+        member = await chat.get_member(update.effective_user.id)
+        return member.status in ("administrator", "creator")
+    except Exception:
+        return False
+
+@timed
+async def on_chat_member(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """成员权限变化：直接修正缓存，不用等 TTL 过期"""
+    cmu = update.chat_member
+    cached = ADMIN_CACHE.get(cmu.chat.id)
+    if not cached:
         return
+    member = cmu.new_chat_member
+    if member.status in ("administrator", "creator"):
+        cached[1].add(member.user.id)
+    else:
+        cached[1].discard(member.user.id)
+
+# ========= 进行中索引：chat_id → {uid → active} =========
+# /who 与换班只需看本群进行中的人，不必扫描全部 user_data
+ACTIVE_BY_CHAT: Dict[int, Dict[int, ActiveSession]] = {}
+
+def index_active(chat_id: int, uid: int, active: ActiveSession):
+    ACTIVE_BY_CHAT.setdefault(chat_id, {})[uid] = active
+
+def unindex_active(chat_id: Optional[int], uid: int):
+    sessions = ACTIVE_BY_CHAT.get(chat_id)
+    if sessions is None:
+        return
+    sessions.pop(uid, None)
+    if not sessions:
+        ACTIVE_BY_CHAT.pop(chat_id, None)
+
+def rebuild_active_index(app: Application):
+    """启动时从持久化数据重建索引（只在启动时扫描一次）；还冷着的人没有进行中的打卡（见 hydrate_users）"""
+    ACTIVE_BY_CHAT.clear()
+    for uid, ud in app.user_data.items():
+        if not ud.is_cold and ud.active and ud.last_chat_id:
+            index_active(ud.last_chat_id, uid, ud.active)
+
+# ========= 超时/宽限提醒：一个到期堆 + 一个调度协程 =========
+class DeadlineHeap:
+    """
+    所有提醒共用一个小顶堆，只有一个协程睡到最早的到期时间：
+    条目 (到期时间戳, 序号, kind, uid, chat_id, token)，token 是开始时间戳。
+    结束打卡不用从堆里删，到期时 token 对不上 active 就直接跳过。
+    """
+
+    def __init__(self, fire: Callable[[str, int, int, float], Awaitable[None]]):
+        self._fire = fire
+        self._heap: List[Tuple[float, int, str, int, int, float]] = []
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, due: float, kind: str, uid: int, chat_id: int, token: float):
+        heapq.heappush(self._heap, (due, next(self._seq), kind, uid, chat_id, token))
+        if self._wake is not None and self._heap[0][0] == due:
+            self._wake.set()
+
+    def pop_due(self, now: float) -> List[Tuple[str, int, int, float]]:
+        out = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, kind, uid, chat_id, token = heapq.heappop(self._heap)
+            out.append((kind, uid, chat_id, token))
+        return out
+
+    def next_due(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    async def fire_due(self, now: float) -> int:
+        """发出所有到期的提醒，返回条数（调度协程和回放共用）"""
+        entries = self.pop_due(now)
+        for entry in entries:
+            try:
+                await self._fire(*entry)
+            except Exception:
+                pass
+        return len(entries)
+
+    def clear(self):
+        self._heap.clear()
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = CLOCK.time()
+            await self.fire_due(now)
+            self._wake.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-    # 先删机器人自己的那条
-    if bot_msg_id:
+TIMERS: Optional[DeadlineHeap] = None
+
+def schedule_reminders(uid: int, chat_id: int, active: ActiveSession, grace: int):
+    """按 active 的开始时间 + 上限安排两条提醒（宽限 grace 分钟后提醒管理员）；已经发过的不再安排"""
+    token = active.start
+    due = token + int(active.limit) * 60
+    if not active.reminded:
+        TIMERS.push(due, "timeout", uid, chat_id, token)
+    if not active.graced:
+        TIMERS.push(due + grace * 60, "grace", uid, chat_id, token)
+
+def rebuild_timers(app: Application):
+    """启动时从持久化的 active 重建所有提醒；已过期的会在调度协程第一轮立刻发出"""
+    TIMERS.clear()
+    for chat_id, sessions in ACTIVE_BY_CHAT.items():
+        grace = chat_policy(app, chat_id).grace
+        for uid, active in sessions.items():
+            schedule_reminders(uid, chat_id, active, grace)
+
+# ========= 启动：用户后台分批解码 =========
+HYDRATION: Optional[asyncio.Task] = None
+
+def _decode_active(blobs: List[bytes]) -> List[Tuple[int, UserState]]:
+    """在线程里解码一批用户，只留下有进行中打卡的 (下标, 解好的对象)；其余的解完就扔"""
+    out = []
+    for i, blob in enumerate(blobs):
+        ud = UserState.from_record(pickle.loads(blob))
+        if ud.active is not None:
+            out.append((i, ud))
+    return out
+
+async def hydrate_users(app: Application, cold: List[UserState], chunk: int = HYDRATE_CHUNK):
+    """
+    启动后在后台找出有进行中打卡的人：反序列化在线程里做，只有这些人就地换成热对象，
+    其余的人继续冷着，来更新时由 refresh_user_data 再解。全都解热的话每人多出近十个 GC 跟踪的对象，
+    十万人时一次整堆回收要两三百毫秒，分多小的批都躲不开。
+    扫完再重建进行中索引和提醒（这一步中间没有 await，和 handler 不会交错）
+    """
+    for i in range(0, len(cold), chunk):
+        part = [ud for ud in cold[i:i + chunk] if ud.is_cold]
+        for j, warm in await asyncio.to_thread(_decode_active, [ud._blob for ud in part]):
+            part[j].hydrate(warm)
+    rebuild_active_index(app)
+    rebuild_timers(app)
+
+# ========= 删除消息：待删堆持久化在 bot_data，定时按群批量 deleteMessages =========
+def pending_deletes(app: Application) -> List[Tuple[float, int, int]]:
+    """(到期时间戳, chat_id, message_id) 小顶堆；随 bot_data 落盘，重启后继续删"""
+    return app.bot_data.setdefault("pending_deletes", [])
+
+def schedule_delete(app: Application, chat_id: int, message_ids, delay: float):
+    due = CLOCK.time() + delay
+    heap = pending_deletes(app)
+    for mid in message_ids:
+        if mid:
+            heapq.heappush(heap, (due, chat_id, mid))
+
+async def delete_batch(bot, chat_id: int, message_ids: List[int]):
+    """一次 deleteMessages 最多 100 条；批量失败时退回逐条删除"""
+    for i in range(0, len(message_ids), 100):
+        chunk = message_ids[i:i+100]
         try:
-            await context.bot.delete_message(chat_id, bot_msg_id)
+            await bot.delete_messages(chat_id, chunk)
         except Exception:
-            pass
+            for mid in chunk:
+                try:
+                    await bot.delete_message(chat_id, mid)
+                except Exception:
+                    pass
 
-    # 再删用户那条
-    if user_msg_id:
+@timed
+async def sweep_deletes(context: ContextTypes.DEFAULT_TYPE):
+    heap = pending_deletes(context.application)
+    now = CLOCK.time()
+    due: Dict[int, List[int]] = {}
+    while heap and heap[0][0] <= now:
+        _, chat_id, mid = heapq.heappop(heap)
+        due.setdefault(chat_id, []).append(mid)
+    if due:
+        await asyncio.gather(*(delete_batch(context.bot, chat_id, ids) for chat_id, ids in due.items()))
+
+# ========= 并发：同一用户 / 同一群串行 =========
+class KeyedLocks:
+    """按 key 分配 asyncio.Lock，没人等的锁用完即回收"""
+
+    def __init__(self):
+        self._locks: Dict[Any, List[Any]] = {}   # key -> [Lock, 使用中的协程数]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        t0 = perf_counter()
         try:
-            await context.bot.delete_message(chat_id, user_msg_id)
-        except Exception:
-            pass
+            async with entry[0]:
+                if TRACE_SLOW_MS:
+                    span_add("lock", t0, key=key, waiters=entry[1] - 1)
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+USER_LOCKS = KeyedLocks()
+CHAT_LOCKS = KeyedLocks()
+
+def per_user(func):
+    """同一个用户的 开始/结束 串行执行（双击“回来”、开始和回来同时到达）"""
+    @functools.wraps(func)
+    async def wrapper(update: Update, ctx: ContextTypes.DEFAULT_TYPE, *args):
+        async with USER_LOCKS.hold(update.effective_user.id):
+            return await func(update, ctx, *args)
+    return wrapper
+
+def per_chat(func):
+    """同一个群的管理命令串行执行"""
+    @functools.wraps(func)
+    async def wrapper(update: Update, ctx: ContextTypes.DEFAULT_TYPE, *args):
+        async with CHAT_LOCKS.hold(update.effective_chat.id):
+            return await func(update, ctx, *args)
+    return wrapper
+
+# ========= 历史记录：按月分段的追加日志（mmap 读）+ 按班 / 按天汇总 =========
+EVENT_REC = struct.Struct("<qqdIBBxx")   # uid, chat_id, 开始时间戳, 用时秒, 类型, 标志 —— 每条 32 字节
+EVENT_KINDS = KINDS                         # 下标写进记录里，顺序不能改
+EV_OVERTIME, EV_SHORT = 1, 2             # 超时 / 低于最小时长（不计入汇总）
+
+def _empty_rollup() -> dict:
+    # {"day"|"shift": {chat: {日期 / 日期+班次: {uid: {类型: [次数, 秒数, 超时次数]}}}}}，键都是字符串（可直接存 JSON）
+    return {"day": {}, "shift": {}}
+
+def _add_to_rollup(roll: dict, uid: int, chat_id: int, kind: str, start: float, dur: int, flags: int):
+    if flags & EV_SHORT:
+        return
+    day, shift = shift_of(start)
+    over = 1 if flags & EV_OVERTIME else 0
+    for level, key in (("day", day), ("shift", day + shift)):
+        per_user = roll[level].setdefault(str(chat_id), {}).setdefault(key, {}).setdefault(str(uid), {})
+        c = per_user.get(kind)
+        if c is None:
+            per_user[kind] = [1, dur, over]
+        else:
+            c[0] += 1
+            c[1] += dur
+            c[2] += over
+
+class EventLog:
+    """
+    每次结束的打卡追加一条定长记录到 events/YYYY-MM.seg（按班次日期分月）。
+    - 汇总按月缓存在内存，写入时增量更新；查询只看汇总，不扫原始记录
+    - 冷启动 / 首次查询某月时用 mmap 扫一遍该月分段重建汇总
+    - 已结束的月份汇总另存 YYYY-MM.roll.json，下次直接读
+    - 多进程时每个 worker 只写自己的 YYYY-MM.s1of4.seg，读的时候该月所有分段都读
+    """
+
+    def __init__(self, directory: str = EVENT_DIR, tag: str = ""):
+        self.dir = directory
+        self.tag = tag
+        os.makedirs(directory, exist_ok=True)
+        self._files: Dict[str, Any] = {}
+        self._rollups: Dict[str, dict] = {}
+        self._building = threading.Lock()   # 冷月份在线程里重建时，别和事件循环上的 append 各建一份互相覆盖
+
+    def _seg_path(self, month: str) -> str:
+        return os.path.join(self.dir, f"{month}{self.tag}.seg")
+
+    def _seg_paths(self, month: str) -> List[str]:
+        return sorted(glob.glob(os.path.join(glob.escape(self.dir), f"{month}*.seg")))
+
+    def _roll_path(self, month: str) -> str:
+        return os.path.join(self.dir, f"{month}.roll.json")
+
+    def append(self, uid: int, chat_id: int, kind: str, start: float, dur: int, flags: int = 0):
+        month = shift_of(start)[0][:7]
+        roll = self.rollup(month)
+        fh = self._files.get(month)
+        if fh is None:
+            fh = self._files[month] = open(self._seg_path(month), "ab")
+            try:
+                os.remove(self._roll_path(month))   # 跨月的夜班补写进旧月份，旧汇总作废
+            except FileNotFoundError:
+                pass
+        fh.write(EVENT_REC.pack(uid, chat_id, start, max(0, int(dur)), EVENT_KINDS.index(kind), flags))
+        _add_to_rollup(roll, uid, chat_id, kind, start, int(dur), flags)
+
+    def flush(self):
+        for fh in self._files.values():
+            fh.flush()
+
+    def close(self):
+        for fh in self._files.values():
+            fh.close()
+        self._files.clear()
+
+    def scan(self, month: str):
+        """mmap 逐条读出某月的原始记录：(uid, chat_id, kind, start, dur, flags)"""
+        fh = self._files.get(month)
+        if fh is not None:
+            fh.flush()
+        for path in self._seg_paths(month):
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                size -= size % EVENT_REC.size   # 写到一半的尾巴忽略
+                if not size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    view = memoryview(mm)
+                    try:
+                        for uid, chat_id, start, dur, k, flags in EVENT_REC.iter_unpack(view[:size]):
+                            yield uid, chat_id, EVENT_KINDS[k], start, dur, flags
+                    finally:
+                        view.release()
+
+    def rollup(self, month: str) -> dict:
+        roll = self._rollups.get(month)
+        if roll is not None:
+            return roll
+        with self._building:
+            roll = self._rollups.get(month)
+            if roll is None:
+                roll = self._rollups[month] = self._build_rollup(month)
+        return roll
+
+    def preload(self, first: str, last: str):
+        """把 first~last 各月的汇总先建好（要扫分段文件，放线程里调）；之后读汇总都在事件循环上"""
+        for month in _months_between(first, last):
+            self.rollup(month)
+
+    def _build_rollup(self, month: str) -> dict:
+        segs, side = self._seg_paths(month), self._roll_path(month)
+        if month not in self._files and segs and os.path.exists(side) \
+                and os.path.getmtime(side) >= max(map(os.path.getmtime, segs)):
+            with open(side, encoding="utf-8") as f:
+                roll = json.load(f)
+        else:
+            roll = _empty_rollup()
+            for uid, chat_id, kind, start, dur, flags in self.scan(month):
+                _add_to_rollup(roll, uid, chat_id, kind, start, dur, flags)
+            # 两天前就结束的月份不会再有新记录，存一份汇总（几个 worker 可能同时写，先写临时文件再替换）
+            if self._closed(month) and segs:
+                tmp = f"{side}.{os.getpid()}"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(roll, f, separators=(",", ":"))
+                os.replace(tmp, side)
+        return roll
+
+    @staticmethod
+    def _closed(month: str) -> bool:
+        return (datetime.fromtimestamp(CLOCK.time(), LOCAL_TZ) - timedelta(days=2)).strftime("%Y-%m") > month
+
+    def frozen(self, month: str) -> bool:
+        """已经结束、这个进程也没在往里写的月份：汇总不会再变，线程里可以直接读"""
+        return self._closed(month) and month not in self._files
+
+    def shifts(self, chat_id: int, lo: str, hi: str, month: str):
+        """逐班产出这个群 lo~hi 的 (班次, [(uid, 类型, 次数, 秒数, 超时), ...])，一次只展开一个班；只对 frozen 的月份在线程里用"""
+        by_key = self.rollup(month)["shift"].get(str(chat_id), {})
+        for key in sorted(by_key):
+            if lo <= key <= hi:
+                yield key, _shift_rows(by_key[key], by_key[key])
+
+    def summarize(self, chat_id: int, level: str, lo: str, hi: str) -> Dict[int, Dict[str, List[int]]]:
+        """
+        level="day" 时 lo/hi 是日期，"shift" 时是 日期+D/N；闭区间。
+        直接遍历内存里的汇总，只能在事件循环上调（append 也在这里改它们）
+        """
+        out: Dict[int, Dict[str, List[int]]] = {}
+        for month in _months_between(lo[:7], hi[:7]):
+            by_key = self.rollup(month)[level].get(str(chat_id), {})
+            for key, users in by_key.items():
+                if not (lo <= key <= hi):
+                    continue
+                for uid, kinds in users.items():
+                    acc = out.setdefault(int(uid), {})
+                    for kind, (c, d, o) in kinds.items():
+                        t = acc.setdefault(kind, [0, 0, 0])
+                        t[0] += c
+                        t[1] += d
+                        t[2] += o
+        return out
+
+    async def snapshot(self, chat_id: int, lo: str, hi: str, month: str,
+                       chunk: int = 500) -> List[Tuple[str, List[tuple]]]:
+        """
+        事件循环上调（先 preload）：把还在写的月份里这个群 lo~hi 各班的汇总拷成 shifts 那样的行，交给线程用。
+        每拷 chunk 个人让一下事件循环；键先取成列表，中途 append 加了人 / 班次也不会打断遍历。
+        拷成只含数字和字符串的元组：GC 不跟踪，拷很多行也不会引来整堆回收
+        """
+        by_key = self.rollup(month)["shift"].get(str(chat_id), {})
+        out = []
+        for key in sorted(k for k in by_key if lo <= k <= hi):
+            users = by_key[key]
+            uids = sorted(users, key=int)
+            rows: List[tuple] = []
+            for i in range(0, len(uids), chunk):
+                rows += _shift_rows(users, uids[i:i + chunk])
+                await asyncio.sleep(0)
+            out.append((key, rows))
+        return out
+
+def _shift_rows(users: dict, uids) -> List[tuple]:
+    """一个班的汇总 {uid: {类型: [次数, 秒数, 超时]}} 里这些人 → [(uid, 类型, 次数, 秒数, 超时), ...]，按 uid 排好"""
+    out = []
+    for uid in sorted(uids, key=int):
+        kinds = users[uid]
+        out += [(int(uid), kind, *kinds[kind]) for kind in KINDS if kind in kinds]
+    return out
+
+def _months_between(first: str, last: str) -> List[str]:
+    y, m = int(first[:4]), int(first[5:7])
+    out = []
+    while f"{y:04d}-{m:02d}" <= last:
+        out.append(f"{y:04d}-{m:02d}")
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return out
+
+EVENTS: Optional[EventLog] = None
+EVENTS_WARM: Optional[asyncio.Task] = None   # 启动后在线程里建当月汇总，不挡着启动
+
+async def events_ready():
+    """要整段读汇总的地方先等当月汇总建好：没建好时在事件循环上读会卡在 _building 锁上，直到线程扫完"""
+    if EVENTS_WARM is not None:
+        await EVENTS_WARM
+
+async def flush_events(context: ContextTypes.DEFAULT_TYPE):
+    if EVENTS is not None:
+        EVENTS.flush()
+    if RECORDER is not None:
+        RECORDER.flush()
+    if OUTBOX is not None and OUTBOX.journal is not None:
+        OUTBOX.journal.maintain()
+
+# ========= 录制：收到的 Update 原样记下来，离线按模拟时钟回放 =========
+class UpdateRecorder:
+    """
+    每行一条 [到达时间戳, Update JSON]，gzip 追加写；
+    每次启动追加一个新的 gzip 段，段首尾相接仍是合法的 gzip 文件。
+    作为 group -1 的 TypeHandler 挂上，所有更新先经过这里再进正常的 handler
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._f = gzip.open(path, "at", encoding="utf-8", compresslevel=6)
+
+    async def __call__(self, update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        self.write(CLOCK.time(), update.to_dict())
+
+    def write(self, ts: float, data: dict):
+        self._f.write(json.dumps([round(ts, 3), data], ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.count += 1
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+def read_recording(path: str):
+    """逐条产出 (到达时间戳, Update dict)"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                ts, data = json.loads(line)
+                yield ts, data
+
+RECORDER: Optional[UpdateRecorder] = None
+
+# ========= 本班按群汇总：end_session 增量更新，/summary 直接读 =========
+SUMMARY_PAGE_CHARS = 3500   # 每页最多字符数（Telegram 单条 4096）
+SUMMARY_CACHE: Dict[int, Tuple[str, int, List[str]]] = {}   # chat_id -> (班次编号, 版本, 分页文本)
+
+def chat_shift_agg(app: Application, chat_data: dict, chat_id: int) -> dict:
+    """
+    chat_data["shift_agg"] = {"epoch", "version", "users": {uid: {类型: [次数, 秒数]}}, "totals": {类型: [次数, 秒数]}}
+    换班后自动换成空表；没有这张表（新群 / 刚升级）时从历史记录里本班的汇总补建一次。
+    end_session 要在记这一次之前取，否则补建时已经算进去了、随后又加一遍
+    """
+    epoch = shift_epoch()
+    agg = chat_data.get("shift_agg")
+    if agg is not None and agg["epoch"] == epoch:
+        return agg
+    seed = agg is None
+    agg = chat_data["shift_agg"] = {"epoch": epoch, "version": 0, "users": {}, "totals": {}}
+    if seed and EVENTS is not None:
+        for uid, kinds in EVENTS.summarize(chat_id, "shift", epoch, epoch).items():
+            for kind, (n, dur, _) in kinds.items():
+                add_to_chat_agg(agg, uid, kind, dur, n)
+    return agg
+
+def add_to_chat_agg(agg: dict, uid: int, kind: str, dur: int, count: int = 1):
+    for bucket in (agg["users"].setdefault(uid, {}), agg["totals"]):
+        c = bucket.setdefault(kind, [0, 0])
+        c[0] += count
+        c[1] += dur
+    agg["version"] += 1
+
+def paginate(header: str, lines: List[str], limit: int = SUMMARY_PAGE_CHARS) -> List[str]:
+    """按行分页，不把一行（和里面的 HTML 标签）切开，超长的单行见 split_long_line；多页时标题带（第几页/共几页）"""
+    pages: List[List[str]] = []
+    cur: List[str] = []
+    size = len(header)
+    room = limit - len(header) - 12   # 留出（第几页/共几页）
+    for line in itertools.chain.from_iterable(
+        split_long_line(line, room) if len(line) > room else (line,) for line in lines
+    ):
+        if cur and size + len(line) + 1 > limit:
+            pages.append(cur)
+            cur, size = [], len(header)
+        cur.append(line)
+        size += len(line) + 1
+    if cur:
+        pages.append(cur)
+    n = len(pages)
+    return [header + (f"（{i}/{n}）" if n > 1 else "") + "\n" + "\n".join(p) for i, p in enumerate(pages, 1)]
+
+def fmt_kinds(kinds: Dict[str, List[int]]) -> str:
+    """{类型: [次数, 秒数(, 超时次数)]} → “抽烟 2 次 / 3分00秒；厕所 …”"""
+    per = []
+    for k in ("smoke", "toilet", "meal"):
+        if k in kinds:
+            c, d, *rest = kinds[k]
+            over = rest[0] if rest else 0
+            per.append(f"{TITLES[k]} <b>{c}</b> 次 / {fmt_dur_mmss(d)}" + (f"（超时 <b>{over}</b>）" if over else ""))
+    return "；".join(per)
+
+def live_summary_pages(app: Application, chat_data: dict, chat_id: int) -> List[str]:
+    """本班汇总；这个群的统计没变就直接用上次排好的文本"""
+    agg = chat_shift_agg(app, chat_data, chat_id)
+    cached = SUMMARY_CACHE.get(chat_id)
+    if cached and cached[0] == agg["epoch"] and cached[1] == agg["version"]:
+        return cached[2]
+    if not agg["users"]:
+        pages = ["暂无数据。"]
+    else:
+        lines = [f"合计：{fmt_kinds(agg['totals'])}"]
+        lines += [f"• {mention_id_html(uid, '这位同事')} — {fmt_kinds(kinds)}" for uid, kinds in agg["users"].items()]
+        pages = paginate(f"📊 本{SHIFT_NAMES[agg['epoch'][-1]]}汇总（按用户）：", lines)
+    SUMMARY_CACHE[chat_id] = (agg["epoch"], agg["version"], pages)
+    return pages
+
+def reply_pages(update: Update, pages: List[str]):
+    """第一页回复命令，后面的页接着发（同优先级按顺序出队）"""
+    reply(update, pages[0])
+    for page in pages[1:]:
+        send(update.effective_chat.id, page)
 
 # ========= 开始 / 结束 / 提醒 =========
-async def begin(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str):
+@timed
+@per_user
+async def begin(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str, policy: Optional[Policy] = None):
     """开始打卡：记录 active + 安排超时提醒 + 记录消息ID，方便结束时删除"""
     user = update.effective_user
     chat = update.effective_chat
     msg  = update.effective_message
-    if kind not in LIMITS:
+    if kind not in KIND_INDEX:
         return
+    policy = policy or POLICIES.get(chat.id, ctx.chat_data)
 
-    ud = ctx.user_data
+    ud: UserState = ctx.user_data
 
     # 已有进行中的打卡：提示 + 定时删除（打卡相关误操作）
-    if ud.get("active"):
-        notice = await msg.reply_html(
-            f"{mention_user_html(user)} 已有进行中的打卡，请先发送“回来/回/back/1”或 /back 结束。"
-        )
-        ctx.job_queue.run_once(
-            delete_help_messages,
-            when=HELP_DELETE_MINUTES * 60,
-            data={
-                "chat_id": chat.id,
-                "user_msg_id": msg.id,
-                "bot_msg_id": notice.message_id,
-            },
-            name=f"del-already-{chat.id}-{msg.id}",
+    if ud.active:
+        reply(
+            update,
+            f"{mention_user_html(user)} 已有进行中的打卡，请先发送“回来/回/back/1”或 /back 结束。",
+            prio=PRIO_HELP,
+            on_sent=lambda notice: schedule_delete(
+                ctx.application, chat.id, (notice.message_id, msg.id), HELP_DELETE_MINUTES * 60
+            ),
         )
         return
 
-    stats = ensure_stats_for_chat(ud, chat.id)
-    today_count = stats[kind]["count"]
-    limit_count = LIMITS_COUNT.get(kind, 0)
+    i = KIND_INDEX[kind]
+    today_count = ud.counters(chat.id).count[i]
+    limit_count = policy.counts[kind]
     if limit_count and today_count >= limit_count:
-        await msg.reply_html(
-            f"{mention_user_html(user)} 本{current_shift_label()}次数已达上限 <b>{limit_count}</b> 次。"
-        )
+        reply(update, f"{mention_user_html(user)} 本{current_shift_label()}次数已达上限 <b>{limit_count}</b> 次。")
         return
 
-    last_end_ts = ud.get(f"last_end_{kind}")
+    now_ts = CLOCK.time()
+    last_end_ts = ud.last_end[i]
     if last_end_ts:
-        delta_min = (datetime.now(timezone.utc).timestamp() - last_end_ts) / 60.0
-        if delta_min < COOLDOWN_MIN.get(kind, 0):
-            need = int(COOLDOWN_MIN.get(kind, 0))
-            await msg.reply_html(
-                f"{mention_user_html(user)} 刚结束不久，{TITLES[kind]} 冷却 <b>{need}</b> 分钟内请勿重复开始。"
-            )
+        delta_min = (now_ts - last_end_ts) / 60.0
+        if delta_min < policy.cooldown[kind]:
+            need = int(policy.cooldown[kind])
+            reply(update, f"{mention_user_html(user)} 刚结束不久，{TITLES[kind]} 冷却 <b>{need}</b> 分钟内请勿重复开始。")
             return
 
-    limit = LIMITS[kind]
-    ud["active"] = {
-        "type":  kind,
-        "title": TITLES[kind],
-        "start": datetime.now(timezone.utc),
-        "limit": limit,
-    }
-    ud["last_chat_id"] = chat.id
-    ud["_last_seen"] = datetime.now(timezone.utc).timestamp()
+    limit = policy.limits[kind]
+    active = ud.active = ActiveSession(kind, now_ts, limit)
+    unindex_active(ud.last_chat_id, user.id)
+    ud.last_chat_id = chat.id
+    index_active(chat.id, user.id, active)
+    ud.last_seen = now_ts
 
     # 记录用户名 & 超时时用 @username
-    ud["user_username"] = getattr(user, "username", None)
-    ud["user_link"] = mention_user_html(user)
+    ud.username = getattr(user, "username", None)
+    ud.name = getattr(user, "full_name", None) or getattr(user, "first_name", None)
 
-    # 取消旧提醒
-    for key in ("reminder_job", "grace_job"):
-        job: Optional[Any] = ud.get(key)
-        if job:
-            try:
-                job.schedule_removal()
-            except Exception:
-                pass
-        ud[key] = None
-
-    # 超时提醒本人
-    run_at = datetime.now(timezone.utc) + timedelta(minutes=limit)
-    ud["reminder_job"] = ctx.job_queue.run_once(
-        remind_timeout, when=run_at,
-        data={"uid": user.id, "chat_id": chat.id},
-        name=f"remind-{user.id}",
-    )
-    # 宽限后提醒管理员
-    ud["grace_job"] = ctx.job_queue.run_once(
-        remind_grace, when=run_at + timedelta(minutes=GRACE_MINUTES),
-        data={"uid": user.id, "chat_id": chat.id},
-        name=f"grace-{user.id}",
-    )
+    # 超时提醒本人 + 宽限后提醒管理员（旧提醒 token 对不上，会自动失效）
+    schedule_reminders(user.id, chat.id, active, policy.grace)
 
     if chat_is_muted(ctx, chat.id):
         return
 
     # 发送开始提示，并记录双方消息 ID，方便结束时删除
-    sent = await ctx.bot.send_message(
-        chat_id=chat.id,
-        text=(f"{mention_user_html(user)} 开始计时（上限 {limit} 分）。\n"
-              f"📊 本{current_shift_label()} {TITLES[kind]} 已 <b>{today_count}</b> 次 / 限制 <b>{limit_count}</b> 次。\n"
-              f"回来后发送“回来/回/back/1”或使用 /back 结束。"),
-        disable_web_page_preview=True,
-        reply_to_message_id=msg.id,
-    )
+    active.user_msg_id = msg.id
+
+    def remember_bot_msg(sent: Message):
+        active.bot_msg_id = sent.message_id
 
-    ud["start_user_msg_id"] = msg.id          # 你发的 wc/抽烟/吃饭
-    ud["start_bot_msg_id"]  = sent.message_id # 机器人“开始计时”
+    reply(
+        update,
+        (f"{mention_user_html(user)} 开始计时（上限 {limit} 分）。\n"
+         f"📊 本{current_shift_label()} {TITLES[kind]} 已 <b>{today_count}</b> 次 / 限制 <b>{limit_count}</b> 次。\n"
+         f"回来后发送“回来/回/back/1”或使用 /back 结束。"),
+        on_sent=remember_bot_msg,
+    )
 
-async def end_session(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+@timed
+@per_user
+async def end_session(update: Update, ctx: ContextTypes.DEFAULT_TYPE, policy: Optional[Policy] = None):
     """结束打卡：删除 3 条消息 + 统计本次时长 + 累积次数/分钟"""
     user = update.effective_user
     chat = update.effective_chat
     msg  = update.effective_message
 
-    ud = ctx.user_data
-    active = ud.get("active")
+    ud: UserState = ctx.user_data
+    active = ud.active
 
     # 当前没有进行中的打卡：提示 + 自动删除两条（打卡相关误操作）
     if not active:
-        notice = await msg.reply_html(f"{mention_user_html(user)} 当前没有进行中的打卡。")
-        ctx.job_queue.run_once(
-            delete_help_messages,
-            when=HELP_DELETE_MINUTES * 60,
-            data={
-                "chat_id": chat.id,
-                "user_msg_id": msg.id,
-                "bot_msg_id": notice.message_id,
-            },
-            name=f"del-noactive-{chat.id}-{msg.id}",
+        reply(
+            update,
+            f"{mention_user_html(user)} 当前没有进行中的打卡。",
+            prio=PRIO_HELP,
+            on_sent=lambda notice: schedule_delete(
+                ctx.application, chat.id, (notice.message_id, msg.id), HELP_DELETE_MINUTES * 60
+            ),
         )
         return
 
     # 先删 3 条消息：开始指令 + 开始提示 + 回来（管理员也一样删）
-    start_user_msg_id = ud.pop("start_user_msg_id", None)
-    start_bot_msg_id  = ud.pop("start_bot_msg_id", None)
-    back_msg_id       = msg.id
-
-    for mid in (start_user_msg_id, start_bot_msg_id, back_msg_id):
-        if not mid:
-            continue
-        try:
-            await ctx.bot.delete_message(chat.id, mid)
-        except Exception:
-            pass
-
-    # 取消超时/宽限提醒
-    for key in ("reminder_job", "grace_job"):
-        job: Optional[Any] = ud.get(key)
-        if job:
-            try:
-                job.schedule_removal()
-            except Exception:
-                pass
-        ud[key] = None
+    ids = [mid for mid in (active.user_msg_id, active.bot_msg_id, msg.id) if mid]
+    ctx.application.create_task(delete_batch(ctx.bot, chat.id, ids), update=update)
 
-    now = datetime.now(timezone.utc)
-    start: datetime = active["start"]
-    used_sec = int((now - start).total_seconds())
-    limit_min = int(active["limit"])
+    now_ts = CLOCK.time()
+    used_sec = int(now_ts - active.start)
+    limit_min = int(active.limit)
     used_min, used_sec_rem = divmod(used_sec, 60)
-    title = active.get("title", "打卡")
-    key   = active["type"]
+    title = active.title
+    key   = active.kind
 
-    stats = ensure_stats_for_chat(ud, chat.id)
+    stats = ud.counters(chat.id)
+    agg = chat_shift_agg(ctx.application, ctx.chat_data, chat.id)
+
+    unindex_active(ud.last_chat_id, user.id)
+    ud.active = None
+    ud.last_seen = now_ts
 
     # 未达最小时长：不计入统计、不开冷却
-    if used_sec < MIN_SECONDS.get(key, 0):
-        ud.pop("active", None)
-        ud["_last_seen"] = now.timestamp()
+    policy = policy or POLICIES.get(chat.id, ctx.chat_data)
+    if used_sec < policy.min_seconds[key]:
+        if EVENTS is not None:
+            EVENTS.append(user.id, chat.id, key, active.start, used_sec, EV_SHORT)
         if not chat_is_muted(ctx, chat.id):
-            await ctx.bot.send_message(
-                chat_id=chat.id,
-                text=(f"{mention_user_html(user)} 本次用时 {used_min}分{used_sec_rem:02d}秒，"
-                      f"低于最小时长（{MIN_SECONDS.get(key,0)} 秒），不计入统计。"),
-                parse_mode=constants.ParseMode.HTML,
-                disable_web_page_preview=True,
-            )
+            send(chat.id, (f"{mention_user_html(user)} 本次用时 {used_min}分{used_sec_rem:02d}秒，"
+                           f"低于最小时长（{policy.min_seconds[key]} 秒），不计入统计。"),
+                 key=f"end:{user.id}:{active.start}")
         return
 
     # 正常计入统计 + 记录冷却起点
-    stats[key]["count"] += 1
-    stats[key]["dur"]   += used_sec
-    ud.pop("active", None)
-    ud[f"last_end_{key}"] = now.timestamp()
-    ud["_last_seen"] = now.timestamp()
-
-    today_count = stats[key]["count"]
-    today_total_sec = stats[key]["dur"]
+    stats.add(key, used_sec)
+    add_to_chat_agg(agg, user.id, key, used_sec)
+    i = KIND_INDEX[key]
+    ud.last_end[i] = now_ts
+
+    today_count = stats.count[i]
+    today_total_sec = stats.dur[i]
     human_this  = f"{used_min}分{used_sec_rem:02d}秒"
     human_limit = f"{limit_min}分"
     human_total = fmt_dur_mmss(today_total_sec)
     overtime = used_min > limit_min or (used_min == limit_min and used_sec_rem > 0)
-    limit_count = LIMITS_COUNT.get(key, 0)
+    limit_count = policy.counts[key]
+    if EVENTS is not None:
+        EVENTS.append(user.id, chat.id, key, active.start, used_sec, EV_OVERTIME if overtime else 0)
 
     base = (f"✅ {mention_user_html(user)} 本次结束，用时 {human_this}（上限 {human_limit}）。\n"
             f"📊 本{current_shift_label()} {title}：第 <b>{today_count}</b> 次（限制 <b>{limit_count}</b> 次），累计 <b>{human_total}</b>。")
     text = base + ("\n⚠️ 本次已超时。" if overtime else "\n✅ 本次未超时。")
 
     if not chat_is_muted(ctx, chat.id):
-        await ctx.bot.send_message(
-            chat_id=chat.id, text=text,
-            parse_mode=constants.ParseMode.HTML,
-            disable_web_page_preview=True,
-        )
+        send(chat.id, text, key=f"end:{user.id}:{active.start}")
+
+@timed
+async def fire_deadline(app: Application, kind: str, uid: int, chat_id: int, token: float):
+    ud = app.user_data.get(uid)
+    active = ud.active if ud else None
+    if not active or active.start != token:
+        return  # 已经结束了（或已开始新的一次）
+    if kind == "timeout":
+        await remind_timeout(app, uid, chat_id)
+        active.reminded = True
+    else:
+        await remind_grace(app, uid, chat_id)
+        active.graced = True
+    app.mark_data_for_update_persistence(user_ids=[uid])
 
 # ⏰ 刚超时提醒当事人（优先 @username）
-async def remind_timeout(context: ContextTypes.DEFAULT_TYPE):
-    data = context.job.data or {}
-    uid = data.get("uid")
-    chat_id = data.get("chat_id")
-    if uid is None or chat_id is None:
-        return
-
-    app = context.application
-    ud = app.user_data.get(uid) or {}
-    active = ud.get("active")
+async def remind_timeout(app: Application, uid: int, chat_id: int):
+    ud = app.user_data.get(uid)
+    active = ud.active if ud else None
     if not active:
         return  # 已经结束了
 
-    title = active.get("title", "打卡")
-    limit_min = int(active.get("limit", 0))
+    title = active.title
+    limit_min = int(active.limit)
 
-    username = ud.get("user_username")
+    username = ud.username
     if username:
         who = f"@{username}"
     else:
         who = mention_id_html(uid, "这位同事")
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"⏰ {who} 的 {title} 已到上限 <b>{limit_min}</b> 分，请尽快发送“回来 / 回 / back / 1”或 /back 结束。",
-        parse_mode=constants.ParseMode.HTML
+    send(
+        chat_id,
+        f"⏰ {who} 的 {title} 已到上限 <b>{limit_min}</b> 分，请尽快发送“回来 / 回 / back / 1”或 /back 结束。",
+        prio=PRIO_REMIND, key=f"timeout:{uid}:{active.start}", guard=(uid, active.start),
     )
 
 # ⏰ 超时 +3 分钟提醒管理员（真正 @Kun）
-async def remind_grace(context: ContextTypes.DEFAULT_TYPE):
-    data = context.job.data or {}
-    uid = data.get("uid")
-    chat_id = data.get("chat_id")
-    if uid is None or chat_id is None:
-        return
-
-    app = context.application
-    ud = app.user_data.get(uid) or {}
-    active = ud.get("active")
+async def remind_grace(app: Application, uid: int, chat_id: int):
+    ud = app.user_data.get(uid)
+    active = ud.active if ud else None
     if not active:
         return  # 已结束则不提醒管理员
 
-    title = active.get("title", "打卡")
-    start: datetime = active.get("start") or datetime.now(timezone.utc)
-    used = fmt_dur_mmss(int((datetime.now(timezone.utc) - start).total_seconds()))
+    title = active.title
+    used = fmt_dur_mmss(int(CLOCK.time() - active.start))
 
     # 当事人显示
-    user_link = ud.get("user_link") or mention_id_html(uid, "这位同事")
+    user_link = ud.link(uid)
 
     # 管理员真正 @
     if MANAGER_USERNAME:
@@ -400,215 +1943,1082 @@ async def remind_grace(context: ContextTypes.DEFAULT_TYPE):
     else:
         manager_call = mention_id_html(MANAGER_ID, "管理员")
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=(f"⚠️ {manager_call} 提醒：{user_link} 的 {title} 已超过上限并宽限 <b>{GRACE_MINUTES}</b> 分钟仍未结束，"
-              f"当前已用时 <b>{used}</b>。"),
-        parse_mode=constants.ParseMode.HTML,
-        disable_web_page_preview=True
+    send(
+        chat_id,
+        (f"⚠️ {manager_call} 提醒：{user_link} 的 {title} 已超过上限并宽限 <b>{chat_policy(app, chat_id).grace}</b> 分钟仍未结束，"
+         f"当前已用时 <b>{used}</b>。"),
+        prio=PRIO_ALERT, key=f"grace:{uid}:{active.start}", guard=(uid, active.start),
     )
 
 # ========= 换班：发群里统计并清状态 =========
+@timed
 async def reset_shift(context: ContextTypes.DEFAULT_TYPE):
-    app = context.application
-    bot = context.bot
-    if not hasattr(app, "user_data"):
+    # 还在后台加载时进行中索引不全，会漏掉已落盘的进行中打卡
+    if HYDRATION is not None:
+        await HYDRATION
+    await events_ready()
+    await fan_out("reset_shift", end_sessions(context.application), prio=PRIO_REMIND,
+                  key=f"shift:{int(CLOCK.time())}")
+
+@timed
+async def reset_on_start(context: ContextTypes.DEFAULT_TYPE):
+    """启动后：等用户加载完，只结束上一班遗留的打卡（同一班内重启不打断进行中的）"""
+    if HYDRATION is not None:
+        await HYDRATION
+    await fan_out("reset_on_start", end_sessions(context.application, stale_only=True), prio=PRIO_REMIND,
+                  key=f"shift-start:{int(CLOCK.time())}")
+
+def session_alive(app: Application, uid: int, start: float) -> bool:
+    """这次打卡（按开始时间认）是不是还没结束；提醒类消息补发前用它判断"""
+    ud = app.user_data.get(uid)
+    return bool(ud and ud.active and ud.active.start == start)
+
+@timed
+async def replay_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """启动后：等用户加载完，补发上次没发出去的要紧消息"""
+    if OUTBOX is None or OUTBOX.journal is None or not OUTBOX.journal.recovered:
         return
+    if HYDRATION is not None:
+        await HYDRATION
+    counts = OUTBOX.replay()
+    print(f"补发上次未发出的消息：{counts['resent']} 条；丢弃 已结束的提醒 {counts['stale']} 条、"
+          f"超过 {OUTBOX_MAX_AGE_HOURS} 小时 {counts['expired']} 条")
 
-    now_utc = datetime.now(timezone.utc)
+def end_sessions(app: Application, stale_only: bool = False) -> List[Tuple[int, str]]:
+    """
+    结束进行中的打卡，返回各群的统计消息 [(chat_id, 文本)]（已按行分页），由调用方一起群发；
+    stale_only 时只结束开始于上一班（或更早）的
+    """
+    if not hasattr(app, "user_data"):
+        return []
+
+    now_ts = CLOCK.time()
+    epoch = shift_epoch(now_ts)
     grouped: Dict[int, List[str]] = {}
+    ended: List[Tuple[int, int]] = []
+
+    # 统计当前仍然 active 的人（只看索引，不扫描全部用户）
+    for chat_id, sessions in ACTIVE_BY_CHAT.items():
+        for uid, active in sessions.items():
+            if stale_only and shift_epoch(active.start) == epoch:
+                continue
+            ended.append((chat_id, uid))
+            used_sec = int(now_ts - active.start)
+            start_local = datetime.fromtimestamp(active.start, LOCAL_TZ).strftime("%H:%M")
+            line = (
+                f"• <a href=\"tg://user?id={uid}\">这位同事</a> — {active.title} | 已用时 <b>{fmt_dur_mmss(used_sec)}</b> | "
+                f"开始 <b>{start_local}</b> | ID <code>{uid}</code>"
+            )
+            grouped.setdefault(chat_id, []).append(line)
 
-    # 统计当前仍然 active 的人
-    for uid, ud in list(app.user_data.items()):
-        active = ud.get("active")
-        if not active:
+    # 先把所有群的统计都渲染好（人多的群按行分页）
+    messages = [
+        (chat_id, page)
+        for chat_id, lines in grouped.items()
+        for page in paginate(f"🕖 换班统计：共有 <b>{len(lines)}</b> 人尚未回来，系统已自动结束：", lines)
+    ]
+
+    # 清状态（堆里剩下的提醒 token 对不上，到期会自动跳过）
+    touched: Set[int] = set()
+    for chat_id, uid in ended:
+        unindex_active(chat_id, uid)
+        ud = app.user_data.get(uid)
+        if ud is None:
             continue
-        title = active.get("title", "打卡")
-        start: datetime = active.get("start") or now_utc
-        used_sec = int((now_utc - start).total_seconds())
-        start_local = start.astimezone(LOCAL_TZ).strftime("%H:%M")
-        line = (
-            f"• <a href=\"tg://user?id={uid}\">这位同事</a> — {title} | 已用时 <b>{fmt_dur_mmss(used_sec)}</b> | "
-            f"开始 <b>{start_local}</b> | ID <code>{uid}</code>"
+        touched.add(uid)
+        ud.active = None
+        ud.last_seen = now_ts
+
+    # 当班统计不用清：epoch 对不上的统计自动算 0（见 UserState.counters）
+    # 这里是直接改的 user_data，需要手动标记才会落盘
+    app.mark_data_for_update_persistence(user_ids=touched)
+    return messages
+
+def _idle_blobs(cold: List[Tuple[int, bytes]], cutoff: float) -> Set[int]:
+    """在线程里解码冷用户的原始行，挑出该清掉的 uid"""
+    out = set()
+    for uid, blob in cold:
+        ud = UserState.from_record(pickle.loads(blob))
+        if not ud.active and ud.last_seen and ud.last_seen < cutoff:
+            out.add(uid)
+    return out
+
+@timed
+async def prune_idle_users(context: ContextTypes.DEFAULT_TYPE):
+    """
+    每天一次：30 天没用过的用户从 user_data 清掉（唯一需要扫全部用户的任务）。
+    冷着的人在线程里看原始行，不在事件循环上把所有人解热；等线程期间被用到（解热了）的人按当前字段重新判断
+    """
+    app = context.application
+    cutoff = CLOCK.time() - IDLE_PRUNE_DAYS * 86400
+    cold = [(uid, ud._blob) for uid, ud in app.user_data.items() if ud.is_cold]
+    idle = await asyncio.to_thread(_idle_blobs, cold, cutoff)
+    for uid, ud in list(app.user_data.items()):
+        if ud.is_cold:
+            if uid in idle:
+                app.drop_user_data(uid)
+        elif not ud.active and ud.last_seen and ud.last_seen < cutoff:
+            app.drop_user_data(uid)
+
+@timed
+async def reload_policies(context: ContextTypes.DEFAULT_TYPE):
+    """定时看一眼 POLICY_FILE，改了就换上新规则（不用重启）"""
+    config = await asyncio.to_thread(POLICIES.read_if_changed)
+    if config is not None:
+        POLICIES.apply(config)
+
+# ========= 持久化（SQLite WAL，只写脏行） =========
+_DROP = object()
+
+class SQLitePersistence(BasePersistence):
+    """
+    替代整文件重写的 PicklePersistence：
+    - 每个 user / chat 一行（pickle 后的 BLOB），bot_data 单独一行
+    - 只写 Application 标记为脏的行，内容没变的行也跳过
+    - 同一轮 update_persistence 的所有行合并成一个事务，在线程里执行，不卡事件循环
+    """
+
+    TABLES = ("user_data", "chat_data", "bot_data")
+
+    def __init__(self, filepath: str = DB_FILE, update_interval: float = PERSIST_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
         )
-        chat_id = ud.get("last_chat_id")
-        if chat_id:
-            grouped.setdefault(chat_id, []).append(line)
+        self.filepath = filepath
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: Dict[Tuple[str, int], Any] = {}
+        self._digests: Dict[Tuple[str, int], int] = {}
+        self._lock = asyncio.Lock()
+        self._written: Set[Tuple[str, int]] = set()      # 落盘后还没被备份取走的行（写入 / 删除）
+        self._written_lock = threading.Lock()           # 写库和备份各在自己的线程里
+        self.last_flush_ms = 0.0
+        self.last_flush_rows = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_db(self.filepath)
+        return self._conn
+
+    def _load(self, table: str) -> Dict[int, Any]:
+        out: Dict[int, Any] = {}
+        # 用户只带原始行，用到时再解码（见 UserState.cold / hydrate_users），启动不必反序列化所有人
+        decode = UserState.cold if table == "user_data" else pickle.loads
+        for key, blob in self._db().execute(f"SELECT id, data FROM {table}"):
+            self._digests[(table, key)] = hash(blob)
+            out[key] = decode(blob)
+        return out
+
+    def _write_batch(self, batch: Dict[Tuple[str, int], Any]):
+        t0 = perf_counter()
+        upserts: Dict[str, List[Tuple[int, bytes]]] = {}
+        deletes: Dict[str, List[Tuple[int]]] = {}
+        for (table, key), data in batch.items():
+            if data is _DROP:
+                self._digests.pop((table, key), None)
+                deletes.setdefault(table, []).append((key,))
+                continue
+            if isinstance(data, UserState):
+                data = data.to_record()
+            blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            digest = hash(blob)
+            if self._digests.get((table, key)) == digest:
+                continue
+            self._digests[(table, key)] = digest
+            upserts.setdefault(table, []).append((key, blob))
+        conn = self._db()
+        with conn:
+            for table, rows in upserts.items():
+                conn.executemany(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", rows)
+            for table, rows in deletes.items():
+                conn.executemany(f"DELETE FROM {table} WHERE id = ?", rows)
+        with self._written_lock:
+            for table, rows in itertools.chain(upserts.items(), deletes.items()):
+                self._written.update((table, row[0]) for row in rows)
+        self.last_flush_rows = sum(map(len, upserts.values())) + sum(map(len, deletes.values()))
+        self.last_flush_ms = (perf_counter() - t0) * 1000
+
+    def take_written(self) -> Set[Tuple[str, int]]:
+        """备份取走上次以来真正写过 / 删过的行，只需重读这些"""
+        with self._written_lock:
+            keys, self._written = self._written, set()
+        return keys
+
+    async def _queue(self, table: str, key: int, data: Any):
+        self._pending[(table, key)] = data
+        # 让同一轮 gather 里的其它 update_* 先把数据放进来，再一起提交
+        await asyncio.sleep(0)
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            s = span_open("persist", {"rows": len(batch)}) if TRACE_SLOW_MS else None
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            finally:
+                if s is not None:
+                    span_close(s)
+            FLUSH_SECONDS.observe("sqlite", self.last_flush_ms / 1000)
+
+    async def get_user_data(self) -> Dict[int, UserState]:
+        return await asyncio.to_thread(self._load, "user_data")
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return await asyncio.to_thread(self._load, "chat_data")
+
+    async def get_bot_data(self) -> dict:
+        return (await asyncio.to_thread(self._load, "bot_data")).get(0, {})
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        return
+
+    async def update_user_data(self, user_id: int, data: UserState) -> None:
+        await self._queue("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._queue("chat_data", chat_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._queue("bot_data", 0, data)
+
+    async def update_callback_data(self, data) -> None:
+        return
 
-    # 发群里统计
-    for chat_id, lines in grouped.items():
-        text = "🕖 换班统计：共有 <b>{}</b> 人尚未回来，系统已自动结束：\n{}".format(
-            len(lines), "\n".join(lines)
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._queue("user_data", user_id, _DROP)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._queue("chat_data", chat_id, _DROP)
+
+    async def refresh_user_data(self, user_id: int, user_data: UserState) -> None:
+        # 每条更新进 handler 之前调用：这个人还没解码的话现在解
+        user_data.hydrate()
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        return
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        return
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if self._pending:
+                batch, self._pending = self._pending, {}
+                await asyncio.to_thread(self._write_batch, batch)
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+def open_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for table in SQLitePersistence.TABLES:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+    return conn
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # PicklePersistence 会把 Bot 实例存成 persistent id，这里直接还原成 None
+    def persistent_load(self, pid):
+        return None
+
+def migrate_pickle(pkl_path: str = LEGACY_PICKLE, db_path: str = DB_FILE) -> bool:
+    """一次性把旧的 botdata.pkl 导入 SQLite；导入后旧文件改名为 .migrated"""
+    if os.path.exists(db_path) or not os.path.exists(pkl_path):
+        return False
+    with open(pkl_path, "rb") as f:
+        data = _LegacyUnpickler(f).load()
+    conn = open_db(db_path)
+    with conn:
+        for table in ("user_data", "chat_data"):
+            rows = []
+            for key, value in (data.get(table) or {}).items():
+                if table == "user_data":
+                    value = UserState.from_record(value).to_record()   # Job 之类的不带过来
+                rows.append((key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            conn.executemany(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", rows)
+        conn.execute(
+            "INSERT OR REPLACE INTO bot_data (id, data) VALUES (0, ?)",
+            (pickle.dumps(data.get("bot_data") or {}, protocol=pickle.HIGHEST_PROTOCOL),),
         )
+    conn.close()
+    os.replace(pkl_path, pkl_path + ".migrated")
+    print(f"已从 {pkl_path} 迁移到 {db_path}")
+    return True
+
+# ========= 备份：压缩整库快照 + 增量，按小时/天/周保留 =========
+def _stamp(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y%m%d-%H%M%S")
+
+def _unstamp(stamp: str) -> float:
+    return datetime.strptime(stamp, "%Y%m%d-%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+
+def _read_rows(conn: sqlite3.Connection) -> Dict[Tuple[str, int], bytes]:
+    """一个读事务里取出全部行，三张表是同一时刻的"""
+    rows: Dict[Tuple[str, int], bytes] = {}
+    conn.execute("BEGIN")
+    try:
+        for table in SQLitePersistence.TABLES:
+            for key, blob in conn.execute(f"SELECT id, data FROM {table}"):
+                rows[(table, key)] = blob
+    finally:
+        conn.execute("ROLLBACK")
+    return rows
+
+def _read_keys(conn: sqlite3.Connection, keys: Set[Tuple[str, int]]) -> Dict[Tuple[str, int], bytes]:
+    """一个读事务里只取这些行；库里已经没有的行不在结果里"""
+    by_table: Dict[str, List[int]] = {}
+    for table, key in keys:
+        by_table.setdefault(table, []).append(key)
+    rows: Dict[Tuple[str, int], bytes] = {}
+    conn.execute("BEGIN")
+    try:
+        for table, ids in by_table.items():
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                sql = f"SELECT id, data FROM {table} WHERE id IN ({','.join('?' * len(part))})"
+                for key, blob in conn.execute(sql, part):
+                    rows[(table, key)] = blob
+    finally:
+        conn.execute("ROLLBACK")
+    return rows
+
+def _crcs(rows: Dict[Tuple[str, int], bytes]) -> Dict[Tuple[str, int], int]:
+    return {key: zlib.crc32(blob) for key, blob in rows.items()}
+
+def _row_digest(key: Tuple[str, int], crc: int) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{key[0]}:{key[1]}:{crc}".encode(), digest_size=8).digest(), "little")
+
+class StateDigest:
+    """
+    整库摘要 = 每行摘要之和 mod 2^64：和行的顺序无关，改几行只要加减这几行，
+    应用增量时不用重算全库。每个备份文件都记下应用后的摘要，恢复时逐个核对。
+    """
+
+    def __init__(self, crcs: Dict[Tuple[str, int], int]):
+        self.crcs = dict(crcs)
+        self.value = sum(_row_digest(k, c) for k, c in crcs.items()) & 0xFFFFFFFFFFFFFFFF
+
+    def apply(self, changed: Dict[Tuple[str, int], int], dropped):
+        for key in dropped:
+            if key in self.crcs:
+                self.value -= _row_digest(key, self.crcs.pop(key))
+        for key, crc in changed.items():
+            if key in self.crcs:
+                self.value -= _row_digest(key, self.crcs[key])
+            self.crcs[key] = crc
+            self.value += _row_digest(key, crc)
+        self.value &= 0xFFFFFFFFFFFFFFFF
+
+    def hex(self) -> str:
+        return f"{self.value:016x}"
+
+class BackupStore:
+    """
+    backup/ 下按“链”存放，一条链 = 一个整库快照 + 之后的若干增量：
+      snap{tag}-20261017-000000.db.gz                    sqlite backup API 拷出的整库，gzip 压缩
+      delta{tag}-20261017-000000-0003-20261017-003000.pkl.gz   相对上一个文件变化 / 删除的行
+    还原点 = 某个快照或增量；恢复到某点 = 解压快照 + 依次应用该链上不晚于它的增量。
+    这里全是阻塞 I/O，由 backup_tick 放到线程里跑。
+    """
+
+    def __init__(self, db_path: str = DB_FILE, directory: str = BACKUP_DIR, tag: str = "",
+                 source: Optional[SQLitePersistence] = None):
+        self.db_path = db_path
+        self.dir = directory
+        self.tag = tag
+        self.source = source                          # 有的话增量只重读它写过的行
+        self.scan = True                              # 下一次增量整库比对：刚接上旧链（停机前的改动没记下），或没有 source
+        self.manifest: Optional[StateDigest] = None   # 最近一次备份时每行的 crc + 整库摘要
+        self.chain = ""
+        self.seq = 0
+        self.last = {"kind": "", "bytes": 0, "rows": 0, "taken": 0.0}
+
+    def _snap_path(self, chain: str) -> str:
+        return os.path.join(self.dir, f"snap{self.tag}-{chain}.db.gz")
+
+    def _delta_path(self, chain: str, seq: int, taken: float) -> str:
+        return os.path.join(self.dir, f"delta{self.tag}-{chain}-{seq:04d}-{_stamp(taken)}.pkl.gz")
+
+    def points(self) -> List[Tuple[float, str, int, str]]:
+        """本 tag 的全部还原点 (时间戳, 链, 序号, 路径)，按时间从旧到新；序号 0 是快照"""
+        out = []
+        d = glob.escape(self.dir)
+        for path in glob.glob(os.path.join(d, f"snap{glob.escape(self.tag)}-*.db.gz")):
+            chain = os.path.basename(path)[len(f"snap{self.tag}-"):-len(".db.gz")]
+            out.append((_unstamp(chain), chain, 0, path))
+        for path in glob.glob(os.path.join(d, f"delta{glob.escape(self.tag)}-*.pkl.gz")):
+            parts = os.path.basename(path)[len(f"delta{self.tag}-"):-len(".pkl.gz")].split("-")
+            if len(parts) == 5:
+                out.append((_unstamp("-".join(parts[3:])), "-".join(parts[:2]), int(parts[2]), path))
+        return sorted(out)
+
+    def tick(self, now: Optional[float] = None) -> str:
+        """备份一次：该开新链时做整库快照，否则只写变化的行；返回 "snap" / "delta" / ""（没变化）"""
+        now = datetime.now(timezone.utc).timestamp() if now is None else now
+        os.makedirs(self.dir, exist_ok=True)
+        if self.manifest is None:
+            self._resume(now)
         try:
-            await bot.send_message(
-                chat_id=chat_id, text=text,
-                parse_mode=constants.ParseMode.HTML,
-                disable_web_page_preview=True
-            )
+            if self.manifest is None or now - _unstamp(self.chain) >= BACKUP_SNAPSHOT_HOURS * 3600:
+                kind = self._snapshot(now)
+            else:
+                kind = self._delta(now)
         except Exception:
-            pass
-
-    # 清状态并取消提醒
-    for uid, ud in list(app.user_data.items()):
-        if not ud.get("active"):
-            continue
-        for key in ("reminder_job", "grace_job"):
-            job: Optional[Any] = ud.get(key)
-            if job:
+            self.manifest = None                      # 取走的脏行可能没写进文件：下次从磁盘上的链重新接，整库比对一次
+            raise
+        if kind:
+            self.prune()
+        return kind
+
+    def _resume(self, now: float):
+        """重启后接着最近一条链写增量（不必每次启动都整库拷一份）；链坏了就重开"""
+        pts = [p for p in self.points() if now - _unstamp(p[1]) < BACKUP_SNAPSHOT_HOURS * 3600]
+        if not pts:
+            return
+        chain = pts[-1][1]
+        try:
+            rows, seq = self._replay(chain)
+        except Exception as e:
+            print(f"备份链 {chain} 校验失败，重新做快照：{e}")
+            return
+        self.manifest, self.chain, self.seq = StateDigest(_crcs(rows)), chain, seq
+
+    def _snapshot(self, now: float) -> str:
+        chain = _stamp(now)
+        tmp = os.path.join(self.dir, f".snap{self.tag}.tmp.db")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if self.source is not None:
+            self.source.take_written()                # 整库拷贝已经包含它们；之后再写的会重新记下
+        src, dst = open_db(self.db_path), sqlite3.connect(tmp, isolation_level=None)
+        try:
+            src.backup(dst)
+            rows = _read_rows(dst)
+            digest = StateDigest(_crcs(rows))
+            dst.execute("CREATE TABLE backup_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            dst.executemany("INSERT INTO backup_meta VALUES (?, ?)", [("digest", digest.hex()), ("taken", str(now))])
+        finally:
+            src.close()
+            dst.close()
+        out = self._snap_path(chain)
+        with open(tmp, "rb") as f, gzip.open(out + ".tmp", "wb", compresslevel=6) as g:
+            shutil.copyfileobj(f, g)
+        os.replace(out + ".tmp", out)
+        os.remove(tmp)
+        self.manifest, self.chain, self.seq = digest, chain, 0
+        self.scan = self.source is None
+        self.last = {"kind": "snap", "bytes": os.path.getsize(out), "rows": len(rows), "taken": now}
+        return "snap"
+
+    def _delta(self, now: float) -> str:
+        keys = self.source.take_written() if self.source is not None else set()
+        if not self.scan and not keys:
+            return ""
+        conn = open_db(self.db_path)
+        conn.isolation_level = None
+        try:
+            rows = _read_rows(conn) if self.scan else _read_keys(conn, keys)
+        finally:
+            conn.close()
+        old = self.manifest.crcs
+        crcs = _crcs(rows)
+        changed = {key: crc for key, crc in crcs.items() if old.get(key) != crc}
+        dropped = [key for key in (old if self.scan else keys) if key not in crcs and key in old]
+        self.scan = self.source is None
+        if not changed and not dropped:
+            return ""
+        self.manifest.apply(changed, dropped)
+        payload = {"version": 1, "chain": self.chain, "seq": self.seq + 1, "taken": now,
+                   "rows": {key: rows[key] for key in changed}, "dropped": dropped, "digest": self.manifest.hex()}
+        out = self._delta_path(self.chain, self.seq + 1, now)
+        with gzip.open(out + ".tmp", "wb", compresslevel=6) as g:
+            pickle.dump(payload, g, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(out + ".tmp", out)
+        self.seq += 1
+        self.last = {"kind": "delta", "bytes": os.path.getsize(out), "rows": len(changed) + len(dropped), "taken": now}
+        return "delta"
+
+    def _replay(self, chain: str, upto: Optional[int] = None) -> Tuple[Dict[Tuple[str, int], bytes], int]:
+        """解压快照 + 依次应用增量，每一步都核对整库摘要；返回 (全部行, 最后的序号)，不对就抛 ValueError"""
+        snap = self._snap_path(chain)
+        tmp = os.path.join(self.dir, f".restore{self.tag}.tmp.db")
+        with gzip.open(snap, "rb") as g, open(tmp, "wb") as f:
+            shutil.copyfileobj(g, f)
+        conn = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            if conn.execute("PRAGMA integrity_check").fetchone()[0] != "ok":
+                raise ValueError(f"{snap} 损坏")
+            meta = dict(conn.execute("SELECT key, value FROM backup_meta"))
+            rows = _read_rows(conn)
+        finally:
+            conn.close()
+            os.remove(tmp)
+        digest = StateDigest(_crcs(rows))
+        if digest.hex() != meta.get("digest"):
+            raise ValueError(f"{snap} 摘要不符")
+        seq = 0
+        for _, c, s, path in self.points():
+            if c != chain or s == 0 or (upto is not None and s > upto):
+                continue
+            if s != seq + 1:
+                raise ValueError(f"链 {chain} 缺少第 {seq + 1} 个增量")
+            with gzip.open(path, "rb") as g:
+                delta = pickle.load(g)
+            for key in delta["dropped"]:
+                rows.pop(key, None)
+            rows.update(delta["rows"])
+            digest.apply(_crcs(delta["rows"]), delta["dropped"])
+            if digest.hex() != delta["digest"]:
+                raise ValueError(f"{path} 摘要不符")
+            seq = s
+        return rows, seq
+
+    def prune(self):
+        """
+        按 BACKUP_KEEP 挑还原点：每小时留最新的一个（快照或增量），每天 / 每周只在快照里挑，
+        这样旧链的增量过了小时档就能整条删掉；再删掉这些点用不到的文件，当前链不动
+        """
+        pts = self.points()
+        keep = set(pts[-1:])
+        for level, n in BACKUP_KEEP.items():
+            fmt = {"hourly": "%Y%m%d%H", "daily": "%Y%m%d", "weekly": "%G%V"}[level]
+            seen: Set[str] = set()
+            for p in reversed(pts if level == "hourly" else [p for p in pts if p[2] == 0]):
+                bucket = datetime.fromtimestamp(p[0], LOCAL_TZ).strftime(fmt)
+                if bucket in seen:
+                    continue
+                if len(seen) >= n:
+                    break
+                seen.add(bucket)
+                keep.add(p)
+        upto: Dict[str, int] = {self.chain: 1 << 30}
+        for _, chain, seq, _ in keep:
+            upto[chain] = max(upto.get(chain, -1), seq)
+        for _, chain, seq, path in pts:
+            if seq > upto.get(chain, -1):
                 try:
-                    job.schedule_removal()
+                    os.remove(path)
                 except Exception:
                     pass
-            ud[key] = None
-        ud.pop("active", None)
-        ud.pop("start_user_msg_id", None)
-        ud.pop("start_bot_msg_id", None)
-        ud["_last_seen"] = now_utc.timestamp()
-
-    # 清空当班统计（所有群），长期不用的用户清理
-    for _uid, ud in list(app.user_data.items()):
-        all_stats = ud.get("stats_by_chat") or {}
-        for chat_stats in all_stats.values():
-            for k in chat_stats:
-                chat_stats[k]["count"] = 0
-                chat_stats[k]["dur"] = 0
-        last = ud.get("_last_seen")
-        if (not ud.get("active")) and last and (now_utc.timestamp() - last > 30 * 86400):
-            try:
-                del app.user_data[_uid]
-            except Exception:
-                pass
+
+    def restore(self, at: Optional[float] = None, db_path: Optional[str] = None) -> str:
+        """
+        恢复到 at（默认最新）之前最近的还原点：先完整核对摘要、逐行反序列化，
+        全部通过才替换；原来的库改名为 .pre-restore
+        """
+        target, desc = self.prepare(at, db_path)
+        self.install(target)
+        return desc
+
+    def prepare(self, at: Optional[float] = None, db_path: Optional[str] = None) -> Tuple[str, str]:
+        """核对并在 target.restore 建好恢复出的库，原库不动；返回 (target, 说明)，不对就抛异常"""
+        pts = [p for p in self.points() if at is None or p[0] <= at]
+        if not pts:
+            raise ValueError("没有可用的备份")
+        taken, chain, seq, _ = pts[-1]
+        rows, _ = self._replay(chain, seq)
+        for (table, _), blob in rows.items():
+            rec = pickle.loads(blob)
+            if table == "user_data":
+                UserState.from_record(rec)
+        target = db_path or self.db_path
+        tmp = target + ".restore"
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(tmp + suffix):
+                os.remove(tmp + suffix)
+        conn = open_db(tmp)
+        with conn:
+            for table in SQLitePersistence.TABLES:
+                conn.executemany(f"INSERT INTO {table} (id, data) VALUES (?, ?)",
+                                 [(key, blob) for (t, key), blob in rows.items() if t == table])
+        conn.close()
+        when = datetime.fromtimestamp(taken, LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        return target, f"{target} ← 链 {chain} 第 {seq} 个还原点（{when}，{len(rows)} 行）"
+
+    @staticmethod
+    def install(target: str):
+        """用 prepare 建好的库替换 target，原来的库改名为 .pre-restore"""
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(target + suffix):
+                os.replace(target + suffix, target + ".pre-restore" + suffix)
+        os.replace(target + ".restore", target)
+
+    @staticmethod
+    def discard(target: str):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(target + ".restore" + suffix):
+                os.remove(target + ".restore" + suffix)
+
+BACKUPS: Optional[BackupStore] = None
+
+@timed
+async def backup_tick(context: ContextTypes.DEFAULT_TYPE):
+    """定时备份；拷库、压缩、写文件都在线程里，不卡事件循环"""
+    if BACKUPS is None:
+        return
+    t0 = perf_counter()
+    kind = await asyncio.to_thread(BACKUPS.tick)
+    if kind:
+        FLUSH_SECONDS.observe("backup_" + kind, perf_counter() - t0)
+
+def restore_cli(args: List[str]) -> int:
+    """python3 checkin_bot.py restore [YYYY-MM-DD HH:MM]：先停机器人；每个分片的库各自恢复"""
+    at = None
+    if args:
+        try:
+            at = datetime.strptime(" ".join(args), "%Y-%m-%d %H:%M").replace(tzinfo=LOCAL_TZ).timestamp()
+        except ValueError:
+            print("时间格式：YYYY-MM-DD HH:MM")
+            return 2
+    base, ext = os.path.splitext(DB_FILE)
+    tags = sorted({os.path.basename(p)[4:].split("-", 1)[0]
+                   for p in glob.glob(os.path.join(glob.escape(BACKUP_DIR), "snap*-*.db.gz"))})
+    if not tags:
+        print(f"{BACKUP_DIR}/ 里没有备份")
+        return 1
+    # 先把每个分片都核对完、建好恢复库，全部通过才开始替换：不会只恢复一部分分片
+    ready: List[Tuple[str, str]] = []
+    for tag in tags:
+        try:
+            ready.append(BackupStore(base + tag + ext, BACKUP_DIR, tag).prepare(at))
+        except Exception as e:
+            for target, _ in ready:
+                BackupStore.discard(target)
+            BackupStore.discard(base + tag + ext)
+            print(f"恢复 {base + tag + ext} 失败：{e}\n所有分片的库都未改动")
+            return 1
+    done: List[str] = []
+    for target, desc in ready:
+        try:
+            BackupStore.install(target)
+        except Exception as e:
+            print(f"替换 {target} 失败：{e}\n已替换：{'、'.join(done) or '无'}（原库在 .pre-restore）")
+            return 1
+        done.append(target)
+        print("已恢复：" + desc)
+    return 0
 
 # ========= 命令 =========
+@timed
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if await is_admin(update):
         txt = ("打卡说明：\n"
                "• 开始：发送“厕所/抽烟/吃饭”（或 wc/smoke/eat 等别名）\n"
                "• 结束：发送“回来/回/back/1”或 /back\n"
-               "• 时长：厕所10分，抽烟10分，吃饭30分；到时提醒；超时提示。\n"
-               "• 最小时长：厕所30秒、抽烟30秒、吃饭60秒，未达不计且不冷却。\n"
-               f"• 超时：到时提醒本人，{GRACE_MINUTES} 分钟后仍未结束会@管理员。\n"
-               "• 管理：/who /summary /setlimit /setcount /mute /unmute")
+               + POLICIES.get(update.effective_chat.id, ctx.chat_data).rules_text() + "\n"
+               "• 管理：/who /summary /export /setlimit /setcount /mute /unmute\n"
+               "• 历史：/summary 2026-10-15 或 /summary 2026-10-01 2026-10-15，可加 白班/夜班")
     else:
         txt = ("打卡说明：\n"
                "• 开始：发送“厕所 / 抽烟 / 吃饭”（或 wc / smoke / eat）\n"
                "• 结束：发送“回来 / 回 / back / 1”")
-    await update.effective_message.reply_html(txt)
+    reply(update, txt)
 
+@timed
 async def cmd_toilet(update: Update, ctx: ContextTypes.DEFAULT_TYPE): await begin(update, ctx, "toilet")
+@timed
 async def cmd_smoke(update: Update, ctx: ContextTypes.DEFAULT_TYPE):  await begin(update, ctx, "smoke")
+@timed
 async def cmd_meal(update: Update, ctx: ContextTypes.DEFAULT_TYPE):   await begin(update, ctx, "meal")
+@timed
 async def cmd_back(update: Update, ctx: ContextTypes.DEFAULT_TYPE):   await end_session(update, ctx)
 
+@timed
+@per_chat
 async def cmd_who(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        return await update.effective_message.reply_html("❌ 仅管理员可用。")
+        return reply(update, "❌ 仅管理员可用。")
     chat = update.effective_chat
-    app = ctx.application
-    now_utc = datetime.now(timezone.utc)
+    now_ts = CLOCK.time()
     lines = []
-    for uid, ud in list(app.user_data.items()):
-        active = ud.get("active")
-        if not active or ud.get("last_chat_id") != chat.id:
-            continue
-        start = active.get("start") or now_utc
+    for uid, active in ACTIVE_BY_CHAT.get(chat.id, {}).items():
         lines.append(
-            f"• <a href=\"tg://user?id={uid}\">这位同事</a> — {active.get('title','打卡')} | "
-            f"已用 <b>{fmt_dur_mmss(int((now_utc - start).total_seconds()))}</b> | "
-            f"开始 <b>{start.astimezone(LOCAL_TZ).strftime('%H:%M')}</b> | ID <code>{uid}</code>"
+            f"• <a href=\"tg://user?id={uid}\">这位同事</a> — {active.title} | "
+            f"已用 <b>{fmt_dur_mmss(int(now_ts - active.start))}</b> | "
+            f"开始 <b>{datetime.fromtimestamp(active.start, LOCAL_TZ).strftime('%H:%M')}</b> | ID <code>{uid}</code>"
         )
-    await update.effective_message.reply_html(
+    reply(
+        update,
         "📋 当前未结束清单：\n" + "\n".join(lines) if lines else "👍 本群当前无人处于进行中状态。"
     )
 
+SHIFT_WORDS = {"白班": "D", "白": "D", "d": "D", "夜班": "N", "夜": "N", "n": "N"}
+
+def parse_summary_range(args: List[str]) -> Optional[Tuple[str, str, str]]:
+    """
+    /summary 参数 → (level, lo, hi)：
+      2026-10-15                 那一天
+      2026-10-01 2026-10-15      日期范围
+      2026-10-15 夜班 / 2026-10-15N        某一班
+      2026-10-14白班 ~ 2026-10-15夜班      班次范围
+    也认 今天 / 昨天。格式不对返回 None
+    """
+    today = datetime.fromtimestamp(CLOCK.time(), LOCAL_TZ).date()
+    alias = {"今天": today, "today": today,
+             "昨天": today - timedelta(days=1), "yesterday": today - timedelta(days=1)}
+    points: List[List[Optional[str]]] = []   # [日期, 班次]
+    for tok in " ".join(args).replace("~", " ").replace("..", " ").split():
+        if tok.lower() in alias:
+            points.append([alias[tok.lower()].isoformat(), None])
+            continue
+        date_part, shift_part = tok[:10], tok[10:]
+        if shift_part == "" and tok.lower() in SHIFT_WORDS:
+            date_part, shift_part = "", tok
+        if date_part:
+            try:
+                date_part = datetime.strptime(date_part, "%Y-%m-%d").date().isoformat()
+            except ValueError:
+                return None
+            points.append([date_part, None])
+        if shift_part:
+            if not points or points[-1][1] or shift_part.lower() not in SHIFT_WORDS:
+                return None
+            points[-1][1] = SHIFT_WORDS[shift_part.lower()]
+    if not points or len(points) > 2:
+        return None
+    lo, hi = points[0], points[-1]
+    if lo[0] > hi[0]:
+        lo, hi = hi, lo
+    if lo[1] or hi[1]:
+        a, b = lo[0] + (lo[1] or "D"), hi[0] + (hi[1] or "N")
+        return ("shift", a, b) if a <= b else ("shift", b, a)
+    return "day", lo[0], hi[0]
+
+def label_range(level: str, lo: str, hi: str) -> str:
+    def one(key: str) -> str:
+        return key if level == "day" else f"{key[:10]} {SHIFT_NAMES[key[10:]]}"
+    return one(lo) if lo == hi else f"{one(lo)} ~ {one(hi)}"
+
+@timed
+@per_chat
 async def cmd_summary(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        return await update.effective_message.reply_html("❌ 仅管理员可用。")
+        return reply(update, "❌ 仅管理员可用。")
     chat = update.effective_chat
-    app = ctx.application
-    lines = [f"📊 本{current_shift_label()}汇总（按用户）："]
-    for uid, ud in list(app.user_data.items()):
-        all_stats = ud.get("stats_by_chat") or {}
-        stats = all_stats.get(str(chat.id)) or {}
-        per = []
-        for k in ("smoke", "toilet", "meal"):
-            c = stats.get(k, {}).get("count", 0)
-            d = stats.get(k, {}).get("dur", 0)
-            if c or d:
-                per.append(f"{TITLES[k]} <b>{c}</b> 次 / {fmt_dur_mmss(d)}")
-        if per:
-            lines.append(f"• {mention_id_html(uid, '这位同事')} — " + "；".join(per))
-    await update.effective_message.reply_html(
-        "\n".join(lines) if len(lines) > 1 else "暂无数据。"
-    )
+    await events_ready()
+    if ctx.args:
+        # 冷月份要扫原始记录重建汇总，放线程里；汇总的读取留在事件循环上，不和 append 交错
+        rng = parse_summary_range(ctx.args)
+        if rng is not None and EVENTS is not None:
+            await asyncio.to_thread(EVENTS.preload, rng[1][:7], rng[2][:7])
+        return reply_pages(update, history_summary(chat.id, ctx.args))
+    reply_pages(update, live_summary_pages(ctx.application, ctx.chat_data, chat.id))
+
+def history_summary(chat_id: int, args: List[str]) -> List[str]:
+    """按日期 / 班次范围出汇总：只读按天 / 按班的汇总，不扫原始记录"""
+    rng = parse_summary_range(args)
+    if rng is None:
+        return ["用法：/summary 2026-10-15 | /summary 2026-10-01 2026-10-15 | "
+                "/summary 2026-10-15 夜班 | /summary 昨天"]
+    if EVENTS is None:
+        return ["历史记录未启用。"]
+    level, lo, hi = rng
+    per_user = EVENTS.summarize(chat_id, level, lo, hi)
+    if not per_user:
+        return ["该时间段暂无数据。"]
+    lines = [f"• {mention_id_html(uid, '这位同事')} — {fmt_kinds(per_user[uid])}"
+             for uid in sorted(per_user, key=lambda u: -sum(c[2] for c in per_user[u].values()))]
+    return paginate(f"📊 {label_range(level, lo, hi)} 汇总（按用户）：", lines)
+
+# ========= /export：按班导出 CSV / XLSX（后台线程流式写文件，写完 send_document） =========
+EXPORT_HEADER = ("班次日期", "班次", "user_id", "姓名", "用户名", "类型", "次数", "总时长(秒)", "总时长", "超时次数")
+EXPORT_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")   # 导出排队，不占默认线程池
+
+def export_shifts(chat_id: int, lo: str, hi: str, live: Dict[str, list]):
+    """
+    按班次顺序产出 (班次, [(uid, 类型, 次数, 秒数, 超时), ...])：live 里有的月份用事件循环上拷好的，
+    其余是 frozen 的月份，直接读 EVENTS 的汇总（不会再变）。在导出线程里迭代
+    """
+    for month in _months_between(lo[:7], hi[:7]):
+        if month in live:
+            yield from live[month]
+        else:
+            yield from EVENTS.shifts(chat_id, lo, hi, month)
+
+def export_uids(chat_id: int, lo: str, hi: str, months: List[str]) -> Set[int]:
+    """导出线程里：frozen 的月份里出现过的人"""
+    return {row[0] for month in months for _, rows in EVENTS.shifts(chat_id, lo, hi, month) for row in rows}
+
+async def export_names(app: Application, uids: Set[int], chunk: int = 500) -> Dict[int, Tuple[str, str]]:
+    """事件循环上取 (姓名, 用户名)：冷用户取字段要解码，不能放线程里；每 chunk 个人让一下事件循环"""
+    names = {}
+    for i, uid in enumerate(uids, 1):
+        ud = app.user_data.get(uid)
+        names[uid] = (ud.name or "", ud.username or "") if ud else ("", "")
+        if i % chunk == 0:
+            await asyncio.sleep(0)
+    return names
+
+async def build_export(app: Application, chat_id: int, lo: str, hi: str, fmt: str) -> Tuple[str, int]:
+    """
+    生成导出文件，返回 (路径, 数据行数)。frozen 的月份导出线程直接读，事件循环上只分块拷还在写的月份和用户名，
+    内存只和这部分数据、以及人数有关，和导出的行数无关
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(EXPORT_POOL, EVENTS.preload, lo[:7], hi[:7])
+    months = _months_between(lo[:7], hi[:7])
+    frozen = [m for m in months if EVENTS.frozen(m)]
+    uids = await loop.run_in_executor(EXPORT_POOL, export_uids, chat_id, lo, hi, frozen)
+    live = {m: await EVENTS.snapshot(chat_id, lo, hi, m) for m in months if m not in frozen}
+    uids.update(row[0] for shifts in live.values() for _, rows in shifts for row in rows)
+    names = await export_names(app, uids)
+    return await loop.run_in_executor(EXPORT_POOL, write_export, export_shifts(chat_id, lo, hi, live), names, fmt)
+
+def export_rows(shifts, names: Dict[int, Tuple[str, str]]):
+    """逐行产出 (班次日期, 班次, uid, 姓名, 用户名, 类型, 次数, 秒数, 时长, 超时次数)，生成器一行一行给"""
+    for key, rows in shifts:
+        for uid, kind, count, secs, over in rows:
+            name, username = names.get(uid, ("", ""))
+            yield (key[:10], SHIFT_NAMES[key[10:]], uid, name, username, TITLES[kind],
+                   count, secs, fmt_dur_mmss(secs), over)
+
+def write_csv(path: str, rows) -> int:
+    n = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:   # 带 BOM，Excel 直接打开不乱码
+        w = csv.writer(f)
+        w.writerow(EXPORT_HEADER)
+        for row in rows:
+            w.writerow(row)
+            n += 1
+    return n
+
+_XML_BAD = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_XLSX_PARTS = {
+    "[Content_Types].xml":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/></Types>',
+    "_rels/.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/></Relationships>',
+    "xl/workbook.xml":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="打卡" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    "xl/_rels/workbook.xml.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/></Relationships>',
+}
 
+def _xlsx_cell(value) -> str:
+    if isinstance(value, int):
+        return f"<c><v>{value}</v></c>"
+    text = _XML_BAD.sub("", str(value)).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def write_xlsx(path: str, rows) -> int:
+    """最小可用的 xlsx（不依赖 openpyxl）：工作表 XML 边生成边压缩写进 zip，内存占用和行数无关"""
+    n = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in _XLSX_PARTS.items():
+            zf.writestr(name, xml)
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            buf = ["<row>" + "".join(map(_xlsx_cell, EXPORT_HEADER)) + "</row>"]
+            for row in rows:
+                buf.append("<row>" + "".join(map(_xlsx_cell, row)) + "</row>")
+                n += 1
+                if len(buf) >= 1000:
+                    f.write("".join(buf).encode())
+                    buf.clear()
+            f.write(("".join(buf) + "</sheetData></worksheet>").encode())
+    return n
+
+def write_export(shifts, names: Dict[int, Tuple[str, str]], fmt: str) -> Tuple[str, int]:
+    """在 EXPORT_POOL 里跑：shifts 是 export_shifts 的生成器，边读边写临时文件，返回 (路径, 数据行数)"""
+    fd, path = tempfile.mkstemp(prefix="export-", suffix="." + fmt)
+    os.close(fd)
+    try:
+        rows = export_rows(shifts, names)
+        return path, (write_xlsx if fmt == "xlsx" else write_csv)(path, rows)
+    except Exception:
+        os.remove(path)
+        raise
+
+async def export_and_send(app: Application, chat_id: int, lo: str, hi: str, fmt: str):
+    t0 = perf_counter()
+    try:
+        path, rows = await build_export(app, chat_id, lo, hi, fmt)
+    except Exception as e:
+        send(chat_id, f"❌ 导出失败：{e}")
+        return
+    FLUSH_SECONDS.observe("export_" + fmt, perf_counter() - t0)
+    try:
+        if not rows:
+            send(chat_id, "该时间段暂无数据。")
+            return
+        # 发送队列按路径上传（每次尝试重新打开文件），发完或放弃之后才删
+        msg = await OUTBOX.submit_document(chat_id, path, f"checkin_{lo}_{hi}.{fmt}",
+                                           caption=f"📎 {label_range('shift', lo, hi)}：共 {rows} 行", parse_mode=None)
+    finally:
+        os.remove(path)
+    if msg is None:
+        send(chat_id, "❌ 导出文件发送失败（Telegram 暂时发不出去），请稍后再 /export 一次。")
+
+@timed
+async def cmd_export(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """/export [日期/班次范围] [csv|xlsx]：马上回一句，文件在后台生成后再发"""
+    if not await is_admin(update):
+        return reply(update, "❌ 仅管理员可用。")
+    args = list(ctx.args or [])
+    fmt = args.pop().lower() if args and args[-1].lower() in ("csv", "xlsx") else "csv"
+    rng = parse_summary_range(args) if args else ("shift", shift_epoch(), shift_epoch())
+    if rng is None:
+        return reply(update, "用法：/export [2026-10-01 2026-10-15 | 昨天 | 2026-10-15 夜班] [csv|xlsx]")
+    if EVENTS is None:
+        return reply(update, "历史记录未启用。")
+    level, lo, hi = rng
+    if level == "day":
+        lo, hi = lo + "D", hi + "N"
+    reply(update, f"⏳ 正在导出 {label_range('shift', lo, hi)}（{fmt}），生成后发文件。")
+    ctx.application.create_task(export_and_send(ctx.application, update.effective_chat.id, lo, hi, fmt),
+                                update=update)
+
+def set_chat_rule(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, table: str, kind: str, value: int):
+    """群里管理员改的规则只影响本群：写进 chat_data 随持久化落盘，并让缓存重新合并"""
+    ctx.chat_data.setdefault("policy", {}).setdefault(table, {})[kind] = value
+    POLICIES.forget(chat_id)
+
+@timed
+@per_chat
 async def cmd_setlimit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        return await update.effective_message.reply_html("❌ 仅管理员可用。")
+        return reply(update, "❌ 仅管理员可用。")
     try:
         name, minutes = ctx.args[0], int(ctx.args[1])
     except Exception:
-        return await update.effective_message.reply_html("用法：/setlimit 抽烟 12")
-    key = next((k for k, v in TITLES.items() if v == name), None)
+        return reply(update, "用法：/setlimit 抽烟 12")
+    key = KIND_BY_NAME.get(name)
     if not key:
-        return await update.effective_message.reply_html("类型不对：厕所/抽烟/吃饭")
-    LIMITS[key] = minutes
-    await update.effective_message.reply_html(f"✅ 已将上限设置为 <b>{minutes}</b> 分。")
-
+        return reply(update, "类型不对：厕所/抽烟/吃饭")
+    if minutes <= 0:
+        return reply(update, "时长必须是大于 0 的分钟数，例如：/setlimit 抽烟 12")
+    set_chat_rule(ctx, update.effective_chat.id, "limits", key, minutes)
+    reply(update, f"✅ 已将本群{TITLES[key]}上限设置为 <b>{minutes}</b> 分。")
+
+@timed
+@per_chat
 async def cmd_setcount(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        return await update.effective_message.reply_html("❌ 仅管理员可用。")
+        return reply(update, "❌ 仅管理员可用。")
     try:
         name, cnt = ctx.args[0], int(ctx.args[1])
     except Exception:
-        return await update.effective_message.reply_html("用法：/setcount 抽烟 2")
-    key = next((k for k, v in TITLES.items() if v == name), None)
+        return reply(update, "用法：/setcount 抽烟 2")
+    key = KIND_BY_NAME.get(name)
     if not key:
-        return await update.effective_message.reply_html("类型不对：厕所/抽烟/吃饭")
-    LIMITS_COUNT[key] = cnt
-    await update.effective_message.reply_html(f"✅ 已将每班次数上限设置为 <b>{cnt}</b> 次。")
-
+        return reply(update, "类型不对：厕所/抽烟/吃饭")
+    if cnt < 0:
+        return reply(update, "次数不能是负数，例如：/setcount 抽烟 2")
+    set_chat_rule(ctx, update.effective_chat.id, "counts", key, cnt)
+    reply(update, f"✅ 已将本群{TITLES[key]}每班次数上限设置为 <b>{cnt}</b> 次。")
+
+@timed
+@per_chat
 async def cmd_mute(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        return await update.effective_message.reply_html("❌ 仅管理员可用。")
+        return reply(update, "❌ 仅管理员可用。")
     ctx.chat_data["muted"] = True
-    await update.effective_message.reply_html("🔕 已开启静音（仅保留换班统计与到时提醒）。")
+    reply(update, "🔕 已开启静音（仅保留换班统计与到时提醒）。")
 
+@timed
+@per_chat
 async def cmd_unmute(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        return await update.effective_message.reply_html("❌ 仅管理员可用。")
+        return reply(update, "❌ 仅管理员可用。")
     ctx.chat_data["muted"] = False
-    await update.effective_message.reply_html("🔔 已取消静音（管理员提醒仍会保留）。")
+    reply(update, "🔔 已取消静音（管理员提醒仍会保留）。")
 
+@timed
 async def cmd_id(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    await update.effective_message.reply_html(f"{mention_user_html(u)} 的 user_id 是 <code>{u.id}</code>")
+    reply(update, f"{mention_user_html(u)} 的 user_id 是 <code>{u.id}</code>")
 
+@timed
 async def cmd_ping(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     t0 = perf_counter()
-    m = await update.effective_message.reply_text("pong…")
+    m = await reply(update, "pong…")
     dt = (perf_counter() - t0) * 1000
-    await m.edit_text(f"pong {dt:.0f} ms")
+    if m is None:
+        return
+    waits = OUTBOX.wait_stats()
+    await m.edit_text(
+        f"pong {dt:.0f} ms\n"
+        f"管理员缓存：命中 {ADMIN_CACHE_STATS['hit']} / 未命中 {ADMIN_CACHE_STATS['miss']}\n"
+        f"发送队列：积压 {OUTBOX.depth} 条，等待 p50 {waits['p50'] * 1000:.0f} ms / "
+        f"p99 {waits['p99'] * 1000:.0f} ms，429 {OUTBOX.stats['retry_after']} 次\n"
+        f"待删除：{len(pending_deletes(ctx.application))} 条"
+    )
 
 # ========= 文本触发 =========
+GROUP_TEXT = F.TEXT & F.ChatType.GROUPS & (~F.COMMAND)
+
 def normalize_txt(s: str) -> str:
     return (s or "").strip().lower()
 
-async def text_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    txt = normalize_txt(update.effective_message.text)
-    for kind, words in TRIGGERS.items():
-        if txt in {w.lower() for w in words}:
-            await begin(update, ctx, kind)
-            return
-
-async def text_back(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    txt = normalize_txt(update.effective_message.text)
-    if BACK_RE.match(txt):
-        await end_session(update, ctx)
+@timed
+async def text_dispatch(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """群内文本只归一化一次、群规则只取一次，查表后分发到 begin / end_session / text_help"""
+    policy = POLICIES.get(update.effective_chat.id, ctx.chat_data)
+    action = policy.actions.get(normalize_txt(update.effective_message.text))
+    if action is None:
+        await text_help(update, ctx, policy)
+    elif action == ACTION_BACK:
+        await end_session(update, ctx, policy)
+    else:
+        await begin(update, ctx, action, policy)
 
 # 乱输入：普通员工提示打卡说明，管理员完全忽略
-async def text_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+class Debounce:
+    """同一个 key 在 window 秒内只放行一次；按时间先后存放，过期的从最早的一头清掉"""
+
+    __slots__ = ("window", "_last")
+
+    def __init__(self, window: float):
+        self.window = window
+        self._last: Dict[Any, float] = {}
+
+    def hit(self, key, now: float) -> bool:
+        """key 还在窗口内（最近放行过）"""
+        last = self._last
+        while last:
+            oldest = next(iter(last))
+            if now - last[oldest] < self.window:
+                break
+            del last[oldest]
+        return key in last
+
+    def mark(self, key, now: float):
+        self._last.pop(key, None)
+        self._last[key] = now
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+HELP_BY_CHAT = Debounce(HELP_CHAT_WINDOW)
+HELP_BY_USER = Debounce(HELP_USER_WINDOW)
+HELP_REPLIES = CounterVec("bot_help_replies_total", "群里乱输：发了说明 / 因群或个人窗口被压掉", ("result",))
+
+@timed
+async def text_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE, policy: Optional[Policy] = None):
     # 管理员：不提示、不删
     if await is_admin(update):
         return
@@ -620,30 +3030,38 @@ async def text_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     user = update.effective_user
 
+    # 窗口内已经发过说明：不再回复，只把这条乱输排进待删（随 sweep 按群批量删除）
+    now = CLOCK.monotonic()
+    suppressed = ("suppressed_chat" if HELP_BY_CHAT.hit(chat.id, now)
+                  else "suppressed_user" if HELP_BY_USER.hit((chat.id, user.id), now) else None)
+    if suppressed:
+        HELP_REPLIES.inc(suppressed)
+        schedule_delete(ctx.application, chat.id, (msg.id,), HELP_DELETE_MINUTES * 60)
+        return
+    HELP_BY_CHAT.mark(chat.id, now)
+    HELP_BY_USER.mark((chat.id, user.id), now)
+    HELP_REPLIES.inc("sent")
+
     txt = (
         "打卡说明：\n"
         "• 开始：发送“厕所/抽烟/吃饭”（或 wc/smoke/eat 等别名）\n"
         "• 结束：发送“回来/回/back/1”或 /back\n"
-        "• 时长：厕所10分，抽烟10分，吃饭30分；到时提醒；超时提示。\n"
-        "• 最小时长：厕所30秒、抽烟30秒、吃饭60秒，未达不计且不冷却。\n"
-        f"• 超时：到时提醒本人，{GRACE_MINUTES} 分钟后仍未结束会@管理员。"
+        + (policy or POLICIES.get(chat.id, ctx.chat_data)).rules_text()
     )
 
-    sent = await msg.reply_html(txt)
-
-    ctx.job_queue.run_once(
-        delete_help_messages,
-        when=HELP_DELETE_MINUTES * 60,
-        data={
-            "chat_id": chat.id,
-            "user_msg_id": msg.id,
-            "bot_msg_id": sent.message_id,
-        },
-        name=f"del-help-{chat.id}-{msg.id}",
+    reply(
+        update, txt, prio=PRIO_HELP,
+        on_sent=lambda sent: schedule_delete(
+            ctx.application, chat.id, (sent.message_id, msg.id), HELP_DELETE_MINUTES * 60
+        ),
     )
 
 # ========= 启动前：设置 / 菜单命令 =========
-async def setup_bot_commands(app: Application):
+async def setup_bot_commands(app: Application) -> int:
+    """
+    菜单没变（和 bot_data 里记的哈希一样）就一个请求都不发；变了三个范围并发设置。
+    set_my_commands 本身就是整表覆盖，不用先 delete。返回发出的请求数
+    """
     commands = [
         BotCommand("start", "查看打卡说明"),
         BotCommand("toilet", "开始厕所打卡"),
@@ -651,7 +3069,8 @@ async def setup_bot_commands(app: Application):
         BotCommand("meal", "开始吃饭打卡"),
         BotCommand("back", "结束打卡（回来）"),
         BotCommand("who", "查看当前未回来名单（管理员）"),
-        BotCommand("summary", "查看本班汇总（管理员）"),
+        BotCommand("summary", "本班汇总，可带日期/班次查历史（管理员）"),
+        BotCommand("export", "导出打卡表 CSV/XLSX，可带日期/班次（管理员）"),
         BotCommand("setlimit", "设置上限时长（管理员）"),
         BotCommand("setcount", "设置每班次数上限（管理员）"),
         BotCommand("mute", "静音模式（管理员）"),
@@ -659,36 +3078,584 @@ async def setup_bot_commands(app: Application):
         BotCommand("id", "查看自己的 user_id"),
         BotCommand("ping", "延迟测试"),
     ]
-    await app.bot.delete_my_commands(scope=BotCommandScopeDefault())
-    await app.bot.delete_my_commands(scope=BotCommandScopeAllGroupChats())
-    await app.bot.delete_my_commands(scope=BotCommandScopeAllPrivateChats())
-    await app.bot.set_my_commands(commands, scope=BotCommandScopeDefault())
-    await app.bot.set_my_commands(commands, scope=BotCommandScopeAllGroupChats())
-    await app.bot.set_my_commands(commands, scope=BotCommandScopeAllPrivateChats())
+    digest = hashlib.sha256(
+        json.dumps([(c.command, c.description) for c in commands], ensure_ascii=False).encode()
+    ).hexdigest()[:16]
+    if app.bot_data.get("commands_hash") == digest:
+        return 0
+    scopes = (BotCommandScopeDefault(), BotCommandScopeAllGroupChats(), BotCommandScopeAllPrivateChats())
+    await asyncio.gather(*(app.bot.set_my_commands(commands, scope=scope) for scope in scopes))
+    app.bot_data["commands_hash"] = digest
+    return len(scopes)
+
+async def sync_commands_in_background(app: Application):
+    # 不挡着启动；失败了不记哈希，下次启动再试
+    try:
+        await setup_bot_commands(app)
+    except Exception as e:
+        print(f"设置菜单命令失败：{e!r}")
+
+async def post_init(app: Application):
+    global OUTBOX, TIMERS, EVENTS, EVENTS_WARM, HYDRATION
+    EVENTS = EventLog(EVENT_DIR, tag=shard_tag())
+    EVENTS_WARM = asyncio.get_running_loop().create_task(
+        asyncio.to_thread(EVENTS.rollup, shift_of(CLOCK.time())[0][:7]))
+    OUTBOX = Outbox(app.bot, SEND_RATE_GLOBAL / SHARDS, SEND_PER_CHAT_MIN)   # 全局限速各 worker 平分
+    if OUTBOX_FILE:
+        OUTBOX.journal = await asyncio.to_thread(OutboxJournal, shard_path(OUTBOX_FILE))
+        OUTBOX.guard = lambda guard: session_alive(app, *guard)
+    OUTBOX.start()
+    config = await asyncio.to_thread(POLICIES.read_if_changed)
+    if config is not None:
+        POLICIES.apply(config)
+    if isinstance(app.persistence, SQLitePersistence):
+        global BACKUPS
+        BACKUPS = BackupStore(app.persistence.filepath, BACKUP_DIR, shard_tag(), app.persistence)
+    TIMERS = DeadlineHeap(lambda *entry: fire_deadline(app, *entry))
+    TIMERS.start()
+    cold = [ud for ud in app.user_data.values() if ud.is_cold]
+    if cold:
+        HYDRATION = asyncio.get_running_loop().create_task(hydrate_users(app, cold))
+    else:
+        HYDRATION = None
+        await hydrate_users(app, cold)
+    if METRICS_PORT:
+        global METRICS_HTTP
+        METRICS_HTTP = await serve_http(metrics_handler(app), "127.0.0.1", METRICS_PORT + SHARD_ID)
+    if SHARD_ID == 0:
+        asyncio.get_running_loop().create_task(sync_commands_in_background(app))
+    BOOT["ready"] = monotonic() - BOOT["started"]
+    verdict = "" if BOOT["ready"] * 1000 <= STARTUP_TARGET_MS else f"，超过目标 {STARTUP_TARGET_MS} ms"
+    print(f"启动完成：{BOOT['ready'] * 1000:.0f} ms（{len(cold)} 个用户在后台找进行中的打卡{verdict}）")
+
+async def post_stop(app: Application):
+    if HYDRATION is not None:
+        HYDRATION.cancel()
+    if METRICS_HTTP is not None:
+        METRICS_HTTP.close()
+    if TIMERS is not None:
+        TIMERS.stop()
+    if OUTBOX is not None:
+        await OUTBOX.stop()
+        if OUTBOX.journal is not None:
+            OUTBOX.journal.close()   # 没发出去的留在日志里，下次启动补发
+    if EVENTS is not None:
+        EVENTS.close()
+    if RECORDER is not None:
+        RECORDER.close()
+
+# ========= Webhook：内置 asyncio HTTP 服务（同端口带 /healthz） =========
+HttpHandler = Callable[[str, str, Dict[str, str], bytes], Awaitable[Tuple[int, str, bytes]]]
+HttpAdmit = Callable[[str, str, Dict[str, str]], Optional[Tuple[int, str, bytes]]]
+
+async def serve_http(handler: HttpHandler, host: str, port: int, admit: Optional[HttpAdmit] = None,
+                     max_body: int = HTTP_MAX_BODY) -> asyncio.AbstractServer:
+    """
+    极简 HTTP/1.1 服务（支持 keep-alive），够 Telegram 推送和健康检查用。
+    handler(method, path, headers, body) -> (status, content_type, payload)
+    读请求体之前先看头：Content-Length 超过 max_body 回 413，admit(method, path, headers) 返回响应时直接回它；
+    这两种情况请求体没读，回完就断开连接
+    """
+    def respond(writer: asyncio.StreamWriter, status: int, ctype: str, payload: bytes, close: bool = False):
+        extra = "Connection: close\r\n" if close else ""
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n{extra}\r\n".encode() + payload
+        )
 
-# ========= 入口 =========
-def backup_pickle():
-    if os.path.exists("botdata.pkl"):
-        os.makedirs("backup", exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-        shutil.copy2("botdata.pkl", f"backup/botdata-{ts}.pkl")
+    async def on_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode("latin-1").split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    raw = await reader.readline()
+                    if raw in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = raw.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                refused = (413, "text/plain", b"too large") if not 0 <= length <= max_body \
+                    else admit(method, path, headers) if admit is not None else None
+                if refused is not None:
+                    respond(writer, *refused, close=True)
+                    await writer.drain()
+                    break
+                body = await reader.readexactly(length)
+                respond(writer, *await handler(method, path, headers, body))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_conn, host, port)
+
+class WebhookServer:
+    """校验 secret token 后把 Update 放进 application.update_queue；GET /healthz 返回运行状态"""
+
+    def __init__(self, app: Application, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH):
+        self.app = app
+        self.secret = secret
+        self.path = path
+        self.received = 0
+        self.rejected = 0
+
+    def admit(self, method: str, path: str, headers: Dict[str, str]) -> Optional[Tuple[int, str, bytes]]:
+        """读请求体之前：不是发到 webhook 路径的、secret 不对的直接拒掉（不给陌生请求分配内存）"""
+        if path == "/healthz":
+            return None
+        if method != "POST" or path != self.path:
+            return 404, "text/plain", b"not found"
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return 403, "text/plain", b"forbidden"
+        return None
+
+    async def handle(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        if path == "/healthz":
+            return 200, "application/json", json.dumps(self.health()).encode()
+        refused = self.admit(method, path, headers)
+        if refused is not None:
+            return refused
+        try:
+            item = self.decode(json.loads(body))
+        except Exception:
+            return 400, "text/plain", b"bad update"
+        self.received += 1
+        await self.deliver(item)
+        return 200, "text/plain", b"ok"
+
+    def decode(self, data: Any) -> Any:
+        return Update.de_json(data, self.app.bot)
+
+    async def deliver(self, item: Any):
+        await self.app.update_queue.put(item)
+
+    def health(self) -> dict:
+        return {
+            "ok": self.app.running,
+            "received": self.received,
+            "rejected": self.rejected,
+            "update_queue": self.app.update_queue.qsize(),
+            "outbox": OUTBOX.depth if OUTBOX else 0,
+            "active_sessions": sum(map(len, ACTIVE_BY_CHAT.values())),
+        }
 
-def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("缺少 BOT_TOKEN：请设置环境变量 BOT_TOKEN 或在代码中填写。")
+async def run_webhook(app: Application, url: str, port: int = PORT, stop: Optional[asyncio.Event] = None):
+    """webhook 模式：自己管理 Application 的启动/停止，收到 SIGTERM/SIGINT（或 stop 被 set）时退出"""
+    loop = asyncio.get_running_loop()
+    if stop is None:
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    server = WebhookServer(app)
+    http = await serve_http(server.handle, "0.0.0.0", port, admit=server.admit)
+    await app.bot.set_webhook(
+        url.rstrip("/") + WEBHOOK_PATH,
+        secret_token=server.secret,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=True,
+    )
+    await app.start()
+    print(f"Webhook listening on :{port}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        http.close()
+        await http.wait_closed()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# ========= 监控端点：GET /metrics（METRICS_PORT，只监听本机） =========
+def _gauge(out: List[str], name: str, doc: str, samples):
+    out += [f"# HELP {name} {doc}", f"# TYPE {name} gauge"]
+    if isinstance(samples, dict):
+        out += [f"{name}{{{labels}}} {v}" for labels, v in samples.items()]
+    else:
+        out.append(f"{name} {samples}")
+
+def render_metrics(app: Application) -> str:
+    out: List[str] = []
+    for metric in (HANDLER_SECONDS, HANDLER_ERRORS, API_SECONDS, API_ERRORS, FLUSH_SECONDS, HELP_REPLIES, SLOW_TRACES):
+        out += metric.render()
+    if OUTBOX is not None:
+        out += ["# HELP bot_outbox_total 发送队列结果（failed = 重试后仍失败被丢弃，retried = 失败后隔一会儿重试）", "# TYPE bot_outbox_total counter"]
+        out += [f'bot_outbox_total{{result="{k}"}} {v}' for k, v in OUTBOX.stats.items()]
+        _gauge(out, "bot_outbox_depth", "发送队列里等待 / 发送中的消息", OUTBOX.depth)
+        journal = OUTBOX.journal
+        if journal is not None:
+            out += ["# HELP bot_outbox_durable_total 要紧消息的结果（stale = 打卡已结束不再提醒，deduped = 同一个 key 重复）",
+                    "# TYPE bot_outbox_durable_total counter"]
+            out += [f'bot_outbox_durable_total{{result="{k}"}} {v}' for k, v in journal.stats.items()]
+            _gauge(out, "bot_outbox_backlog", "日志里还没发出的要紧消息", len(journal))
+            _gauge(out, "bot_outbox_backlog_oldest_seconds", "最早一条没发出的要紧消息等了多久", journal.oldest_age())
+            _gauge(out, "bot_outbox_drain_per_second", "最近一分钟每秒发出 / 放弃的要紧消息", journal.drain_rate())
+    out += ["# HELP bot_admin_cache_total 管理员名单缓存命中", "# TYPE bot_admin_cache_total counter"]
+    out += [f'bot_admin_cache_total{{result="{k}"}} {v}' for k, v in ADMIN_CACHE_STATS.items()]
+    _gauge(out, "bot_active_sessions", "进行中的打卡（按群）",
+           {f'chat="{chat_id}"': len(sessions) for chat_id, sessions in ACTIVE_BY_CHAT.items()})
+    _gauge(out, "bot_pending_jobs", "JobQueue 里的任务", len(app.job_queue.jobs()) if app.job_queue else 0)
+    _gauge(out, "bot_pending_deadlines", "到期堆里的提醒", len(TIMERS) if TIMERS is not None else 0)
+    _gauge(out, "bot_pending_deletes", "待删除的消息", len(app.bot_data.get("pending_deletes", ())))
+    _gauge(out, "bot_user_data_entries", "user_data 里的用户数", len(app.user_data))
+    _gauge(out, "bot_startup_seconds", "进程启动到各阶段的耗时",
+           {f'stage="{stage}"': BOOT[stage] for stage in ("ready", "first_update")})
+    _gauge(out, "bot_chat_data_entries", "chat_data 里的群数", len(app.chat_data))
+    _gauge(out, "bot_policy_cached_chats", "已合并好规则的群", len(POLICIES))
+    _gauge(out, "bot_policy_reloads", "规则文件加载次数", POLICIES.reloads)
+    if isinstance(app.persistence, SQLitePersistence):
+        _gauge(out, "bot_persistence_last_flush_seconds", "最近一次落盘耗时", app.persistence.last_flush_ms / 1000)
+        _gauge(out, "bot_persistence_last_flush_rows", "最近一次落盘写入的行数", app.persistence.last_flush_rows)
+    if BACKUPS is not None and BACKUPS.last["kind"]:
+        _gauge(out, "bot_backup_last_bytes", "最近一次备份文件大小",
+               {f'kind="{BACKUPS.last["kind"]}"': BACKUPS.last["bytes"]})
+        _gauge(out, "bot_backup_last_rows", "最近一次备份写入的行数", BACKUPS.last["rows"])
+        _gauge(out, "bot_backup_last_timestamp_seconds", "最近一次备份时间", BACKUPS.last["taken"])
+    return "\n".join(out) + "\n"
+
+def metrics_handler(app: Application) -> HttpHandler:
+    async def handle(method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        if path.split("?", 1)[0] != "/metrics":
+            return 404, "text/plain", b"not found"
+        return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics(app).encode()
+    return handle
+
+METRICS_HTTP: Optional[asyncio.AbstractServer] = None
+
+# ========= 多进程：入口进程按 chat_id 分发，每个 worker 管自己那一片群 =========
+SHARD0_COMMANDS = {"/id"}   # 不依赖群状态的命令，固定交给 0 号
+
+def chat_shard(chat_id: Optional[int], shards: int) -> int:
+    """群按 chat_id 取模分片；私聊（正数 id）和没有 chat 的都归 0 号"""
+    if shards <= 1 or not chat_id or chat_id > 0:
+        return 0
+    return chat_id % shards
+
+def shard_of(data: dict, shards: int) -> int:
+    """原始 Update JSON → 分片号（入口进程不反序列化 Update）"""
+    body = data.get("message") or data.get("edited_message") or data.get("chat_member") \
+        or data.get("my_chat_member") or {}
+    text = body.get("text") or ""
+    if text.startswith("/") and text.split(None, 1)[0].split("@", 1)[0] in SHARD0_COMMANDS:
+        return 0
+    return chat_shard((body.get("chat") or {}).get("id"), shards)
+
+def shard_tag(shard: Optional[int] = None, shards: Optional[int] = None) -> str:
+    shard = SHARD_ID if shard is None else shard
+    shards = SHARDS if shards is None else shards
+    return "" if shards <= 1 else f".s{shard}of{shards}"
+
+def shard_path(path: str, shard: Optional[int] = None, shards: Optional[int] = None) -> str:
+    """botdata.db → botdata.s1of4.db；单进程原样返回"""
+    base, ext = os.path.splitext(path)
+    return base + shard_tag(shard, shards) + ext
+
+def merge_user_copies(a: UserState, b: UserState) -> UserState:
+    """
+    同一用户在几个分片各有一份（在不同分片的群里都打过卡）时合成一份：其余字段以最近用过的那份为准；
+    同一班的统计按群合并，同一个群两份都有时逐项取大（一班之内只增不减）；冷却按类型取最晚；
+    进行中的打卡哪份有就留哪份
+    """
+    new, old = (a, b) if a.last_seen >= b.last_seen else (b, a)
+    if old.epoch == new.epoch:
+        for cid, c in old.stats.items():
+            mine = new.stats.get(cid)
+            if mine is None:
+                new.stats[cid] = c
+            else:
+                mine.count = array("I", map(max, mine.count, c.count))
+                mine.dur = array("I", map(max, mine.dur, c.dur))
+    elif old.epoch > new.epoch:
+        new.epoch, new.stats = old.epoch, old.stats
+    new.last_end = array("d", map(max, new.last_end, old.last_end))
+    if new.active is None and old.active is not None:
+        new.active, new.last_chat_id = old.active, old.last_chat_id
+    return new
+
+def reshard_db(shards: int, db_path: str = DB_FILE) -> bool:
+    """
+    分片数变了（包括 单进程 ↔ 多进程）时重新分配数据库里的行：
+    - chat_data 按 chat_id 分
+    - user_data 同一用户多份时用 merge_user_copies 合成一份，写进它打过卡的群所在的每一片；
+      进行中的打卡只留在 last_chat_id 那一片，别的片里不能再提醒一遍
+    - bot_data 里的待删消息按群分，其余键每片一份
+    旧文件改名为 .resharded
+    """
+    base, ext = os.path.splitext(db_path)
+    targets = [shard_path(db_path, i, shards) for i in range(shards)]
+    sources = sorted({p for p in [db_path] + glob.glob(glob.escape(base) + ".s*of*" + ext) if os.path.exists(p)})
+    if not [p for p in sources if p not in targets]:
+        return False
 
-    defaults = Defaults(parse_mode=constants.ParseMode.HTML)
-    persistence = PicklePersistence(filepath="botdata.pkl", update_interval=30)
+    users: Dict[int, UserState] = {}
+    chats: Dict[int, dict] = {}
+    bot_data: dict = {}
+    deletes: List[Tuple[float, int, int]] = []
+    for path in sources:
+        conn = open_db(path)
+        for uid, blob in conn.execute("SELECT id, data FROM user_data"):
+            ud = UserState.from_record(pickle.loads(blob))
+            users[uid] = merge_user_copies(users[uid], ud) if uid in users else ud
+        for cid, blob in conn.execute("SELECT id, data FROM chat_data"):
+            chats[cid] = pickle.loads(blob)
+        for _, blob in conn.execute("SELECT id, data FROM bot_data"):
+            data = pickle.loads(blob)
+            deletes.extend(data.pop("pending_deletes", []))
+            for k, v in data.items():
+                bot_data.setdefault(k, v)
+        conn.close()
+
+    dump = functools.partial(pickle.dumps, protocol=pickle.HIGHEST_PROTOCOL)
+    rows: List[List[Tuple[int, bytes]]] = [[] for _ in targets]
+    for uid, ud in users.items():
+        owner = chat_shard(ud.last_chat_id, shards)
+        rows[owner].append((uid, dump(ud.to_record())))
+        others = {chat_shard(cid, shards) for cid in ud.stats} - {owner}
+        if others:
+            ud.active = None
+            bare = dump(ud.to_record())
+            for i in others:
+                rows[i].append((uid, bare))
+    for i, target in enumerate(targets):
+        tmp = target + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        conn = open_db(tmp)
+        with conn:
+            conn.executemany("INSERT INTO user_data (id, data) VALUES (?, ?)", rows[i])
+            conn.executemany("INSERT INTO chat_data (id, data) VALUES (?, ?)", [
+                (cid, dump(cd)) for cid, cd in chats.items() if chat_shard(cid, shards) == i
+            ])
+            mine = [d for d in deletes if chat_shard(d[1], shards) == i]
+            heapq.heapify(mine)
+            conn.execute("INSERT INTO bot_data (id, data) VALUES (0, ?)", (dump(dict(bot_data, pending_deletes=mine)),))
+        conn.close()
+    for path in sources:
+        os.replace(path, path + ".resharded")
+    for target in targets:
+        os.replace(target + ".tmp", target)
+    print(f"数据库已按 {shards} 个分片重新分配：{', '.join(targets)}")
+    return True
+
+class ShardRouter:
+    """入口进程：Update JSON 按分片排队，每片一个协程把攒下的一批写进该 worker 的管道"""
+
+    def __init__(self, conns: List[Any], procs: Optional[List[Any]] = None):
+        self.conns = conns
+        self.procs = procs or []
+        self.queues: List[asyncio.Queue] = [asyncio.Queue() for _ in conns]
+        self.sent = [0] * len(conns)
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._pump(i)) for i in range(len(self.conns))]
+
+    def route(self, data: dict):
+        self.queues[shard_of(data, len(self.conns))].put_nowait(data)
+
+    async def _pump(self, i: int):
+        queue, conn = self.queues[i], self.conns[i]
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                # 管道满了会阻塞，放线程里等，别的分片照常发
+                await asyncio.to_thread(conn.send_bytes, json.dumps(batch).encode())
+                self.sent[i] += len(batch)
+            except (OSError, ValueError):
+                pass   # worker 已退出
+            for _ in batch:
+                queue.task_done()
+
+    def alive(self) -> bool:
+        return all(p.is_alive() for p in self.procs)
+
+    async def stop(self, timeout: float = 5):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for conn in self.conns:
+            conn.close()   # worker 收到 EOF 后处理完手上的更新再退出
+
+class IngressServer(WebhookServer):
+    """入口进程的 webhook：只校验 + 转发原始 JSON，不反序列化"""
+
+    def __init__(self, router: ShardRouter, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH):
+        super().__init__(None, secret, path)
+        self.router = router
+
+    def decode(self, data: Any) -> Any:
+        if not isinstance(data, dict) or "update_id" not in data:
+            raise ValueError("not an update")
+        return data
+
+    async def deliver(self, item: Any):
+        self.router.route(item)
+
+    def health(self) -> dict:
+        return {
+            "ok": self.router.alive(),
+            "received": self.received,
+            "rejected": self.rejected,
+            "shards": [{"sent": sent, "queued": q.qsize()} for sent, q in zip(self.router.sent, self.router.queues)],
+        }
+
+async def poll_into(bot, router: ShardRouter, stop: asyncio.Event):
+    """入口进程的 long polling：getUpdates 拿到的更新直接按分片转发"""
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = 0
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=25, allowed_updates=ALLOWED_UPDATES)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Exception:
+            await asyncio.sleep(3)
+            continue
+        for update in updates:
+            router.route(update.to_dict())
+            offset = update.update_id + 1
+
+async def serve_worker(app: Application, conn):
+    """worker：从管道读入口进程转来的更新，入口关掉管道后处理完剩下的再退出"""
+    loop = asyncio.get_running_loop()
+    closed = asyncio.Event()
+
+    def feed(batch: List[dict]):
+        for data in batch:
+            app.update_queue.put_nowait(Update.de_json(data, app.bot))
+
+    def pump():
+        try:
+            while True:
+                loop.call_soon_threadsafe(feed, json.loads(conn.recv_bytes()))
+        except (EOFError, OSError):
+            loop.call_soon_threadsafe(closed.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    threading.Thread(target=pump, name="shard-pipe", daemon=True).start()
+    try:
+        await closed.wait()
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+
+def worker_main(shard: int, shards: int, conn):
+    """worker 进程入口：自己的数据库 / 历史分段 / 定时器，只处理分到本片的群"""
+    global SHARD_ID, SHARDS
+    # Ctrl+C 和 SIGTERM（Heroku 重启 / 部署时发给 dyno 里每个进程）都交给入口进程：
+    # 它关掉管道后 worker 才停机收尾（落盘、刷历史和发送日志）；入口进程异常退出时管道也会关
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal.SIG_IGN)
+    SHARD_ID, SHARDS = shard, shards
+    persistence = SQLitePersistence(filepath=shard_path(DB_FILE), update_interval=PERSIST_INTERVAL)
+    asyncio.run(serve_worker(build_app(persistence=persistence), conn))
+
+def spawn_workers(shards: int, target: Callable = worker_main, *extra) -> Tuple[List[Any], List[Any]]:
+    ctx = multiprocessing.get_context("spawn")
+    conns, procs = [], []
+    for i in range(shards):
+        recv, send_end = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=target, args=(i, shards, recv, *extra), name=f"shard-{i}")
+        proc.start()
+        recv.close()
+        conns.append(send_end)
+        procs.append(proc)
+    return conns, procs
+
+async def run_sharded(shards: int, url: Optional[str] = WEBHOOK_URL, port: int = PORT,
+                      stop: Optional[asyncio.Event] = None):
+    """多进程模式的入口进程：收更新（webhook 或 polling）→ 按群分给 worker"""
+    loop = asyncio.get_running_loop()
+    if stop is None:
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+    conns, procs = spawn_workers(shards)
+    router = ShardRouter(conns, procs)
+    router.start()
+    bot = Bot(BOT_TOKEN)
+    await bot.initialize()
+    http = poller = None
+    if url:
+        server = IngressServer(router)
+        http = await serve_http(server.handle, "0.0.0.0", port, admit=server.admit)
+        await bot.set_webhook(url.rstrip("/") + WEBHOOK_PATH, secret_token=server.secret,
+                              allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
+        print(f"Ingress webhook on :{port}{WEBHOOK_PATH} → {shards} workers")
+    else:
+        poller = asyncio.create_task(poll_into(bot, router, stop))
+        print(f"Ingress polling → {shards} workers")
+    try:
+        await stop.wait()
+    finally:
+        if http is not None:
+            http.close()
+            await http.wait_closed()
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        await router.stop()
+        await bot.shutdown()
+        for proc in procs:
+            await asyncio.to_thread(proc.join, 30)
 
-    backup_pickle()
-    app: Application = (
+# ========= 入口 =========
+def build_app(token: str = BOT_TOKEN, persistence: Optional[BasePersistence] = None,
+              request=None, concurrent_updates: int = CONCURRENT_UPDATES) -> Application:
+    """组装 Application（handler + 定时任务）；request 可换成假的 Bot API，方便压测"""
+    defaults = Defaults(parse_mode=constants.ParseMode.HTML)
+    builder = (
         ApplicationBuilder()
-        .token(BOT_TOKEN)
+        .token(token)
         .defaults(defaults)
-        .persistence(persistence)
-        .post_init(setup_bot_commands)
-        .build()
+        .context_types(ContextTypes(user_data=UserState))
+        .post_init(post_init)
+        .post_stop(post_stop)
     )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if request is None:
+        builder = builder.request(TimedRequest(HTTPXRequest(connection_pool_size=256)))
+        builder = builder.get_updates_request(TimedRequest(HTTPXRequest()))
+    else:
+        builder = builder.request(TimedRequest(request)).get_updates_request(TimedRequest(request))
+    if concurrent_updates:
+        builder = builder.concurrent_updates(concurrent_updates)
+    app: Application = builder.build()
+
+    # 录制（在所有 handler 之前）
+    if RECORD_FILE:
+        global RECORDER
+        RECORDER = UpdateRecorder(shard_path(RECORD_FILE))
+        app.add_handler(TypeHandler(Update, RECORDER), group=-1)
 
     # 命令
     app.add_handler(CommandHandler("start",   cmd_start))
@@ -698,6 +3665,7 @@ def main():
     app.add_handler(CommandHandler("back",    cmd_back))
     app.add_handler(CommandHandler("who",     cmd_who))
     app.add_handler(CommandHandler("summary", cmd_summary))
+    app.add_handler(CommandHandler("export",  cmd_export))
     app.add_handler(CommandHandler("setlimit", cmd_setlimit))
     app.add_handler(CommandHandler("setcount", cmd_setcount))
     app.add_handler(CommandHandler("mute",    cmd_mute))
@@ -705,32 +3673,60 @@ def main():
     app.add_handler(CommandHandler("id",      cmd_id))
     app.add_handler(CommandHandler("ping",    cmd_ping))
 
-    # 文本触发（群内）
-    app.add_handler(MessageHandler(
-        F.TEXT & F.ChatType.GROUPS & (~F.COMMAND) & F.Regex(START_RE),
-        text_start
-    ), group=0)
-
-    app.add_handler(MessageHandler(
-        F.TEXT & F.ChatType.GROUPS & (~F.COMMAND) & F.Regex(BACK_RE),
-        text_back
-    ), group=1)
+    # 管理员变动（需要 allowed_updates 包含 chat_member，且机器人是群管理员）
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
 
-    # 其它乱输（只有普通员工会走这里，管理员在 text_help 里直接 return）
-    app.add_handler(MessageHandler(
-        F.TEXT & F.ChatType.GROUPS & (~F.COMMAND) & (~F.Regex(START_RE)) & (~F.Regex(BACK_RE)),
-        text_help
-    ), group=99)
+    # 文本触发（群内）：开始 / 回来 / 其它乱输（管理员在 text_help 里直接 return）
+    app.add_handler(MessageHandler(GROUP_TEXT, text_dispatch))
 
     # 定时：07:00 & 19:00（UTC+7）换班统计并清状态
     app.job_queue.run_daily(reset_shift, time=dtime(7, 0, tzinfo=LOCAL_TZ),  name="reset-shift-0700")
     app.job_queue.run_daily(reset_shift, time=dtime(19, 0, tzinfo=LOCAL_TZ), name="reset-shift-1900")
 
-    # 启动后 5 秒执行一次换班（防止上次关机跨班数据残留）
-    app.job_queue.run_once(reset_shift, when=5, name="reset-on-start")
+    # 到期的提示类消息按群批量删除
+    app.job_queue.run_repeating(sweep_deletes, interval=DELETE_SWEEP_SECONDS, first=DELETE_SWEEP_SECONDS,
+                                name="sweep-deletes")
+    app.job_queue.run_repeating(flush_events, interval=PERSIST_INTERVAL, first=PERSIST_INTERVAL,
+                                name="flush-events")
+
+    # 每天 03:00 清理长期不用的用户（和换班错开）
+    app.job_queue.run_daily(prune_idle_users, time=dtime(3, 0, tzinfo=LOCAL_TZ), name="prune-idle-users")
+
+    # 群规则文件改了自动生效
+    app.job_queue.run_repeating(reload_policies, interval=POLICY_RELOAD_SECONDS, first=POLICY_RELOAD_SECONDS,
+                                name="reload-policies")
+
+    # 备份：隔一段时间写一次变化的行，每天一个整库快照
+    app.job_queue.run_repeating(backup_tick, interval=BACKUP_DELTA_MINUTES * 60, first=60, name="backup")
+
+    # 启动后补发上次没发出去的提醒 / 结果 / 统计
+    app.job_queue.run_once(replay_outbox, when=1, name="replay-outbox")
+
+    # 启动后 5 秒结束上一班遗留的打卡（防止上次关机跨班数据残留）
+    app.job_queue.run_once(reset_on_start, when=5, name="reset-on-start")
+    return app
+
+def main():
+    if sys.argv[1:2] == ["restore"]:
+        sys.exit(restore_cli(sys.argv[2:]))
+    if not BOT_TOKEN:
+        raise RuntimeError("缺少 BOT_TOKEN：请设置环境变量 BOT_TOKEN 或在代码中填写。")
+
+    migrate_pickle()
+    if WORKERS > 1:
+        reshard_db(WORKERS)
+        print(f"Bot running with {WORKERS} workers ...")
+        asyncio.run(run_sharded(WORKERS))
+        return
+    reshard_db(1)   # 从多进程切回单进程时把分片合并回来
+    persistence = SQLitePersistence(filepath=DB_FILE, update_interval=PERSIST_INTERVAL)
+    app = build_app(persistence=persistence)
 
     print("Bot running ...")
-    app.run_polling(close_loop=False, allowed_updates=["message"], drop_pending_updates=True)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app, WEBHOOK_URL, PORT))
+    else:
+        app.run_polling(close_loop=False, allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()